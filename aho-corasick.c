@@ -55,10 +55,18 @@
 
 #include "aho-corasick.h"
 
-#include "slist.h"
-
 #include <stdio.h>
 
+/* How many characters a byte of UTF-8 adds: none for continuation bytes,
+   and two for the lead byte of a character that a narrow build of Python
+   stores as a surrogate pair. */
+#if Py_UNICODE_SIZE == 2
+#define aho_corasick_utf8_width(c) \
+	(((c) & 0xC0) == 0x80 ? 0 : (c) >= 0xF0 ? 2 : 1)
+#else
+#define aho_corasick_utf8_width(c) (((c) & 0xC0) != 0x80)
+#endif
+
 
 #ifdef DEBUG
 #define debug(x) x
@@ -78,6 +86,9 @@
    The number I've selected below is completely arbitrary.  Changing it will
    affect memory and performance.  I dunno, three seemed like a good odd
    number.  *grin*
+
+   This only goes for the tables states have while keywords are being
+   added.  make() picks the ones they keep by g->policy.
  */
 #define TRANSITION_SWITCHING_THRESHOLD 3
 
@@ -88,28 +99,120 @@
    representation instead. */
 /**********************************************************************/
 
-void aho_corasick_goto_set(aho_corasick_state_t *from_state,
-			   unsigned char symbol,
-			   aho_corasick_state_t *to_state) {
-	aho_corasick_labeled_edge_t *edge;
+/* Returns an empty sparse transition table with room for at least size
+   edges, off the spare list for its capacity if there's one there, or
+   NULL on memory allocation failure. */
+static aho_corasick_sparse_edges_t *
+aho_corasick_sparse_new(aho_corasick_t *g, aho_corasick_int_t size) {
+	aho_corasick_sparse_edges_t *edges;
+	aho_corasick_int_t capacity = 1;
+	int size_index = 0;
+
+	while ( capacity < size ) {
+		capacity *= 2;
+		size_index++;
+	}
+
+	if ( (edges = g->spare_edges[size_index]) != NULL ) {
+		g->spare_edges[size_index] =
+			*(aho_corasick_sparse_edges_t **) edges;
+	}
+	else if ( (edges = arena_alloc(&g->arena,
+				       aho_corasick_sparse_sizeof(capacity)))
+		  == NULL ) {
+		return NULL;
+	}
+	edges->size = 0;
+	edges->capacity = capacity;
+	return edges;
+}
+
+
+/* Puts a sparse table that's no longer wanted on the spare list for its
+   capacity. */
+static void
+aho_corasick_sparse_free(aho_corasick_t *g,
+			 aho_corasick_sparse_edges_t *edges) {
+	int size_index = 0;
+
+	while ( (1U << size_index) < edges->capacity )
+		size_index++;
+	/* The table is at least as big as a pointer, so it can hold the
+	   link to the next spare one. */
+	*(aho_corasick_sparse_edges_t **) edges = g->spare_edges[size_index];
+	g->spare_edges[size_index] = edges;
+}
+
+
+/* Makes room for at least one more edge in a sparse transition table, by
+   moving it into a table of twice the capacity.  The old table goes on the
+   spare list for its capacity.  Returns the new table, or NULL on memory
+   allocation failure. */
+static aho_corasick_sparse_edges_t *
+aho_corasick_sparse_grow(aho_corasick_t *g,
+			 aho_corasick_sparse_edges_t *edges) {
+	aho_corasick_sparse_edges_t *grown;
+
+	if ( (grown = aho_corasick_sparse_new(g, edges != NULL ?
+					      edges->capacity * 2 : 1))
+	     == NULL )
+		return NULL;
+
+	if (edges != NULL) {
+		grown->size = edges->size;
+		memcpy(aho_corasick_sparse_states(grown),
+		       aho_corasick_sparse_states(edges),
+		       edges->size * sizeof(aho_corasick_state_t *));
+		memcpy(aho_corasick_sparse_labels(grown),
+		       aho_corasick_sparse_labels(edges),
+		       edges->size);
+		aho_corasick_sparse_free(g, edges);
+	}
+	return grown;
+}
+
+
+int aho_corasick_goto_set(aho_corasick_t *g,
+			  aho_corasick_state_t *from_state,
+			  unsigned char symbol,
+			  aho_corasick_state_t *to_state) {
+	aho_corasick_sparse_edges_t *edges;
+	unsigned char *labels;
+	aho_corasick_state_t **states;
+	aho_corasick_int_t i, j;
 	switch (from_state->_transitions.type) {
 	case AHO_CORASICK_DENSE_TRANSITIONS:
 		from_state->_transitions.data.array[symbol] = to_state;
-		return;
+		return 0;
 	case AHO_CORASICK_SPARSE_TRANSITIONS:
-		edge = xalloc(sizeof(aho_corasick_labeled_edge_t));
-		if (edge == NULL) {
-			/* fixme: check memory allocation! */
+		edges = from_state->_transitions.data.edges;
+		if (edges == NULL || edges->size == edges->capacity) {
+			if ( (edges = aho_corasick_sparse_grow(g, edges))
+			     == NULL )
+				return -1;
+			from_state->_transitions.data.edges = edges;
 		}
-		edge->label = symbol;
-		edge->state = to_state;
-		
-		if (slist_prepend(from_state->_transitions.data.slist, edge) < 0) {
-			/* fixme: check memory allocation! */
+		labels = aho_corasick_sparse_labels(edges);
+		states = aho_corasick_sparse_states(edges);
+
+		/* Keep the labels sorted, so that lookups can stop early. */
+		for (i = 0; i < edges->size && labels[i] < symbol; i++)
+			;
+		if (i < edges->size && labels[i] == symbol) {
+			states[i] = to_state;
+			return 0;
 		}
-		return;
+		for (j = edges->size; j > i; j--) {
+			labels[j] = labels[j-1];
+			states[j] = states[j-1];
+		}
+		labels[i] = symbol;
+		states[i] = to_state;
+		edges->size++;
+		return 0;
 	}
 
+	return -1;
 }
 
 
@@ -117,19 +220,20 @@ void aho_corasick_goto_set(aho_corasick_state_t *from_state,
    symbol.  If no such transition exists, returns FAIL. */
 aho_corasick_state_t* aho_corasick_goto_get(aho_corasick_state_t *state,
 					    unsigned char symbol) {
-	slist_node_t *node;
+	aho_corasick_sparse_edges_t *edges;
+	unsigned char *labels;
+	aho_corasick_int_t i;
 	switch (state->_transitions.type) {
 	case AHO_CORASICK_DENSE_TRANSITIONS:
 		return state->_transitions.data.array[symbol];
 	case AHO_CORASICK_SPARSE_TRANSITIONS:
-		node = slist_head(state->_transitions.data.slist);
-		while (node != NULL) {
-			if (((aho_corasick_labeled_edge_t *) node->data)
-			    ->label == symbol) {
-				return ((aho_corasick_labeled_edge_t *)
-					node->data)->state;
-			}
-			node = node->next;
+		edges = state->_transitions.data.edges;
+		if (edges == NULL)
+			return FAIL;
+		labels = aho_corasick_sparse_labels(edges);
+		for (i = 0; i < edges->size && labels[i] <= symbol; i++) {
+			if (labels[i] == symbol)
+				return aho_corasick_sparse_states(edges)[i];
 		}
 		return FAIL;
 	}
@@ -139,11 +243,45 @@ aho_corasick_state_t* aho_corasick_goto_get(aho_corasick_state_t *state,
 }
 
 
+/* Walks the transition arrows out of a state, in symbol order: returns the
+   next one after position *i, setting *symbol to its label and moving *i on
+   past it, or FAIL once there are none left.  *i starts out at 0.  A
+   sparse table is walked directly, rather than probing every symbol. */
+static aho_corasick_state_t *
+aho_corasick_goto_next(aho_corasick_t *g,
+		       aho_corasick_state_t *state,
+		       aho_corasick_int_t *i,
+		       unsigned char *symbol) {
+	aho_corasick_sparse_edges_t *edges;
+	aho_corasick_state_t *s;
+	switch (state->_transitions.type) {
+	case AHO_CORASICK_DENSE_TRANSITIONS:
+		for (; *i < (aho_corasick_int_t) g->nclasses; (*i)++) {
+			if ( (s = state->_transitions.data.array[*i]) != FAIL ) {
+				*symbol = *i;
+				(*i)++;
+				return s;
+			}
+		}
+		return FAIL;
+	case AHO_CORASICK_SPARSE_TRANSITIONS:
+		edges = state->_transitions.data.edges;
+		if (edges == NULL || *i >= edges->size)
+			return FAIL;
+		*symbol = aho_corasick_sparse_labels(edges)[*i];
+		return aho_corasick_sparse_states(edges)[(*i)++];
+	}
+	return FAIL;
+}
+
+
 /* Initializes all of the transition arrows to FAIL.  representation_type must
    be either DENSE_TRANSITIONS or SPARSE_TRANSITIONS.  If everything is ok,
    returns 0.  If bad things happen, returns -1. */
-static int aho_corasick_goto_initialize(aho_corasick_state_t *state) {
+static int aho_corasick_goto_initialize(aho_corasick_t *g,
+				       aho_corasick_state_t *state) {
 	aho_corasick_transition_t rep_type = AHO_CORASICK_DENSE_TRANSITIONS;
+	int i;
 	if (state->depth >= TRANSITION_SWITCHING_THRESHOLD) {
 		rep_type = AHO_CORASICK_SPARSE_TRANSITIONS;
 	}
@@ -151,21 +289,17 @@ static int aho_corasick_goto_initialize(aho_corasick_state_t *state) {
 	case AHO_CORASICK_DENSE_TRANSITIONS:
 		state->_transitions.type = AHO_CORASICK_DENSE_TRANSITIONS;
 		state->_transitions.data.array =
-			xalloc(AHO_CORASICK_CHARACTERS *
-			       sizeof(aho_corasick_state_t *));
+			arena_alloc(&g->dense_arena,
+				    AHO_CORASICK_CHARACTERS *
+				    sizeof(aho_corasick_state_t *));
 		if (state->_transitions.data.array == NULL)
 			return -1;
-		memset(state->_transitions.data.array,
-		       (int) FAIL,
-		       AHO_CORASICK_CHARACTERS*sizeof(aho_corasick_state_t *));
+		for (i = 0; i < AHO_CORASICK_CHARACTERS; i++)
+			state->_transitions.data.array[i] = FAIL;
 		return 0;
 	case AHO_CORASICK_SPARSE_TRANSITIONS:
 		state->_transitions.type = AHO_CORASICK_SPARSE_TRANSITIONS;
-		state->_transitions.data.slist =
-			xalloc(sizeof(slist_t));
-		if (state->_transitions.data.slist == NULL)
-			return -1;
-		slist_init(state->_transitions.data.slist);
+		state->_transitions.data.edges = NULL;
 		return 0;
 	}
 
@@ -173,19 +307,105 @@ static int aho_corasick_goto_initialize(aho_corasick_state_t *state) {
 }
 
 
-/* Deallocates the transition table.  Do nothing for now. */
-static void aho_corasick_goto_destroy(aho_corasick_state_t *state) {
+/* Returns the number of transition arrows out of a state whose table is
+   still labeled by raw bytes. */
+static aho_corasick_int_t
+aho_corasick_goto_fanout(aho_corasick_state_t *state) {
+	aho_corasick_int_t i, n = 0;
 	switch (state->_transitions.type) {
 	case AHO_CORASICK_DENSE_TRANSITIONS:
-		xfree(state->_transitions.data.array);
-		return;
+		for(i = 0; i < AHO_CORASICK_CHARACTERS; i++)
+			n += state->_transitions.data.array[i] != FAIL;
+		return n;
 	case AHO_CORASICK_SPARSE_TRANSITIONS:
-		slist_destroy(state->_transitions.data.slist, SLIST_FREE_DATA);
-		xfree(state->_transitions.data.slist);
+		if (state->_transitions.data.edges == NULL)
+			return 0;
+		return state->_transitions.data.edges->size;
 	}
+	return 0;
 }
 
 
+/* Rewrites the transition table of a state, whose arrows are still labeled
+   by raw bytes, in terms of the byte classes that aho_corasick_maketree()
+   has just computed, as a dense table of g->nclasses entries if dense is
+   set, and as a sparse one otherwise.  Dense tables move out of the
+   dense_arena.  Returns 0 on success, -1 on memory allocation failure. */
+static int aho_corasick_goto_compress(aho_corasick_t *g,
+				      aho_corasick_state_t *state,
+				      int dense) {
+	aho_corasick_state_t **array, **states;
+	aho_corasick_sparse_edges_t *edges;
+	unsigned char *labels;
+	aho_corasick_int_t i;
+	switch (state->_transitions.type) {
+	case AHO_CORASICK_DENSE_TRANSITIONS:
+		array = state->_transitions.data.array;
+		if (!dense) {
+			/* Used bytes have classes of their own, numbered in
+			   byte order, so the labels come out sorted. */
+			i = aho_corasick_goto_fanout(state);
+			state->_transitions.type =
+				AHO_CORASICK_SPARSE_TRANSITIONS;
+			state->_transitions.data.edges = NULL;
+			if (i == 0)
+				return 0;
+			if ( (edges = aho_corasick_sparse_new(g, i)) == NULL )
+				return -1;
+			labels = aho_corasick_sparse_labels(edges);
+			states = aho_corasick_sparse_states(edges);
+			for(i = 0; i < AHO_CORASICK_CHARACTERS; i++) {
+				if (array[i] == FAIL)
+					continue;
+				labels[edges->size] = g->classes[i];
+				states[edges->size++] = array[i];
+			}
+			state->_transitions.data.edges = edges;
+			return 0;
+		}
+		state->_transitions.data.array =
+			arena_alloc(&g->arena,
+				    g->nclasses * sizeof(aho_corasick_state_t *));
+		if (state->_transitions.data.array == NULL)
+			return -1;
+		/* Bytes that share a class share a transition, so it doesn't
+		   matter which one of them gets copied last. */
+		for(i = 0; i < AHO_CORASICK_CHARACTERS; i++)
+			state->_transitions.data.array[g->classes[i]] =
+				array[i];
+		return 0;
+	case AHO_CORASICK_SPARSE_TRANSITIONS:
+		edges = state->_transitions.data.edges;
+		if (dense) {
+			array = arena_alloc(&g->arena, g->nclasses *
+					    sizeof(aho_corasick_state_t *));
+			if (array == NULL)
+				return -1;
+			for(i = 0; i < (aho_corasick_int_t) g->nclasses; i++)
+				array[i] = FAIL;
+			state->_transitions.type =
+				AHO_CORASICK_DENSE_TRANSITIONS;
+			state->_transitions.data.array = array;
+			if (edges == NULL)
+				return 0;
+			labels = aho_corasick_sparse_labels(edges);
+			states = aho_corasick_sparse_states(edges);
+			for(i = 0; i < edges->size; i++)
+				array[g->classes[labels[i]]] = states[i];
+			aho_corasick_sparse_free(g, edges);
+			return 0;
+		}
+		/* Classes are numbered in byte order, so the labels stay
+		   sorted. */
+		if (edges == NULL)
+			return 0;
+		labels = aho_corasick_sparse_labels(edges);
+		for(i = 0; i < edges->size; i++)
+			labels[i] = g->classes[labels[i]];
+		return 0;
+	}
+	return -1;
+}
 
 
 /* Anything below this should access state transitions only through the API
@@ -198,275 +418,2139 @@ static void aho_corasick_goto_destroy(aho_corasick_state_t *state) {
 
 
 
-/* Does an aho-corasick search, given a 'string' of length 'n'.  If
-   we're able to find a match, returns a positive integer and the
-   start-end indices of the match.
- */
-aho_corasick_int_t
-ahocorasick_KeywordTree_search_helper(aho_corasick_t *g,
-				      unsigned char *string,
-				      size_t n,
-				      size_t startpos,
-				      size_t *out_start, size_t *out_end)
+/* Follows the transition out of the state with the given id on the symbol,
+   chasing failure transitions as needed, and returns the id of the state we
+   end up in.  In DFA mode that chase has been done ahead of time by
+   aho_corasick_maketree(), so this is a single table lookup. */
+static aho_corasick_int_t
+aho_corasick_step(aho_corasick_t *g,
+		  aho_corasick_int_t id,
+		  unsigned char symbol)
 {
-	size_t j;
-	aho_corasick_state_t *state;
-	for(j = startpos,state = g->zerostate ; j < n ; j++)
+	aho_corasick_state_t *state, *next;
+	unsigned char class = g->classes[symbol];
+
+	if (g->delta != NULL)
+		return g->delta[id * g->nclasses + class];
+
+	state = g->states[id];
+	while( (next = aho_corasick_goto_get(state,class)) == FAIL )
 	{
-		while( aho_corasick_goto_get(state,*(string+j)) == FAIL ) 
-		{
-			state = aho_corasick_fail(state);
-		}
-		state = aho_corasick_goto_get(state,*(string+j));
-		if ( aho_corasick_output(state) != 0 ) 
-		{
-			*out_start = j - aho_corasick_output(state) + 1;
-			*out_end = j+1;
-			return state->id;
-		}
+		state = aho_corasick_fail(state);
 	}
-	*out_start = -1;
-	*out_end = -1;
-	return 0;
+	return next->id;
 }
 
 
-
-/* Similar to the first helper function, but tries to return the longest
-   match. */
-aho_corasick_int_t
-ahocorasick_KeywordTree_search_long_helper(aho_corasick_t *g,
-					   unsigned char *string,
-					   size_t n,
-					   size_t startpos,
-					   size_t *out_start, size_t *out_end)
+/* Same as aho_corasick_step(), but counts the transition, and each failure
+   transition it follows on the way. */
+static aho_corasick_int_t
+aho_corasick_step_counting(aho_corasick_t *g,
+			   aho_corasick_int_t id,
+			   unsigned char symbol,
+			   aho_corasick_counters_t *counters)
 {
-	size_t j;
-	aho_corasick_state_t *state;
+	aho_corasick_state_t *state, *next;
+	unsigned char class = g->classes[symbol];
 
-	*out_start = -1;
-	*out_end = -1;
-	for(j = startpos,state = g->zerostate ; j < n ; j++)
+	counters->transitions++;
+	if (g->delta != NULL)
+		return g->delta[id * g->nclasses + class];
+
+	state = g->states[id];
+	while( (next = aho_corasick_goto_get(state,class)) == FAIL )
 	{
+		state = aho_corasick_fail(state);
+		counters->fails++;
+	}
+	return next->id;
+}
 
-		if (aho_corasick_goto_get(state, *(string+j)) == FAIL &&
-		    *out_end != -1) 
-		{
-			return state->id;
-		}
-		while( aho_corasick_goto_get(state,*(string+j)) == FAIL )
-		{
-			state = aho_corasick_fail(state);
-		}
-		state = aho_corasick_goto_get(state,*(string+j));
-		if ( aho_corasick_output(state) != 0) 
+/* Steps, counting if there are counters. */
+#define aho_corasick_next(g, id, symbol, counters) \
+	((counters) != NULL ? \
+	 aho_corasick_step_counting(g, id, symbol, counters) : \
+	 aho_corasick_step(g, id, symbol))
+
+/* Counts a scan from start up to end, which found matched matches. */
+#define aho_corasick_count(counters, start, end, matched) \
+	do { \
+		if ((counters) != NULL) { \
+			(counters)->bytes += (end) - (start); \
+			(counters)->matches += (matched); \
+		} \
+	} while (0)
+
+
+/* True if there's nothing to the options that changes what a search finds,
+   so that it can take the quick way through, counting at most.  Word
+   boundaries don't count here: they're dealt with after the search, see
+   aho_corasick_unbounded(). */
+#define aho_corasick_plain(options) \
+	((options) == NULL || \
+	 ((options)->removed == NULL && \
+	  (options)->ndeltas == 0 && (options)->groups == NULL))
+
+
+/* Above this many bytes that can start a match, skipping ahead isn't worth
+   it: the scan stops again too soon to make up for starting it.  A step
+   costs less in DFA mode, so there it has to pay off sooner. */
+#define AHO_CORASICK_SKIP_MAX 16
+#define AHO_CORASICK_SKIP_MAX_DFA 8
+
+/* Works out which bytes can start a match, once the classes are final. */
+static void
+aho_corasick_makeskip(aho_corasick_t *g)
+{
+	int i;
+
+	g->nstarts = 0;
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+	{
+		g->starts[i] = aho_corasick_step(g,0,i) != 0;
+		if ( g->starts[i] )
 		{
-			*out_start = j - aho_corasick_output(state) + 1;
-			*out_end = j+1;
+			g->start = i;
+			g->nstarts++;
 		}
 	}
+	g->skip = g->nstarts <= (g->delta != NULL ? AHO_CORASICK_SKIP_MAX_DFA :
+				 AHO_CORASICK_SKIP_MAX);
+}
 
-	/* If we reach the end of the string, we still have to double check if
-	   we had a longest match queued up. */
-	if (*out_end != -1) {
-		return state->id;
+
+/* Returns the position of the first byte of the string from j on that can
+   start a match, or n if there's none.  A single such byte is looked for
+   with memchr(), which is about as fast as scanning gets.  The bytes
+   skipped are counted, if there are counters. */
+static size_t
+aho_corasick_skip(aho_corasick_t *g,
+		  unsigned char *string,
+		  size_t j,
+		  size_t n,
+		  aho_corasick_counters_t *counters)
+{
+	unsigned char *p;
+	size_t i = j;
+
+	if (g->nstarts == 1)
+	{
+		p = memchr(string + j, g->start, n - j);
+		i = p != NULL ? (size_t) (p - string) : n;
 	}
-	return 0;
+	else
+	{
+		while( i < n && !g->starts[string[i]] )
+			i++;
+	}
+	if (counters != NULL)
+		counters->skipped += i - j;
+	return i;
 }
 
 
+int
+aho_corasick_find(aho_corasick_t *g, unsigned char *string, size_t n)
+{
+	size_t j;
+	aho_corasick_int_t state = 0, next;
 
+	/* Only goto transitions take us one level deeper each time. */
+	for(j = 0 ; j < n ; j++)
+	{
+		next = aho_corasick_step(g,state,*(string+j));
+		if (g->depths[next] != g->depths[state] + 1)
+			return -1;
+		state = next;
+	}
+	if (g->outputs[state] == 0)
+		return -1;
+	return g->keywords[state];
+}
 
 
-/* Initializes the zerostate.  If initialization is successful,
-   returns 0.  If bad things happen, returns -1. */
+/* Sets *next to where the next goto transition out of the state of a made
+   tree leads, and returns 1, or returns 0 once there are none left.  *i
+   starts out at 0.  A loaded tree only has its DFA table, but the
+   transitions in it that go one level deeper are the goto ones. */
 static int
-initialize_zero_state(aho_corasick_t *in) {
-	if ( in->zerostate == NULL )
+aho_corasick_child(aho_corasick_t *g, aho_corasick_int_t id,
+		   aho_corasick_int_t *i, aho_corasick_int_t *next)
+{
+	aho_corasick_state_t *s;
+	unsigned char symbol;
+
+	for(;;)
 	{
-		if ( (in->zerostate = xalloc(sizeof(aho_corasick_state_t))) == NULL )
+		if (g->states != NULL)
 		{
-			xfree(in);
-			return -1;
+			s = aho_corasick_goto_next(g, g->states[id], i,
+						   &symbol);
+			if (s == FAIL)
+				return 0;
+			*next = s->id;
 		}
-		in->newstate = 1;
-		in->zerostate->id = 0;
-		in->zerostate->depth = 0;
-		aho_corasick_output(in->zerostate) = 0;
-		aho_corasick_fail(in->zerostate) = NULL;
-		/* FIXME: check the error return value of
-		   aho_corasick_goto_initialize. */
-		aho_corasick_goto_initialize(in->zerostate);
+		else
+		{
+			if (*i == (aho_corasick_int_t) g->nclasses)
+				return 0;
+			*next = g->delta[id * g->nclasses + (*i)++];
+		}
+		/* That leaves out the zerostate's transitions to itself. */
+		if (g->depths[*next] == g->depths[id] + 1)
+			return 1;
 	}
+}
+
+
+/* True if a goto transition takes the state of a made tree to a state
+   that isn't dead. */
+static int
+aho_corasick_live_child(aho_corasick_t *g, aho_corasick_int_t id,
+			const unsigned char *dead)
+{
+	aho_corasick_int_t i = 0, next;
+
+	while (aho_corasick_child(g, id, &i, &next))
+		if (!dead[next])
+			return 1;
 	return 0;
 }
 
 
+/* Where the groups that aho_corasick_setgroups() fills in have the groups
+   that go through each state, and the groups joined since. */
+#define aho_corasick_belows(g, groups) ((groups) + (g)->newstate)
+#define aho_corasick_stale(g, groups) ((groups)[2 * (size_t) (g)->newstate])
+
+
+/* The groups of the keywords that go through the state of a made tree and
+   haven't been removed, worked out from those of the states under it, in
+   below. */
+static aho_corasick_groups_t
+aho_corasick_below(aho_corasick_t *g, aho_corasick_int_t id,
+		   const aho_corasick_groups_t *masks,
+		   const unsigned char *removed,
+		   const aho_corasick_groups_t *below)
+{
+	aho_corasick_groups_t groups = 0;
+	aho_corasick_int_t i = 0, next;
+
+	if (g->outputs[id] != 0 &&
+	    (removed == NULL || !removed[g->keywords[id]]))
+		groups = masks[g->keywords[id]];
+	while (aho_corasick_child(g, id, &i, &next))
+		groups |= below[next];
+	return groups;
+}
+
+
 int
-aho_corasick_init(aho_corasick_t *g)
+aho_corasick_kill(aho_corasick_t *g, unsigned char *string, size_t n,
+		  unsigned char *dead, const unsigned char *removed,
+		  const aho_corasick_groups_t *masks,
+		  aho_corasick_groups_t *groups)
 {
-	if (!g)
-	{
+	aho_corasick_groups_t *below = groups != NULL && masks != NULL ?
+		aho_corasick_belows(g, groups) : NULL;
+	aho_corasick_int_t *path, state;
+	size_t j;
+	int live = 0;
+
+	if ( (path = xalloc((n + 1) * sizeof(aho_corasick_int_t))) == NULL )
 		return -1;
-	}
-	else
+	path[0] = 0;
+	for(j = 0; j < n ;j++)
+		path[j+1] = aho_corasick_step(g, path[j], string[j]);
+
+	/* Going back up, a state dies if it has no keyword that's left and
+	   all of the states below it are dead.  Once one doesn't, the ones
+	   above it don't either.  The zerostate never does.  The groups
+	   that go through each state have to be worked out all the way up,
+	   though. */
+	for(j = n; j > 0 ;j--)
 	{
-		g->zerostate = NULL;
-		g->newstate = 0;
-		return initialize_zero_state(g);
+		state = path[j];
+		if (!live)
+			live = (g->outputs[state] != 0 &&
+				!removed[g->keywords[state]]) ||
+				aho_corasick_live_child(g, state, dead);
+		if (!live)
+			dead[state] = 1;
+		if (below != NULL)
+			below[state] = aho_corasick_below(g, state, masks,
+							  removed, below);
 	}
-
+	if (below != NULL)
+		below[0] = aho_corasick_below(g, 0, masks, removed, below);
+	xfree(path);
+	return 0;
 }
 
 
-/* Really do the memory deallocation of a state. */
-static void aho_corasick_state_dealloc(aho_corasick_state_t *state) {
-	/* Warning: order dependent code ahead: */
-	aho_corasick_goto_destroy(state);
-	xfree(state);
+void
+aho_corasick_revive(aho_corasick_t *g, unsigned char *string, size_t n,
+		    unsigned char *dead, aho_corasick_groups_t mask,
+		    aho_corasick_groups_t *groups)
+{
+	aho_corasick_groups_t *below = groups != NULL ?
+		aho_corasick_belows(g, groups) : NULL;
+	aho_corasick_int_t state = 0;
+	size_t j;
+
+	if (below != NULL)
+		below[0] |= mask;
+	for(j = 0; j < n ;j++)
+	{
+		state = aho_corasick_step(g, state, string[j]);
+		if (dead != NULL)
+			dead[state] = 0;
+		if (below != NULL)
+			below[state] |= mask;
+	}
 }
 
 
 
-/* Helper function for aho_corasick_destroy.  Recursively frees up each state,
-   doing this essentially depth-first. */
-static void
-aho_corasick_free(aho_corasick_state_t *state)
+void
+aho_corasick_word_boundaries(unsigned char *boundaries)
 {
 	int i;
 
 	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
-		if ( aho_corasick_goto_get(state,i) != FAIL ) 
-			aho_corasick_free(aho_corasick_goto_get(state,i));
-	
-	/* Actually do the memory deallocation here. */
-	aho_corasick_state_dealloc(state);
+		boundaries[i] = !((i >= 'a' && i <= 'z') ||
+				  (i >= 'A' && i <= 'Z') ||
+				  (i >= '0' && i <= '9') ||
+				  i == '_' || i >= 0x80);
 }
 
 
+/* True if position i of the string falls inside a word. */
+#define aho_corasick_inside_word(boundaries, string, i) \
+	(!(boundaries)[(string)[(i) - 1]] && !(boundaries)[(string)[(i)]])
 
-
-void
-aho_corasick_destroy(aho_corasick_t *in)
+/* True if a tree made of just the keywords that the options leave wouldn't
+   have the state of tree g: because no keyword that's left goes through
+   it, as dead says, or none of the wanted groups do, as the groups that
+   aho_corasick_setgroups() filled in for g say. */
+static int
+aho_corasick_gone(const aho_corasick_options_t *options,
+		  aho_corasick_t *g, aho_corasick_int_t state,
+		  const unsigned char *dead,
+		  const aho_corasick_groups_t *groups)
 {
-	int i;
-
-	if (in->zerostate != NULL) 
-	{
-		for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
-			if ( aho_corasick_goto_get(in->zerostate,i) != FAIL && 
-			     aho_corasick_goto_get(in->zerostate,i)->id > 0 )
-				aho_corasick_free(aho_corasick_goto_get
-						  (in->zerostate,i));
-		
-		/* dyoo: added to free the last node. */
-		aho_corasick_state_dealloc(in->zerostate);
-		
-		in->zerostate = NULL;
-	}
+	return (dead != NULL && dead[state]) ||
+		(options->groups != NULL && groups != NULL &&
+		 (aho_corasick_belows(g, groups)[state] &
+		  options->wanted) == 0);
 }
 
-int
-aho_corasick_maketree(aho_corasick_t *in)
+/* Steps the tree, and each of the deltas of the options, on from the
+   states they're in, with the next byte of the input.  states[0] is the
+   tree's state, and states[k + 1] that of delta k. */
+static void
+aho_corasick_next_all(aho_corasick_t *g,
+		      const aho_corasick_options_t *options,
+		      aho_corasick_int_t *states,
+		      unsigned char c,
+		      aho_corasick_counters_t *counters)
 {
-	slist_t queue;
-	aho_corasick_state_t *state,*s,*r;
-	aho_corasick_t *g = in;
-	int i;
+	int k;
+
+	states[0] = aho_corasick_next(g, states[0], c, counters);
+	if (options != NULL)
+		for(k = 0; k < options->ndeltas ;k++)
+			states[k+1] = aho_corasick_next(options->deltas[k],
+							states[k+1], c,
+							counters);
+}
 
-	slist_init(&queue);
 
-	// Set all FAIL transition of 0 state to point to itself
-	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+/* Sets *t and *m to the tree and the state that a search would be in, if
+   it were searching a tree made of just the keywords the options leave,
+   given the states that the tree and the deltas are in.  Each is taken
+   down its failure chain past the states that are gone: the first state
+   that's left is the longest suffix of what the search has seen that such
+   a tree has.  Then the deepest of those is the one, for the same reason.
+   Those that are as deep as each other stand for the same string, and
+   it's the one that has a keyword. */
+static void
+aho_corasick_current(const aho_corasick_options_t *options,
+		     aho_corasick_t *g, const aho_corasick_int_t *states,
+		     aho_corasick_t **t, aho_corasick_int_t *m)
+{
+	aho_corasick_t *delta;
+	aho_corasick_int_t state = states[0];
+	int k, gone = options != NULL && (options->dead != NULL ||
+					  options->groups != NULL);
+
+	if (gone)
+		while (state != 0 &&
+		       aho_corasick_gone(options, g, state, options->dead,
+					 options->tree_groups))
+			state = g->fails[state];
+	*t = g;
+	*m = state;
+	for(k = 0; options != NULL && k < options->ndeltas ;k++)
 	{
-		if ( aho_corasick_goto_get(g->zerostate,i) == FAIL )
-			aho_corasick_goto_set(g->zerostate, i, g->zerostate);
-		// Construct fail()
-		else
+		delta = options->deltas[k];
+		state = states[k+1];
+		if (gone)
+			while (state != 0 &&
+			       aho_corasick_gone(options, delta, state, NULL,
+						 options->delta_groups[k]))
+				state = delta->fails[state];
+		if (delta->depths[state] > (*t)->depths[*m] ||
+		    (delta->depths[state] == (*t)->depths[*m] &&
+		     delta->outputs[state] != 0))
 		{
-			if ( slist_append(&queue,aho_corasick_goto_get(g->zerostate,i)) < 0 )
-				goto fail;
-			aho_corasick_fail(aho_corasick_goto_get(g->zerostate,i)) = g->zerostate;
+			*t = delta;
+			*m = state;
 		}
 	}
+}
+
+
+/* Fills in the match for the keyword of the state in tree g, ending at
+   end. */
+static void
+aho_corasick_match_set(aho_corasick_match_t *match,
+		       aho_corasick_t *g,
+		       aho_corasick_int_t state,
+		       size_t end)
+{
+	match->start = end - g->outputs[state];
+	match->end = end;
+	match->keyword = g->keywords[state];
+	match->chars = g->chars != NULL ? g->chars[state] : 0;
+}
+
+
+
+/* Walks the keywords that end at the same place, longest first: those on
+   the dictionary suffix chain of the tree's state, merged with those on
+   the chains of the deltas' states, if there are deltas.  trees[0] is the
+   tree, and trees[k + 1] delta k. */
+typedef struct {
+	aho_corasick_t *trees[1 + AHO_CORASICK_DELTAS];
+	aho_corasick_int_t next[1 + AHO_CORASICK_DELTAS];	/* or 0 */
+	int n;
+} aho_corasick_chain_t;
+
 
-	// Set fail() for depth > 0
-	while( (r = slist_pop_first(&queue)) != NULL )
+/* True if none of the keywords on the chain of the state are in the groups
+   the options want, as the groups that aho_corasick_setgroups() filled in
+   for g say. */
+#define aho_corasick_unwanted(g, groups, state, options) \
+	((groups) != NULL && \
+	 (((groups)[state] | aho_corasick_stale(g, groups)) & \
+	  (options)->wanted) == 0)
+
+
+static void
+aho_corasick_chain_start(aho_corasick_chain_t *chain,
+			 const aho_corasick_options_t *options,
+			 aho_corasick_t *g, const aho_corasick_int_t *states)
+{
+	aho_corasick_t *t;
+	const aho_corasick_groups_t *groups;
+	aho_corasick_int_t state;
+	int k;
+
+	chain->n = 1 + (options != NULL ? options->ndeltas : 0);
+	for(k = 0; k < chain->n ;k++)
 	{
-		for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+		t = chain->trees[k] = k == 0 ? g : options->deltas[k-1];
+		state = states[k];
+		chain->next[k] = t->outputs[state] != 0 ?
+			state : t->dicts[state];
+
+		/* A chain that only has keywords of other groups on it is
+		   over before it starts. */
+		if (options != NULL && options->groups != NULL)
 		{
-			if ( (s = aho_corasick_goto_get(r,i)) == FAIL )
-				continue;
-			if ( slist_append(&queue,s) < 0 )
-				goto fail;
-			state = aho_corasick_fail(r);
-			while( aho_corasick_goto_get(state,i) == FAIL )
-				state = aho_corasick_fail(state);
-			aho_corasick_fail(s) = aho_corasick_goto_get(state,i);
-			debug(printf("Setting f(%u) == %u\n",s->id,
-				     aho_corasick_goto_get(state,i)->id));
-			// Join outputs missing
+			groups = k == 0 ? options->tree_groups :
+				options->delta_groups[k-1];
+			if (aho_corasick_unwanted(t, groups, state, options))
+				chain->next[k] = 0;
 		}
 	}
+}
 
-	slist_destroy(&queue,SLIST_LEAVE_DATA);
-	return 0;
 
-fail:
-	slist_destroy(&queue,SLIST_LEAVE_DATA);
-	return -1;
+/* Sets *tree and *state to the next keyword on the chain.  Returns 0 once
+   there are none left. */
+static int
+aho_corasick_chain_next(aho_corasick_chain_t *chain,
+			aho_corasick_t **tree, aho_corasick_int_t *state)
+{
+	int k, best = -1;
+
+	for(k = 0; k < chain->n ;k++)
+		if (chain->next[k] != 0 &&
+		    (best < 0 ||
+		     chain->trees[k]->outputs[chain->next[k]] >
+		     chain->trees[best]->outputs[chain->next[best]]))
+			best = k;
+	if (best < 0)
+		return 0;
+	*tree = chain->trees[best];
+	*state = chain->next[best];
+	chain->next[best] = chain->trees[best]->dicts[*state];
+	return 1;
 }
 
 
+/* True if the options leave the keyword of the state in tree g in: it
+   hasn't been removed, and it's in one of the wanted groups. */
+static int
+aho_corasick_allowed(const aho_corasick_options_t *options,
+		     aho_corasick_t *g,
+		     aho_corasick_int_t state)
+{
+	if (options->removed != NULL && options->removed[g->keywords[state]])
+		return 0;
+	if (options->groups != NULL &&
+	    (options->groups[g->keywords[state]] & options->wanted) == 0)
+		return 0;
+	return 1;
+}
 
 
-int
-aho_corasick_addstring(aho_corasick_t *in, unsigned char *string, Py_ssize_t n)
+/* Word boundaries don't change where the search goes: the searches run
+   without them, and then turn down the matches that don't fit, picking up
+   after each one where they would have if it had fit.  That way they only
+   ever take matches away.  This sets *unbounded to the options without
+   their boundaries, and returns it, or the options if they have none.  As
+   with the options the wrapper hands us, it's NULL if that leaves nothing
+   to them. */
+static const aho_corasick_options_t *
+aho_corasick_unbounded(const aho_corasick_options_t *options,
+		       aho_corasick_options_t *unbounded)
 {
-	aho_corasick_t* g = in;
-	aho_corasick_state_t *state,*s = NULL;
-	int j = 0;
+	if (options == NULL || options->boundaries == NULL)
+		return options;
+	if (options->counters == NULL && aho_corasick_plain(options))
+		return NULL;
+	*unbounded = *options;
+	unbounded->boundaries = NULL;
+	return unbounded;
+}
 
-	state = g->zerostate;
 
-	// As long as we have transitions follow them
-	while( j != n &&
-	       (s = aho_corasick_goto_get(state,*(string+j))) != FAIL )
+/* True if the match, in a string of length n, fits the word boundaries of
+   the options, if they have any.  One that doesn't isn't counted as a
+   match after all. */
+static int
+aho_corasick_fits(const aho_corasick_options_t *options,
+		  unsigned char *string,
+		  size_t n,
+		  const aho_corasick_match_t *match)
+{
+	if (options == NULL || options->boundaries == NULL)
+		return 1;
+	if ((match->start > 0 &&
+	     aho_corasick_inside_word(options->boundaries, string,
+				      match->start)) ||
+	    (match->end < n &&
+	     aho_corasick_inside_word(options->boundaries, string,
+				      match->end)))
 	{
-		state = s;
-		++j;
-	}
-
-	if ( j == n ) {
-		/* dyoo: added so that if a keyword ends up in a prefix
-		   of another, we still mark that as a match.*/
-		aho_corasick_output(s) = j;
+		if (options->counters != NULL)
+			options->counters->matches--;
 		return 0;
 	}
+	return 1;
+}
 
-	while( j != n )
-	{
-		// Create new state
-		if ( (s = xalloc(sizeof(aho_corasick_state_t))) == NULL )
-			return -1;
-		s->id = g->newstate++;
- 		debug(printf("allocating state %d\n", s->id)); /* debug */ 
-		s->depth = state->depth + 1;
 
-		/* FIXME: check the error return value of
-		   aho_corasick_goto_initialize. */
-		aho_corasick_goto_initialize(s);
 
-		// Create transition
-		aho_corasick_goto_set(state,*(string+j), s);
-		debug(printf("%u -> %c -> %u\n",state->id,*(string+j),s->id));
-		state = s;
-		aho_corasick_output(s) = 0;
-		aho_corasick_fail(s) = NULL;
-		++j;
+/* Does an aho-corasick search, given a 'string' of length 'n'.  If
+   we're able to find a match, fills in the match and returns 1.
+ */
+static int
+aho_corasick_first(aho_corasick_t *g,
+		   unsigned char *string,
+		   size_t n,
+		   size_t startpos,
+		   const aho_corasick_options_t *options,
+		   aho_corasick_match_t *match)
+{
+	size_t j;
+	aho_corasick_int_t state, m, states[1 + AHO_CORASICK_DELTAS];
+	aho_corasick_t *t;
+	aho_corasick_counters_t *counters;
+
+	if (options == NULL)
+	{
+		for(j = startpos,state = 0 ; j < n ; j++)
+		{
+			if (g->skip && state == 0 &&
+			    (j = aho_corasick_skip(g,string,j,n,NULL)) == n)
+				break;
+			state = aho_corasick_step(g,state,*(string+j));
+			if ( g->outputs[state] != 0 )
+			{
+				aho_corasick_match_set(match, g, state, j+1);
+				return 1;
+			}
+		}
+		return 0;
 	}
 
-	aho_corasick_output(s) = n;
+	/* The same again, only counting.  It's kept apart from the loop
+	   above, which shouldn't have to check for counters at every
+	   byte. */
+	counters = options->counters;
+	if (aho_corasick_plain(options))
+	{
+		for(j = startpos,state = 0 ; j < n ; j++)
+		{
+			if (g->skip && state == 0 &&
+			    (j = aho_corasick_skip(g,string,j,n,counters)) == n)
+				break;
+			state = aho_corasick_step_counting(g,state,
+							   *(string+j),
+							   counters);
+			if ( g->outputs[state] != 0 )
+			{
+				aho_corasick_match_set(match, g, state, j+1);
+				aho_corasick_count(counters, startpos, j+1, 1);
+				return 1;
+			}
+		}
+		aho_corasick_count(counters, startpos, n, 0);
+		return 0;
+	}
+
+	/* Otherwise it's the keyword of the state we'd be in without the
+	   keywords that are gone, if it gets past the options. */
+	memset(states, 0, sizeof(states));
+	for(j = startpos ; j < n ; j++)
+	{
+		if (g->skip && states[0] == 0 && options->ndeltas == 0 &&
+		    (j = aho_corasick_skip(g,string,j,n,counters)) == n)
+			break;
+		aho_corasick_next_all(g, options, states, *(string+j),
+				      counters);
+		aho_corasick_current(options, g, states, &t, &m);
+		if (t->outputs[m] != 0 &&
+		    aho_corasick_allowed(options, t, m))
+		{
+			aho_corasick_match_set(match, t, m, j+1);
+			aho_corasick_count(counters, startpos, j+1, 1);
+			return 1;
+		}
+	}
+	aho_corasick_count(counters, startpos, n, 0);
+	return 0;
+}
+
+
+
+/* Similar to the first helper function, but tries to return the longest
+   match. */
+static int
+aho_corasick_longest(aho_corasick_t *g,
+		     unsigned char *string,
+		     size_t n,
+		     size_t startpos,
+		     const aho_corasick_options_t *options,
+		     aho_corasick_match_t *match)
+{
+	size_t j;
+	aho_corasick_int_t m, depth = 0, states[1 + AHO_CORASICK_DELTAS];
+	aho_corasick_t *t;
+	aho_corasick_counters_t *counters =
+		options != NULL ? options->counters : NULL;
+	int ndeltas = options != NULL ? options->ndeltas : 0;
+	int plain = aho_corasick_plain(options);
+	int queued = 0;
+
+	memset(states, 0, sizeof(states));
+	for(j = startpos ; j < n ; j++)
+	{
+		if (g->skip && states[0] == 0 && !queued && ndeltas == 0 &&
+		    (j = aho_corasick_skip(g,string,j,n,counters)) == n)
+			break;
+		aho_corasick_next_all(g, options, states, *(string+j),
+				      counters);
+		aho_corasick_current(options, g, states, &t, &m);
+
+		/* Only a goto transition takes us exactly one level deeper;
+		   anything else means the match we have queued up can't grow
+		   any longer.  With options, that's a goto transition of the
+		   tree made of just the keywords they leave. */
+		if (t->depths[m] != depth + 1 && queued)
+		{
+			aho_corasick_count(counters, startpos, j+1, 1);
+			return 1;
+		}
+		depth = t->depths[m];
+		if (t->outputs[m] != 0 &&
+		    (plain ||
+		     aho_corasick_allowed(options, t, m)))
+		{
+			aho_corasick_match_set(match, t, m, j+1);
+			queued = 1;
+		}
+	}
+
+	/* If we reach the end of the string, we still have to double check if
+	   we had a longest match queued up. */
+	aho_corasick_count(counters, startpos, n, queued);
+	return queued;
+}
+
+
+/* Runs one of the two above without word boundaries, and if the match it
+   comes up with doesn't fit them, goes on from its end, the way findall()
+   would. */
+static int
+aho_corasick_bounded(int (*helper)(aho_corasick_t *, unsigned char *,
+				   size_t, size_t,
+				   const aho_corasick_options_t *,
+				   aho_corasick_match_t *),
+		     aho_corasick_t *g,
+		     unsigned char *string,
+		     size_t n,
+		     size_t startpos,
+		     const aho_corasick_options_t *options,
+		     aho_corasick_match_t *match)
+{
+	aho_corasick_options_t unbounded;
+	const aho_corasick_options_t *search =
+		aho_corasick_unbounded(options, &unbounded);
+
+	while (startpos < n && (*helper)(g, string, n, startpos, search, match))
+	{
+		if (aho_corasick_fits(options, string, n, match))
+			return 1;
+		startpos = match->end;
+	}
+	return 0;
+}
+
+
+int
+ahocorasick_KeywordTree_search_helper(aho_corasick_t *g,
+				      unsigned char *string,
+				      size_t n,
+				      size_t startpos,
+				      const aho_corasick_options_t *options,
+				      aho_corasick_match_t *match)
+{
+	if (options == NULL || options->boundaries == NULL)
+		return aho_corasick_first(g, string, n, startpos, options,
+					  match);
+	return aho_corasick_bounded(aho_corasick_first, g, string, n,
+				    startpos, options, match);
+}
+
+
+int
+ahocorasick_KeywordTree_search_long_helper(aho_corasick_t *g,
+					   unsigned char *string,
+					   size_t n,
+					   size_t startpos,
+					   const aho_corasick_options_t *options,
+					   aho_corasick_match_t *match)
+{
+	if (options == NULL || options->boundaries == NULL)
+		return aho_corasick_longest(g, string, n, startpos, options,
+					    match);
+	return aho_corasick_bounded(aho_corasick_longest, g, string, n,
+				    startpos, options, match);
+}
+
+
+
+
+
+void
+aho_corasick_matches_init(aho_corasick_matches_t *matches)
+{
+	matches->data = NULL;
+	matches->size = 0;
+	matches->capacity = 0;
+}
+
+
+void
+aho_corasick_matches_destroy(aho_corasick_matches_t *matches)
+{
+	xfree(matches->data);
+	aho_corasick_matches_init(matches);
+}
+
+
+/* Adds one match to the end of the array, growing it if need be. */
+static int
+aho_corasick_matches_append(aho_corasick_matches_t *matches,
+			    const aho_corasick_match_t *match)
+{
+	size_t capacity;
+	aho_corasick_match_t *data;
+
+	if (matches->size == matches->capacity)
+	{
+		capacity = matches->capacity ? matches->capacity * 2 : 16;
+		data = xrealloc(matches->data,
+				capacity * sizeof(aho_corasick_match_t));
+		if (data == NULL)
+			return -1;
+		matches->data = data;
+		matches->capacity = capacity;
+	}
+	matches->data[matches->size++] = *match;
+	return 0;
+}
+
+
+int
+ahocorasick_KeywordTree_findall_helper(aho_corasick_t *g,
+				       ahocorasick_KeywordTree_search_helper_t helper,
+				       unsigned char *string,
+				       size_t n,
+				       size_t startpos,
+				       const aho_corasick_options_t *options,
+				       int allow_overlaps,
+				       aho_corasick_matches_t *matches)
+{
+	size_t pos = startpos;
+	aho_corasick_match_t match;
+	aho_corasick_options_t unbounded;
+	const aho_corasick_options_t *search =
+		aho_corasick_unbounded(options, &unbounded);
+
+	/* Matches that don't fit the word boundaries are passed over, but we
+	   go on from them just as if they'd been kept. */
+	while (pos < n && (*helper)(g, string, n, pos, search, &match))
+	{
+		if (aho_corasick_fits(options, string, n, &match) &&
+		    aho_corasick_matches_append(matches, &match) < 0)
+			return -1;
+
+		if (allow_overlaps)
+			pos = match.start + 1;
+		else
+			pos = match.end;
+	}
+	return 0;
+}
+
+
+
+
+
+size_t
+ahocorasick_KeywordTree_count_helper(aho_corasick_t *g,
+				     ahocorasick_KeywordTree_search_helper_t helper,
+				     unsigned char *string,
+				     size_t n,
+				     size_t startpos,
+				     const aho_corasick_options_t *options,
+				     int allow_overlaps,
+				     long *counts)
+{
+	size_t pos = startpos, total = 0;
+	aho_corasick_match_t match;
+	aho_corasick_options_t unbounded;
+	const aho_corasick_options_t *search =
+		aho_corasick_unbounded(options, &unbounded);
+
+	while (pos < n && (*helper)(g, string, n, pos, search, &match))
+	{
+		if (aho_corasick_fits(options, string, n, &match))
+		{
+			total++;
+			if (counts != NULL)
+				counts[match.keyword]++;
+		}
+
+		if (allow_overlaps)
+			pos = match.start + 1;
+		else
+			pos = match.end;
+	}
+	return total;
+}
+
+
+
+
+
+int
+ahocorasick_KeywordTree_feed_helper(aho_corasick_t *g,
+				    unsigned char *string,
+				    size_t n,
+				    size_t offset,
+				    const aho_corasick_options_t *options,
+				    aho_corasick_int_t *states,
+				    int all,
+				    aho_corasick_matches_t *matches)
+{
+	size_t j;
+	aho_corasick_int_t m;
+	aho_corasick_t *t;
+	aho_corasick_counters_t *counters =
+		options != NULL ? options->counters : NULL;
+	aho_corasick_chain_t chain;
+	aho_corasick_match_t match;
+	size_t found = matches->size;
+	int ndeltas = options != NULL ? options->ndeltas : 0;
+	int plain = aho_corasick_plain(options);
+	for(j = 0 ; j < n ; j++)
+	{
+		if (g->skip && states[0] == 0 && ndeltas == 0 &&
+		    (j = aho_corasick_skip(g,string,j,n,counters)) == n)
+			break;
+		aho_corasick_next_all(g, options, states, *(string+j),
+				      counters);
+		if ( !all )
+		{
+			aho_corasick_current(options, g, states, &t, &m);
+			if ( t->outputs[m] == 0 ||
+			     (!plain && !aho_corasick_allowed(options, t, m)) )
+				continue;
+			/* Like findall(): start over right after the match. */
+			aho_corasick_match_set(&match, t, m, offset + j + 1);
+			if (aho_corasick_matches_append(matches, &match) < 0)
+				return -1;
+			memset(states, 0,
+			       (1 + ndeltas) * sizeof(aho_corasick_int_t));
+			continue;
+		}
+
+		aho_corasick_chain_start(&chain, options, g, states);
+		while (aho_corasick_chain_next(&chain, &t, &m))
+		{
+			if (options != NULL &&
+			    !aho_corasick_allowed(options, t, m))
+				continue;
+			aho_corasick_match_set(&match, t, m, offset + j + 1);
+			if (aho_corasick_matches_append(matches, &match) < 0)
+				return -1;
+		}
+	}
+	aho_corasick_count(counters, 0, n, matches->size - found);
+	return 0;
+}
+
+
+int
+ahocorasick_KeywordTree_next_helper(aho_corasick_t *g,
+				    unsigned char *string,
+				    size_t n,
+				    size_t *pos,
+				    const aho_corasick_options_t *options,
+				    aho_corasick_int_t *states,
+				    aho_corasick_matches_t *matches)
+{
+	size_t j;
+	aho_corasick_int_t m;
+	aho_corasick_t *t;
+	aho_corasick_counters_t *counters =
+		options != NULL ? options->counters : NULL;
+	aho_corasick_chain_t chain;
+	aho_corasick_match_t match;
+	size_t found = matches->size;
+	int ndeltas = options != NULL ? options->ndeltas : 0;
+	for(j = *pos ; j < n ; j++)
+	{
+		if (g->skip && states[0] == 0 && ndeltas == 0 &&
+		    (j = aho_corasick_skip(g,string,j,n,counters)) == n)
+			break;
+		aho_corasick_next_all(g, options, states, *(string+j),
+				      counters);
+		aho_corasick_chain_start(&chain, options, g, states);
+		while (aho_corasick_chain_next(&chain, &t, &m))
+		{
+			if (options != NULL &&
+			    !aho_corasick_allowed(options, t, m))
+				continue;
+			aho_corasick_match_set(&match, t, m, j + 1);
+			if (aho_corasick_matches_append(matches, &match) < 0)
+				return -1;
+		}
+		if (matches->size > found)
+		{
+			j++;
+			break;
+		}
+	}
+	aho_corasick_count(counters, *pos, j, matches->size - found);
+	*pos = j;
+	return 0;
+}
+
+
+int
+ahocorasick_KeywordTree_every_helper(aho_corasick_t *g,
+				     unsigned char *string,
+				     size_t n,
+				     size_t startpos,
+				     const aho_corasick_options_t *options,
+				     aho_corasick_matches_t *matches)
+{
+	aho_corasick_int_t states[1 + AHO_CORASICK_DELTAS];
+
+	memset(states, 0, sizeof(states));
+	if (startpos >= n)
+		return 0;
+	return ahocorasick_KeywordTree_feed_helper(g, string + startpos,
+						   n - startpos, startpos,
+						   options, states, 1, matches);
+}
+
+
+
+
+size_t
+aho_corasick_utf8_chars(unsigned char *string, size_t n)
+{
+	size_t j, chars = 0;
+	for(j = 0 ; j < n ; j++)
+		chars += aho_corasick_utf8_width(string[j]);
+	return chars;
+}
+
+
+size_t
+aho_corasick_utf8_offset(unsigned char *string, size_t n, size_t chars)
+{
+	size_t j, seen = 0;
+	for(j = 0 ; j < n ; j++)
+	{
+		if ( (seen += aho_corasick_utf8_width(string[j])) > chars )
+			return j;
+	}
+	return n;
+}
+
+
+void
+aho_corasick_matches_to_chars(unsigned char *string,
+			      size_t n,
+			      size_t bytes,
+			      size_t chars,
+			      aho_corasick_matches_t *matches)
+{
+	size_t i, pos = 0, end;
+	aho_corasick_match_t *match;
+
+	/* Keep a cursor into the string, and move it to the end of each
+	   match in turn.  The start is the end less the keyword's length. */
+	for(i = 0 ; i < matches->size ; i++)
+	{
+		match = &matches->data[i];
+		end = match->end - bytes;
+		for( ; pos < end && pos < n ; pos++)
+			chars += aho_corasick_utf8_width(string[pos]);
+		while( pos > end )
+		{
+			pos--;
+			chars -= aho_corasick_utf8_width(string[pos]);
+		}
+		match->end = chars;
+		match->start = chars - match->chars;
+	}
+}
+
+
+
+
+
+/* Initializes the zerostate.  If initialization is successful,
+   returns 0.  If bad things happen, returns -1. */
+static int
+initialize_zero_state(aho_corasick_t *in) {
+	if ( in->zerostate == NULL )
+	{
+		if ( (in->zerostate = arena_alloc(&in->arena,
+						  sizeof(aho_corasick_state_t)))
+		     == NULL )
+		{
+			return -1;
+		}
+		in->newstate = 1;
+		in->zerostate->id = 0;
+		in->zerostate->depth = 0;
+		aho_corasick_output(in->zerostate) = 0;
+		in->zerostate->keyword = 0;
+		aho_corasick_fail(in->zerostate) = NULL;
+		if ( aho_corasick_goto_initialize(in, in->zerostate) < 0 )
+		{
+			in->zerostate = NULL;
+			return -1;
+		}
+	}
+	return 0;
+}
+
+
+int
+aho_corasick_init(aho_corasick_t *g)
+{
+	int i;
+
+	if (!g)
+	{
+		return -1;
+	}
+	else
+	{
+		for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+		{
+			g->classes[i] = i;
+			g->used[i] = 0;
+			g->translate[i] = i;
+			g->folded[i] = i;
+		}
+		g->nclasses = AHO_CORASICK_CHARACTERS;
+		arena_init(&g->arena);
+		arena_init(&g->dense_arena);
+		for(i = 0; i < AHO_CORASICK_SPARSE_SIZES ;i++)
+			g->spare_edges[i] = NULL;
+		g->zerostate = NULL;
+		g->newstate = 0;
+		g->nkeywords = 0;
+		g->states = NULL;
+		g->outputs = NULL;
+		g->keywords = NULL;
+		g->depths = NULL;
+		g->fails = NULL;
+		g->dicts = NULL;
+		g->chars = NULL;
+		g->delta = NULL;
+		g->image = NULL;
+		g->text = 0;
+		g->policy.fanout = 0;
+		g->policy.budget = AHO_CORASICK_NO_BUDGET;
+		g->nstarts = 0;
+		g->skip = 0;
+		return initialize_zero_state(g);
+	}
+
+}
+
+
+/* Deallocates the id-indexed tables that aho_corasick_maketree() fills in,
+   unless they belong to an image. */
+static void
+aho_corasick_free_tables(aho_corasick_t *g)
+{
+	if (g->image == NULL) {
+		xfree(g->states);
+		xfree(g->outputs);
+		xfree(g->keywords);
+		xfree(g->depths);
+		xfree(g->fails);
+		xfree(g->dicts);
+		xfree(g->chars);
+		xfree(g->delta);
+	}
+	g->states = NULL;
+	g->outputs = NULL;
+	g->keywords = NULL;
+	g->depths = NULL;
+	g->fails = NULL;
+	g->dicts = NULL;
+	g->chars = NULL;
+	g->delta = NULL;
+	g->image = NULL;
+}
+
+
+void
+aho_corasick_destroy(aho_corasick_t *in)
+{
+	int i;
+
+	/* Every state and transition table lives in the arenas, so there's
+	   no need to walk the tree. */
+	arena_destroy(&in->arena);
+	arena_destroy(&in->dense_arena);
+	for(i = 0; i < AHO_CORASICK_SPARSE_SIZES ;i++)
+		in->spare_edges[i] = NULL;
+	in->zerostate = NULL;
+
+	aho_corasick_free_tables(in);
+}
+
+
+/* Walks the states of a tree that hasn't been made yet, depth first, and
+   fills in the depth of each, and how many tables of each kind there
+   are. */
+static int
+aho_corasick_stats_walk(aho_corasick_t *g,
+			aho_corasick_stats_t *stats,
+			aho_corasick_int_t *depths)
+{
+	aho_corasick_state_t **stack, *state, *s;
+	aho_corasick_int_t top = 0, i;
+	unsigned char symbol;
+
+	if ( (stack = xalloc(g->newstate *
+			     sizeof(aho_corasick_state_t *))) == NULL )
+		return -1;
+	stack[top++] = g->zerostate;
+	while (top > 0)
+	{
+		state = stack[--top];
+		depths[state->id] = state->depth;
+		if (state->_transitions.type == AHO_CORASICK_DENSE_TRANSITIONS)
+			stats->dense++;
+		else
+			stats->sparse++;
+		i = 0;
+		while( (s = aho_corasick_goto_next(g,state,&i,&symbol)) != FAIL )
+			stack[top++] = s;
+	}
+	xfree(stack);
+	return 0;
+}
+
+
+/* Returns the ids of the states of a finished tree sorted by depth, in a
+   table for the caller to xfree(), or NULL on memory allocation failure.
+   Failure and dictionary suffix links only ever go up the tree, so going
+   down it in this order finds where each link leads done before the state
+   it leads from. */
+static aho_corasick_int_t *
+aho_corasick_depth_order(aho_corasick_t *g)
+{
+	aho_corasick_int_t *order, i, maxdepth = 0;
+	size_t *starts, start, count;
+
+	for(i = 0; i < g->newstate ;i++)
+		if (g->depths[i] > maxdepth)
+			maxdepth = g->depths[i];
+	order = xalloc((size_t) g->newstate * sizeof(aho_corasick_int_t));
+	starts = xalloc((maxdepth + 1) * sizeof(size_t));
+	if (order == NULL || starts == NULL)
+	{
+		xfree(order);
+		xfree(starts);
+		return NULL;
+	}
+
+	/* Count the states at each depth, and turn that into where the
+	   states of each depth start. */
+	memset(starts, 0, (maxdepth + 1) * sizeof(size_t));
+	for(i = 0; i < g->newstate ;i++)
+		starts[g->depths[i]]++;
+	for(i = 0, start = 0; i <= maxdepth ;i++)
+	{
+		count = starts[i];
+		starts[i] = start;
+		start += count;
+	}
+	for(i = 0; i < g->newstate ;i++)
+		order[starts[g->depths[i]]++] = i;
+	xfree(starts);
+	return order;
+}
+
+
+/* Sets chain[id] to one more than chain[links[id]], for every state but
+   the zerostate, whose links always go up the tree, and returns the
+   largest.  The order has the states by depth.  With counting set, a link
+   to the zerostate is the end of the chain rather than a step on it. */
+static aho_corasick_int_t
+aho_corasick_stats_chain(aho_corasick_t *g,
+			 aho_corasick_int_t *links,
+			 aho_corasick_int_t *order,
+			 aho_corasick_int_t *chain,
+			 int counting)
+{
+	aho_corasick_int_t i, id, longest = 0;
+
+	chain[0] = 0;
+	for(i = 1; i < g->newstate ;i++)
+	{
+		id = order[i];
+		if (counting && links[id] == 0)
+			chain[id] = 0;
+		else
+			chain[id] = chain[links[id]] + 1;
+		if (chain[id] > longest)
+			longest = chain[id];
+	}
+	return longest;
+}
+
+
+int
+aho_corasick_stats(aho_corasick_t *g, aho_corasick_stats_t *stats)
+{
+	aho_corasick_int_t *depths = g->depths, *order = NULL, *chain = NULL;
+	aho_corasick_int_t i;
+	size_t table = (size_t) g->newstate * sizeof(aho_corasick_int_t);
+
+	memset(stats, 0, sizeof(*stats));
+	stats->states = g->newstate;
+	stats->arena_bytes = g->arena.allocated + g->dense_arena.allocated;
+	if (g->image != NULL)
+		stats->image_bytes =
+			((aho_corasick_image_header_t *) g->image)->size;
+	else if (g->outputs != NULL)
+	{
+		stats->table_bytes = g->newstate *
+			sizeof(aho_corasick_state_t *) + 5 * table;
+		if (g->chars != NULL)
+			stats->table_bytes += table;
+		if (g->delta != NULL)
+			stats->dfa_bytes = table * g->nclasses;
+	}
+
+	if (g->states != NULL)
+	{
+		for(i = 0; i < g->newstate ;i++)
+			if (g->states[i]->_transitions.type ==
+			    AHO_CORASICK_DENSE_TRANSITIONS)
+				stats->dense++;
+			else
+				stats->sparse++;
+	}
+	else if (depths == NULL)
+	{
+		if ( (depths = xalloc(table)) == NULL )
+			goto fail;
+		if (aho_corasick_stats_walk(g, stats, depths) < 0)
+			goto fail;
+	}
+
+	for(i = 0; i < g->newstate ;i++)
+		if (depths[i] > stats->maxdepth)
+			stats->maxdepth = depths[i];
+	if ( (stats->depths = xalloc((stats->maxdepth + 1) *
+				     sizeof(size_t))) == NULL )
+		goto fail;
+	memset(stats->depths, 0, (stats->maxdepth + 1) * sizeof(size_t));
+	for(i = 0; i < g->newstate ;i++)
+		stats->depths[depths[i]]++;
+
+	if (g->fails != NULL)
+	{
+		order = aho_corasick_depth_order(g);
+		chain = xalloc(table);
+		if (order == NULL || chain == NULL)
+			goto fail;
+		stats->max_fail_chain =
+			aho_corasick_stats_chain(g, g->fails, order, chain, 0);
+		stats->max_dict_chain =
+			aho_corasick_stats_chain(g, g->dicts, order, chain, 1);
+	}
+
+	if (depths != g->depths)
+		xfree(depths);
+	xfree(order);
+	xfree(chain);
+	return 0;
+
+ fail:
+	if (depths != g->depths)
+		xfree(depths);
+	xfree(order);
+	xfree(chain);
+	aho_corasick_stats_destroy(stats);
+	return -1;
+}
+
+
+void
+aho_corasick_stats_destroy(aho_corasick_stats_t *stats)
+{
+	xfree(stats->depths);
+	stats->depths = NULL;
+}
+
+
+int
+aho_corasick_setgroups(aho_corasick_t *g,
+		       const aho_corasick_groups_t *keywords,
+		       const unsigned char *removed,
+		       aho_corasick_groups_t *groups)
+{
+	aho_corasick_groups_t *below = aho_corasick_belows(g, groups);
+	aho_corasick_int_t *order, i, id;
+
+	if ( (order = aho_corasick_depth_order(g)) == NULL )
+		return -1;
+	aho_corasick_stale(g, groups) = 0;
+
+	/* The zerostate is the only state at depth 0, and has no keyword;
+	   every other state has what the rest of its chain has, and then
+	   its own keyword's groups. */
+	groups[0] = 0;
+	for(i = 1; i < g->newstate ;i++)
+	{
+		id = order[i];
+		groups[id] = groups[g->dicts[id]];
+		if (g->outputs[id] != 0)
+			groups[id] |= keywords[g->keywords[id]];
+	}
+
+	/* Going up the tree, the states below each one are done by the time
+	   it is. */
+	for(i = g->newstate; i-- > 0 ;)
+		below[order[i]] = aho_corasick_below(g, order[i], keywords,
+						     removed, below);
+	xfree(order);
+	return 0;
+}
+
+
+void
+aho_corasick_joingroup(aho_corasick_t *g, unsigned char *string, size_t n,
+		       aho_corasick_groups_t mask, int removed,
+		       aho_corasick_groups_t *groups)
+{
+	aho_corasick_groups_t *below = aho_corasick_belows(g, groups);
+	aho_corasick_int_t state = 0;
+	size_t j;
+
+	aho_corasick_stale(g, groups) |= mask;
+	if (removed)
+		return;
+	below[0] |= mask;
+	for(j = 0; j < n ;j++)
+	{
+		state = aho_corasick_step(g, state, string[j]);
+		below[state] |= mask;
+	}
+}
+
+
+size_t
+aho_corasick_edges(aho_corasick_t *g, long *src, long *labels, long *dst)
+{
+	/* The bytes of each class, in byte order: those of class c are
+	   bytes[first[c]] up to bytes[first[c + 1]]. */
+	unsigned char bytes[AHO_CORASICK_CHARACTERS];
+	int first[AHO_CORASICK_CHARACTERS + 1];
+	aho_corasick_state_t *s;
+	aho_corasick_int_t id, next, i;
+	unsigned char symbol;
+	size_t n = 0;
+	int b, c;
+
+	for(c = 0; c <= g->nclasses ;c++)
+		first[c] = 0;
+	for(b = 0; b < AHO_CORASICK_CHARACTERS ;b++)
+		first[g->classes[b] + 1]++;
+	for(c = 0; c < g->nclasses ;c++)
+		first[c + 1] += first[c];
+	for(b = 0; b < AHO_CORASICK_CHARACTERS ;b++)
+		bytes[first[g->classes[b]]++] = b;
+	/* That left each first[c] where first[c + 1] started out. */
+	for(c = g->nclasses; c > 0 ;c--)
+		first[c] = first[c - 1];
+	first[0] = 0;
+
+	for(id = 0; id < g->newstate ;id++)
+	{
+		/* A loaded tree only has its DFA table, but the transitions
+		   in it that go one level deeper are the goto ones. */
+		i = 0;
+		for(;;)
+		{
+			if (g->states != NULL)
+			{
+				s = aho_corasick_goto_next(g, g->states[id], &i,
+							   &symbol);
+				if (s == FAIL)
+					break;
+				next = s->id;
+			}
+			else
+			{
+				if (i == (aho_corasick_int_t) g->nclasses)
+					break;
+				symbol = i++;
+				next = g->delta[id * g->nclasses + symbol];
+				if (g->depths[next] != g->depths[id] + 1)
+					continue;
+			}
+			if (next == 0)
+				continue;
+			for(b = first[symbol]; b < first[symbol + 1] ;b++)
+			{
+				if (src != NULL)
+				{
+					src[n] = id;
+					labels[n] = bytes[b];
+					dst[n] = next;
+				}
+				n++;
+			}
+		}
+	}
+	return n;
+}
+
+
+/* Fills in the row of the DFA transition table delta for a state whose
+   failure transition is known: any symbol without a goto transition behaves
+   exactly like it does in the failure state.  The row of the failure state
+   must already be done, which it is if the caller goes breadth-first, since
+   it sits at a lower depth. */
+static void
+aho_corasick_fill_row(aho_corasick_t *g,
+		      aho_corasick_state_t *state,
+		      aho_corasick_int_t *delta)
+{
+	aho_corasick_int_t *row, *fail_row;
+	aho_corasick_state_t *s;
+	int i;
+
+	row = delta + state->id * g->nclasses;
+	if (aho_corasick_fail(state) == NULL) {
+		/* The zerostate: it has a goto transition everywhere. */
+		for(i = 0; i < g->nclasses ;i++)
+			row[i] = aho_corasick_goto_get(state,i)->id;
+		return;
+	}
+
+	fail_row = delta + aho_corasick_fail(state)->id * g->nclasses;
+	for(i = 0; i < g->nclasses ;i++)
+	{
+		if ( (s = aho_corasick_goto_get(state,i)) != FAIL )
+			row[i] = s->id;
+		else
+			row[i] = fail_row[i];
+	}
+}
+
+
+/* Fills in the flat, id-indexed views of a state once its failure
+   transition is known, including its row of the transition table in DFA
+   mode.  The state's failure state, being shallower, has already been
+   through here, so its dictionary link is ready to be followed. */
+static void
+aho_corasick_makestate(aho_corasick_t *g, aho_corasick_state_t *state)
+{
+	aho_corasick_int_t fail;
+
+	g->states[state->id] = state;
+	g->outputs[state->id] = aho_corasick_output(state);
+	g->keywords[state->id] = state->keyword;
+	g->depths[state->id] = state->depth;
+	if (aho_corasick_fail(state) == NULL) {
+		/* The zerostate. */
+		g->fails[state->id] = 0;
+		g->dicts[state->id] = 0;
+	}
+	else {
+		fail = aho_corasick_fail(state)->id;
+		g->fails[state->id] = fail;
+		g->dicts[state->id] = g->outputs[fail] != 0 ?
+			fail : g->dicts[fail];
+	}
+
+	if (g->delta != NULL)
+		aho_corasick_fill_row(g, state, g->delta);
+}
+
+/* Splits the bytes into equivalence classes: every byte that shows up in a
+   keyword gets a class of its own, and all the others share class 0.  If
+   every byte shows up somewhere, the classes are just the bytes. */
+static void
+aho_corasick_makeclasses(aho_corasick_t *g)
+{
+	int i;
+
+	g->nclasses = 0;
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+		if ( !g->used[i] )
+			g->nclasses = 1;
+
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+	{
+		if ( g->used[i] )
+			g->classes[i] = g->nclasses++;
+		else
+			g->classes[i] = 0;
+	}
+}
+
+
+/* Folds the translate table into the classes, once nothing needs the
+   classes of the translated bytes any more. */
+static void
+aho_corasick_composeclasses(aho_corasick_t *g)
+{
+	unsigned char classes[AHO_CORASICK_CHARACTERS];
+	int i;
+
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+		classes[i] = g->classes[g->translate[i]];
+	memcpy(g->folded, g->translate, AHO_CORASICK_CHARACTERS);
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+	{
+		g->classes[i] = classes[i];
+		g->translate[i] = i;
+	}
+}
+
+
+int
+aho_corasick_build_begin(aho_corasick_t *g,
+			 aho_corasick_build_t *build,
+			 aho_corasick_mode_t mode)
+{
+	aho_corasick_state_t *r,*s;
+	aho_corasick_int_t head, tail, j, fanout;
+	unsigned char symbol;
+	size_t budget, row;
+	int i, dense;
+
+	build->order = xalloc(g->newstate * sizeof(aho_corasick_state_t *));
+	g->states = xalloc(g->newstate * sizeof(aho_corasick_state_t *));
+	g->outputs = xalloc(g->newstate * sizeof(aho_corasick_int_t));
+	g->keywords = xalloc(g->newstate * sizeof(aho_corasick_int_t));
+	g->depths = xalloc(g->newstate * sizeof(aho_corasick_int_t));
+	g->fails = xalloc(g->newstate * sizeof(aho_corasick_int_t));
+	g->dicts = xalloc(g->newstate * sizeof(aho_corasick_int_t));
+	if (build->order == NULL || g->states == NULL || g->outputs == NULL ||
+	    g->keywords == NULL || g->depths == NULL || g->fails == NULL ||
+	    g->dicts == NULL)
+		goto fail;
+
+	aho_corasick_makeclasses(g);
+
+	/* In text mode, count the characters along the way down, which
+	   needs the byte behind each class.  Only bytes that are in some
+	   keyword label a transition, and those have classes of their own. */
+	if (g->text) {
+		if ( (g->chars = xalloc(g->newstate *
+					sizeof(aho_corasick_int_t))) == NULL )
+			goto fail;
+		for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+			if ( g->used[i] )
+				build->bytes[g->classes[i]] = i;
+		g->chars[0] = 0;
+	}
+
+	if (mode == AHO_CORASICK_DFA_MODE) {
+		g->delta = xalloc((size_t) g->newstate * g->nclasses *
+				  sizeof(aho_corasick_int_t));
+		if (g->delta == NULL)
+			goto fail;
+	}
+
+	/* Line the states up breadth-first, using the order array itself as
+	   the queue, and relabel their transitions by class on the way, in
+	   the tables that the policy picks for them.  Going breadth-first
+	   hands the budget out shallowest first. */
+	fanout = g->policy.fanout;
+	if (fanout == 0)
+		fanout = g->nclasses / 4 > 1 ? g->nclasses / 4 : 1;
+	budget = g->policy.budget;
+	row = g->nclasses * sizeof(aho_corasick_state_t *);
+	build->order[0] = g->zerostate;
+	for(head = 0, tail = 1; head < tail; head++)
+	{
+		r = build->order[head];
+		dense = r == g->zerostate;
+		if (!dense && aho_corasick_goto_fanout(r) >= fanout &&
+		    (budget == AHO_CORASICK_NO_BUDGET || budget >= row))
+		{
+			dense = 1;
+			if (budget != AHO_CORASICK_NO_BUDGET)
+				budget -= row;
+		}
+		if ( aho_corasick_goto_compress(g, r, dense) < 0 )
+			goto fail;
+		j = 0;
+		while( (s = aho_corasick_goto_next(g, r, &j, &symbol)) != FAIL )
+			build->order[tail++] = s;
+	}
+	build->n = tail;
+
+	// Set all FAIL transition of 0 state to point to itself
+	for(i = 0; i < g->nclasses ;i++)
+	{
+		if ( (s = aho_corasick_goto_get(g->zerostate,i)) == FAIL )
+		{
+			if ( aho_corasick_goto_set(g, g->zerostate, i,
+						   g->zerostate) < 0 )
+				goto fail;
+		}
+		// Construct fail()
+		else
+		{
+			aho_corasick_fail(s) = g->zerostate;
+			if (g->chars != NULL)
+				g->chars[s->id] =
+					aho_corasick_utf8_width(build->bytes[i]);
+		}
+	}
+	aho_corasick_makestate(g, g->zerostate);
+	return 0;
+
+fail:
+	xfree(build->order);
+	build->order = NULL;
+	aho_corasick_free_tables(g);
+	return -1;
+}
+
+
+aho_corasick_int_t
+aho_corasick_build_level(aho_corasick_build_t *build, aho_corasick_int_t from)
+{
+	aho_corasick_int_t to = from;
+
+	while( to < build->n && build->order[to]->depth ==
+	       build->order[from]->depth )
+		to++;
+	return to;
+}
+
+
+void
+aho_corasick_build_states(aho_corasick_t *g,
+			  aho_corasick_build_t *build,
+			  aho_corasick_int_t from,
+			  aho_corasick_int_t to)
+{
+	aho_corasick_state_t *state,*s,*r;
+	aho_corasick_int_t j;
+	unsigned char symbol;
+
+	for(; from < to; from++)
+	{
+		r = build->order[from];
+		aho_corasick_makestate(g, r);
+		j = 0;
+		while( (s = aho_corasick_goto_next(g, r, &j, &symbol)) != FAIL )
+		{
+			if (g->chars != NULL)
+				g->chars[s->id] = g->chars[r->id] +
+					aho_corasick_utf8_width(build->bytes[symbol]);
+			state = aho_corasick_fail(r);
+			while( aho_corasick_goto_get(state,symbol) == FAIL )
+				state = aho_corasick_fail(state);
+			aho_corasick_fail(s) = aho_corasick_goto_get(state,symbol);
+			debug(printf("Setting f(%u) == %u\n",s->id,
+				     aho_corasick_fail(s)->id));
+			/* Outputs aren't joined: aho_corasick_makestate()
+			   links s to the outputs it inherits instead. */
+		}
+	}
+}
+
+
+void
+aho_corasick_build_end(aho_corasick_t *g, aho_corasick_build_t *build)
+{
+	xfree(build->order);
+	build->order = NULL;
+
+	/* Every dense table has been compressed by now. */
+	arena_destroy(&g->dense_arena);
+	aho_corasick_composeclasses(g);
+	aho_corasick_makeskip(g);
+}
+
+
+int
+aho_corasick_maketree(aho_corasick_t *in, aho_corasick_mode_t mode)
+{
+	aho_corasick_build_t build;
+	aho_corasick_int_t from, to;
+
+	if ( aho_corasick_build_begin(in, &build, mode) < 0 )
+		return -1;
+
+	// Set fail() for depth > 0, a level at a time
+	for(from = 1; from < build.n; from = to)
+	{
+		to = aho_corasick_build_level(&build, from);
+		aho_corasick_build_states(in, &build, from, to);
+	}
+
+	aho_corasick_build_end(in, &build);
+	return 0;
+}
+
+
+
+
+/* Adds the string to the tree, given that its first j bytes lead from the
+   zerostate to state.  If states isn't NULL, the state after each byte
+   from there on is put in states[j + 1], ..., states[n]. */
+static int
+aho_corasick_addstring_from(aho_corasick_t *g,
+			    aho_corasick_state_t *state,
+			    unsigned char *string,
+			    Py_ssize_t j,
+			    Py_ssize_t n,
+			    aho_corasick_state_t **states)
+{
+	aho_corasick_state_t *s = state;
+
+	// As long as we have transitions follow them
+	while( j != n &&
+	       (s = aho_corasick_goto_get(state,
+					  aho_corasick_symbol(g, *(string+j))))
+	       != FAIL )
+	{
+		state = s;
+		++j;
+		if (states != NULL)
+			states[j] = s;
+	}
+
+	if ( j == n ) {
+		/* dyoo: added so that if a keyword ends up in a prefix
+		   of another, we still mark that as a match.*/
+		if ( aho_corasick_output(s) == 0 )
+			s->keyword = g->nkeywords++;
+		aho_corasick_output(s) = j;
+		return s->keyword;
+	}
+
+	while( j != n )
+	{
+		// Create new state.  If anything goes wrong after this, the
+		// memory stays in the arena until the tree is destroyed.
+		if ( (s = arena_alloc(&g->arena,
+				      sizeof(aho_corasick_state_t))) == NULL )
+			return -1;
+		s->id = g->newstate;
+ 		debug(printf("allocating state %d\n", s->id)); /* debug */ 
+		s->depth = state->depth + 1;
+
+		if ( aho_corasick_goto_initialize(g, s) < 0 )
+			return -1;
+
+		// Create transition
+		if ( aho_corasick_goto_set(g, state,
+					   aho_corasick_symbol(g, *(string+j)),
+					   s) < 0 )
+			return -1;
+		g->newstate++;
+		g->used[g->translate[*(string+j)]] = 1;
+		debug(printf("%u -> %c -> %u\n",state->id,*(string+j),s->id));
+		state = s;
+		aho_corasick_output(s) = 0;
+		s->keyword = 0;
+		aho_corasick_fail(s) = NULL;
+		++j;
+		if (states != NULL)
+			states[j] = s;
+	}
+
+	aho_corasick_output(s) = n;
+	s->keyword = g->nkeywords++;
+
+	return s->keyword;
+}
+
+
+int
+aho_corasick_addstring(aho_corasick_t *in, unsigned char *string, Py_ssize_t n)
+{
+	return aho_corasick_addstring_from(in, in->zerostate, string, 0, n,
+					   NULL);
+}
+
+
+void
+aho_corasick_path_init(aho_corasick_path_t *path)
+{
+	path->keyword = NULL;
+	path->states = NULL;
+	path->n = 0;
+	path->capacity = 0;
+}
+
+
+void
+aho_corasick_path_destroy(aho_corasick_path_t *path)
+{
+	xfree(path->keyword);
+	xfree(path->states);
+	aho_corasick_path_init(path);
+}
+
+
+int
+aho_corasick_addstring_path(aho_corasick_t *g,
+			    aho_corasick_path_t *path,
+			    unsigned char *string,
+			    Py_ssize_t n)
+{
+	size_t capacity, shared = 0;
+	unsigned char *keyword;
+	aho_corasick_state_t **states;
+	int result;
+
+	if ((size_t) n + 1 > path->capacity)
+	{
+		capacity = path->capacity * 2 > (size_t) n + 1 ?
+			path->capacity * 2 : (size_t) n + 1;
+		if ( (keyword = xrealloc(path->keyword, capacity)) == NULL )
+			return -1;
+		path->keyword = keyword;
+		if ( (states = xrealloc(path->states, capacity *
+					sizeof(aho_corasick_state_t *))) == NULL )
+			return -1;
+		path->states = states;
+		path->capacity = capacity;
+	}
+
+	/* states[0 .. path->n] still lead down the last keyword. */
+	while( shared < (size_t) n && shared < path->n &&
+	       string[shared] == path->keyword[shared] )
+		shared++;
+	path->states[0] = g->zerostate;
+	result = aho_corasick_addstring_from(g, path->states[shared], string,
+					     shared, n, path->states);
+	if (result == -1)
+	{
+		path->n = 0;
+		return -1;
+	}
+	memcpy(path->keyword, string, n);
+	path->n = n;
+	return result;
+}
+
+
+
+/**********************************************************************/
+/* Flat images of a finished tree. */
+
+
+/* Works out where each table goes in the image of the tree, and how big the
+   image is. */
+static void
+aho_corasick_image_layout(aho_corasick_t *g,
+			  aho_corasick_image_header_t *header)
+{
+	size_t offset, table;
+	int i;
+
+	memset(header, 0, sizeof(aho_corasick_image_header_t));
+	memcpy(header->magic, AHO_CORASICK_IMAGE_MAGIC, sizeof(header->magic));
+	header->version = AHO_CORASICK_IMAGE_VERSION;
+	header->byteorder = AHO_CORASICK_IMAGE_BYTEORDER;
+	header->sizeof_size = sizeof(size_t);
+	header->nstates = g->newstate;
+	header->nclasses = g->nclasses;
+	header->nkeywords = g->nkeywords;
+	header->flags = g->text ? AHO_CORASICK_IMAGE_TEXT : 0;
+	memcpy(header->classes, g->classes, AHO_CORASICK_CHARACTERS);
+	memcpy(header->folded, g->folded, AHO_CORASICK_CHARACTERS);
+
+	offset = (sizeof(aho_corasick_image_header_t) + 7) & ~(size_t) 7;
+	for(i = 0; i < AHO_CORASICK_IMAGE_TABLES ;i++)
+	{
+		table = (size_t) g->newstate * sizeof(aho_corasick_int_t);
+		if (i == AHO_CORASICK_IMAGE_DELTA)
+			table *= g->nclasses;
+		if (i == AHO_CORASICK_IMAGE_CHARS && !g->text)
+			continue;
+		header->sections[i] = offset;
+		offset += (table + 7) & ~(size_t) 7;
+	}
+	header->size = offset;
+}
+
+
+size_t
+aho_corasick_image_size(aho_corasick_t *g)
+{
+	aho_corasick_image_header_t header;
+	aho_corasick_image_layout(g, &header);
+	return header.size;
+}
+
+
+int
+aho_corasick_image_write(aho_corasick_t *g, void *image)
+{
+	aho_corasick_image_header_t header;
+	char *base = image;
+	size_t table = (size_t) g->newstate * sizeof(aho_corasick_int_t);
+	aho_corasick_int_t *order, *count;
+	aho_corasick_int_t i, maxdepth = 0;
+
+	aho_corasick_image_layout(g, &header);
+	memset(image, 0, header.size);
+	memcpy(image, &header, sizeof(header));
+	memcpy(base + header.sections[AHO_CORASICK_IMAGE_OUTPUTS],
+	       g->outputs, table);
+	memcpy(base + header.sections[AHO_CORASICK_IMAGE_DEPTHS],
+	       g->depths, table);
+	memcpy(base + header.sections[AHO_CORASICK_IMAGE_FAILS],
+	       g->fails, table);
+	memcpy(base + header.sections[AHO_CORASICK_IMAGE_KEYWORDS],
+	       g->keywords, table);
+	memcpy(base + header.sections[AHO_CORASICK_IMAGE_DICTS],
+	       g->dicts, table);
+	if (g->text)
+		memcpy(base + header.sections[AHO_CORASICK_IMAGE_CHARS],
+		       g->chars, table);
+
+	if (g->delta != NULL) {
+		memcpy(base + header.sections[AHO_CORASICK_IMAGE_DELTA],
+		       g->delta, table * g->nclasses);
+		return 0;
+	}
+
+	/* In GOTO mode, we have to work out the DFA table now.  The rows need
+	   to be filled in breadth-first, so sort the states by depth. */
+	for(i = 0; i < g->newstate ;i++)
+		if (g->depths[i] > maxdepth)
+			maxdepth = g->depths[i];
+	order = xalloc(table);
+	count = xalloc((maxdepth + 2) * sizeof(aho_corasick_int_t));
+	if (order == NULL || count == NULL) {
+		xfree(order);
+		xfree(count);
+		return -1;
+	}
+	memset(count, 0, (maxdepth + 2) * sizeof(aho_corasick_int_t));
+	for(i = 0; i < g->newstate ;i++)
+		count[g->depths[i] + 1]++;
+	for(i = 1; i <= maxdepth + 1 ;i++)
+		count[i] += count[i-1];
+	for(i = 0; i < g->newstate ;i++)
+		order[count[g->depths[i]]++] = i;
+
+	for(i = 0; i < g->newstate ;i++)
+		aho_corasick_fill_row(g, g->states[order[i]],
+				      (aho_corasick_int_t *)
+				      (base + header.sections
+				       [AHO_CORASICK_IMAGE_DELTA]));
+	xfree(order);
+	xfree(count);
+	return 0;
+}
+
+
+/* Checks the tables of an image: every state they name must be in the
+   tree, every keyword that ends at a state must be one of the tree's, and
+   failure and dictionary links, like goto transitions, must not lead any
+   deeper than the state they start from.  That's what keeps the chains
+   short of looping and the starts of matches inside the string, whatever
+   is in the image.  Returns 0 if the tables are fine, -1 if not. */
+static int
+aho_corasick_image_check(aho_corasick_image_header_t *header, char *base)
+{
+	aho_corasick_int_t *outputs, *keywords, *depths, *fails, *dicts;
+	aho_corasick_int_t *chars, *row;
+	aho_corasick_int_t i, c, n = header->nstates;
+
+	outputs = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_OUTPUTS]);
+	keywords = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_KEYWORDS]);
+	depths = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_DEPTHS]);
+	fails = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_FAILS]);
+	dicts = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_DICTS]);
+	chars = (header->flags & AHO_CORASICK_IMAGE_TEXT) ?
+		(aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_CHARS]) : NULL;
+
+	if (depths[0] != 0 || outputs[0] != 0 || fails[0] != 0 ||
+	    dicts[0] != 0)
+		return -1;
+	for(i = 0; i < n ;i++)
+	{
+		if (depths[i] >= n || fails[i] >= n || dicts[i] >= n)
+			return -1;
+		/* The output of a state is the length of its keyword, which is
+		   how deep the state is. */
+		if (outputs[i] != 0 &&
+		    (outputs[i] != depths[i] || keywords[i] >= header->nkeywords))
+			return -1;
+		if (i != 0 && (depths[fails[i]] >= depths[i] ||
+			       depths[dicts[i]] >= depths[i] ||
+			       (dicts[i] != 0 && outputs[dicts[i]] == 0)))
+			return -1;
+		if (chars != NULL && chars[i] > depths[i])
+			return -1;
+
+		row = (aho_corasick_int_t *)
+			(base + header->sections[AHO_CORASICK_IMAGE_DELTA]) +
+			(size_t) i * header->nclasses;
+		for(c = 0; c < header->nclasses ;c++)
+			if (row[c] >= n || depths[row[c]] > depths[i] + 1)
+				return -1;
+	}
+	return 0;
+}
+
+
+int
+aho_corasick_image_load(aho_corasick_t *g, void *image, size_t size)
+{
+	aho_corasick_image_header_t *header = image;
+	aho_corasick_image_header_t expected;
+	char *base = image;
+	int i;
+
+	if (size < sizeof(aho_corasick_image_header_t) ||
+	    memcmp(header->magic, AHO_CORASICK_IMAGE_MAGIC,
+		   sizeof(header->magic)) != 0 ||
+	    header->version != AHO_CORASICK_IMAGE_VERSION ||
+	    header->byteorder != AHO_CORASICK_IMAGE_BYTEORDER ||
+	    header->sizeof_size != sizeof(size_t) ||
+	    (header->flags & ~AHO_CORASICK_IMAGE_TEXT) != 0 ||
+	    header->nstates == 0 ||
+	    header->nclasses == 0 ||
+	    header->nclasses > AHO_CORASICK_CHARACTERS)
+		return -1;
+
+	/* The tables must be exactly where we would have put them. */
+	g->newstate = header->nstates;
+	g->nclasses = header->nclasses;
+	g->nkeywords = header->nkeywords;
+	g->text = (header->flags & AHO_CORASICK_IMAGE_TEXT) != 0;
+	aho_corasick_image_layout(g, &expected);
+	if (header->size != expected.size || size < expected.size)
+		return -1;
+	for(i = 0; i < AHO_CORASICK_IMAGE_SECTIONS ;i++)
+		if (header->sections[i] != expected.sections[i])
+			return -1;
+
+	memcpy(g->classes, header->classes, AHO_CORASICK_CHARACTERS);
+	memcpy(g->folded, header->folded, AHO_CORASICK_CHARACTERS);
+	for(i = 0; i < AHO_CORASICK_CHARACTERS ;i++)
+	{
+		if (g->classes[i] >= g->nclasses)
+			return -1;
+		g->translate[i] = i;
+	}
+	if (aho_corasick_image_check(header, base) == -1)
+		return -1;
 
+	g->zerostate = NULL;
+	g->states = NULL;
+	g->outputs = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_OUTPUTS]);
+	g->keywords = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_KEYWORDS]);
+	g->depths = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_DEPTHS]);
+	g->fails = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_FAILS]);
+	g->dicts = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_DICTS]);
+	g->chars = g->text ? (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_CHARS]) : NULL;
+	g->delta = (aho_corasick_int_t *)
+		(base + header->sections[AHO_CORASICK_IMAGE_DELTA]);
+	g->image = image;
+	aho_corasick_makeskip(g);
 	return 0;
 }
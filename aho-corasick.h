@@ -34,23 +34,38 @@
 
 */
 
-#include "slist.h"
-
 #ifndef AHO_CORASICK_H
 #define AHO_CORASICK_H
 
+#include "arena.h"
+
 typedef unsigned int aho_corasick_int_t;
 
 #define AHO_CORASICK_CHARACTERS 256
 
+/* Keywords can be put in groups, up to AHO_CORASICK_GROUPS of them, and
+   a set of groups is a mask with a bit for each. */
+typedef unsigned PY_LONG_LONG aho_corasick_groups_t;
+
+#define AHO_CORASICK_GROUPS 64
+
+
 
+/* Transitions are not labeled by raw input bytes, but by the byte's
+   equivalence class, looked up through the classes[] table of the tree.
+   Until make() is called, every byte is in a class of its own.  make()
+   then lumps together all the bytes that don't occur in any keyword, since
+   no state can tell them apart, and numbers the remaining bytes in
+   increasing order.  Transition tables shrink from AHO_CORASICK_CHARACTERS
+   entries to nclasses entries. */
 
 /* A transition table has two possible implemementations:
 
    1.  A "dense" array.  Constant-time access, but expensive in terms of memory.
 
-   2.  A "sparse" linked list.  Linear time acces, but not too expensive in
-       terms of memory.
+   2.  A "sparse" sorted array of labels, alongside an array of the states
+       they lead to.  Linear time acces, but not too expensive in terms of
+       memory.  Both arrays live in a single allocation.
  */
 
 /* Defines the two types of transition table implementations we might want to
@@ -63,18 +78,33 @@ struct aho_corasick_transition_table {
 	union {
 		/* array is a pointer to an array of states. */
 		struct aho_corasick_state ** array;
-		slist_t* slist;
+		/* edges is NULL until the first transition is set. */
+		struct aho_corasick_sparse_edges * edges;
 	} data;
 };
 typedef struct aho_corasick_transition_table aho_corasick_transition_table_t;
 
 
-/* Represents a single labeled edge. */
-struct aho_corasick_labeled_edge {
-	unsigned char label;
-	struct aho_corasick_state *state;
+/* Header of the sparse representation.  It is followed in memory by
+   capacity state pointers, and then by capacity labels, of which the first
+   size are in use.  Use the macros below to get at the arrays. */
+struct aho_corasick_sparse_edges {
+	aho_corasick_int_t size;
+	aho_corasick_int_t capacity;
 };
-typedef struct aho_corasick_labeled_edge aho_corasick_labeled_edge_t;
+typedef struct aho_corasick_sparse_edges aho_corasick_sparse_edges_t;
+
+#define aho_corasick_sparse_states(e) \
+	((struct aho_corasick_state **) ((e) + 1))
+#define aho_corasick_sparse_labels(e) \
+	((unsigned char *) (aho_corasick_sparse_states(e) + (e)->capacity))
+#define aho_corasick_sparse_sizeof(capacity) \
+	(sizeof(aho_corasick_sparse_edges_t) + \
+	 (capacity) * (sizeof(struct aho_corasick_state *) + 1))
+
+/* Sparse tables only come in power-of-two capacities, from 1 up to
+   AHO_CORASICK_CHARACTERS.  This is how many different sizes there are. */
+#define AHO_CORASICK_SPARSE_SIZES 9
 
 
 
@@ -82,6 +112,8 @@ struct aho_corasick_state
 {
 	aho_corasick_int_t id;
 	aho_corasick_int_t depth;
+	/* Index of the keyword that ends here, if output is nonzero. */
+	aho_corasick_int_t keyword;
 	size_t output;
 	struct aho_corasick_state * fail;
 	aho_corasick_transition_table_t _transitions;
@@ -91,31 +123,263 @@ typedef struct aho_corasick_state aho_corasick_state_t;
 
 
 
+/* The two ways a finished tree can be searched:
+
+   1.  GOTO mode.  Follow the goto transitions of each state, chasing
+       failure transitions whenever there is no such arrow.
+
+   2.  DFA mode.  The failure transitions are folded into a full
+       deterministic transition table at make() time, so every input
+       symbol costs exactly one table lookup.  Expensive in terms of
+       memory: num_states * nclasses entries.
+ */
+typedef enum { AHO_CORASICK_GOTO_MODE = 0,
+	       AHO_CORASICK_DFA_MODE } aho_corasick_mode_t;
+
+
+/* While keywords are being added, states near the top of the tree get
+   dense tables, so that adding is quick.  make() then decides again for
+   each state, from how many transitions it really has: a state gets a
+   dense table of nclasses entries if it has at least fanout of them, and
+   a sparse one otherwise.  A fanout of 0 leaves it to make(), which goes
+   for dense once a quarter of the classes have a transition.  If budget
+   isn't AHO_CORASICK_NO_BUDGET, dense tables only go to states as long as
+   they fit in that many bytes, shallowest first, since searches spend
+   most of their time near the top of the tree.  The zerostate always gets
+   a dense table, outside of the budget. */
+struct aho_corasick_policy {
+	aho_corasick_int_t fanout;
+	size_t budget;
+};
+typedef struct aho_corasick_policy aho_corasick_policy_t;
+
+#define AHO_CORASICK_NO_BUDGET ((size_t) -1)
+
+
 struct aho_corasick
 {
 	aho_corasick_int_t newstate;
+	/* Number of distinct keywords added so far; they are numbered in the
+	   order they were first added. */
+	aho_corasick_int_t nkeywords;
 	aho_corasick_state_t *zerostate;
+
+	/* All of the states and their transition tables are allocated out of
+	   the arena, and given back in one go by aho_corasick_destroy().
+	   Sparse tables that outgrow their capacity are put on the
+	   spare_edges list for that capacity, to be reused by the next table
+	   that grows into it.  The full-width dense tables that states get
+	   while keywords are still being added live in dense_arena, which
+	   aho_corasick_maketree() throws away once it has compressed them. */
+	arena_t arena;
+	arena_t dense_arena;
+	aho_corasick_sparse_edges_t *spare_edges[AHO_CORASICK_SPARSE_SIZES];
+
+	/* Maps each input byte to its equivalence class; see above. */
+	unsigned char classes[AHO_CORASICK_CHARACTERS];
+	int nclasses;
+	/* Nonzero for every byte that occurs in some keyword. */
+	unsigned char used[AHO_CORASICK_CHARACTERS];
+
+	/* Every byte of a keyword, and of the input, is put through this
+	   table first, like folding case.  It starts out as the identity.
+	   make() folds it into classes[], so that searching doesn't pay for
+	   it, and then sets it back to the identity. */
+	unsigned char translate[AHO_CORASICK_CHARACTERS];
+	/* What translate[] was when make() folded it away, which images
+	   carry along, so that a tree loaded from one still knows it. */
+	unsigned char folded[AHO_CORASICK_CHARACTERS];
+
+	/* Nonzero if the keywords are UTF-8 encoded text, whose matches
+	   should be reported in characters rather than bytes.  Must be set
+	   before make(). */
+	int text;
+
+	/* How make() picks the transition table that each state ends up
+	   with; see aho_corasick_policy_t.  Must be set before make(). */
+	aho_corasick_policy_t policy;
+
+	/* The following are filled in by aho_corasick_maketree(), and are
+	   indexed by state id. */
+	aho_corasick_state_t **states;
+	aho_corasick_int_t *outputs;
+	aho_corasick_int_t *keywords;
+	aho_corasick_int_t *depths;
+	aho_corasick_int_t *fails;
+	/* Dictionary suffix links: the id of the nearest state along the
+	   failure chain that has an output, or 0 if there is none. */
+	aho_corasick_int_t *dicts;
+	/* In text mode, the number of characters from the zerostate to each
+	   state, which is the length of the state's keyword in characters.
+	   NULL otherwise. */
+	aho_corasick_int_t *chars;
+
+	/* The flat transition table of DFA mode: delta[id * nclasses +
+	   classes[byte]] is the id of the next state.  NULL in GOTO mode. */
+	aho_corasick_int_t *delta;
+
+	/* Filled in by make(), and by aho_corasick_image_load(): nonzero in
+	   starts[] for the bytes that take the zerostate anywhere but back to
+	   itself, which are the only bytes a match can start with.  nstarts
+	   counts them; if there's just the one, it's start.  skip is nonzero
+	   if there are few enough of them that searches should scan straight
+	   over the input that can't start a match whenever they're back in
+	   the zerostate. */
+	unsigned char starts[AHO_CORASICK_CHARACTERS];
+	int nstarts;
+	unsigned char start;
+	int skip;
+
+	/* Not NULL if the tree came from aho_corasick_image_load().  Then all
+	   of the id-indexed tables above point into that image, which belongs
+	   to the caller, and there are no state structures at all: zerostate
+	   and states are NULL, and the tree is always in DFA mode. */
+	void *image;
 };
 
 typedef struct aho_corasick aho_corasick_t;
 
+/* The symbol that an input byte stands for, whether or not the tree has
+   been made yet. */
+#define aho_corasick_symbol(g, byte) ((g)->classes[(g)->translate[byte]])
+
+
+
+/* A finished tree can be written out as a flat image: a header followed by
+   its id-indexed tables, each at an offset from the start of the image,
+   and aligned to 8 bytes.  Nothing in the image is a pointer, so it can be
+   mapped anywhere in memory and searched right where it sits.  Images are
+   only readable on the platform that wrote them. */
+
+#define AHO_CORASICK_IMAGE_MAGIC "AHOCORAS"
+#define AHO_CORASICK_IMAGE_VERSION 5
+#define AHO_CORASICK_IMAGE_BYTEORDER 0x01020304
+
+/* The tables in an image.  A section offset of 0 means the table isn't
+   there. */
+enum { AHO_CORASICK_IMAGE_OUTPUTS = 0,
+       AHO_CORASICK_IMAGE_DEPTHS,
+       AHO_CORASICK_IMAGE_FAILS,
+       AHO_CORASICK_IMAGE_DELTA,
+       AHO_CORASICK_IMAGE_KEYWORDS,
+       AHO_CORASICK_IMAGE_DICTS,
+       AHO_CORASICK_IMAGE_CHARS,	/* only in text mode */
+       AHO_CORASICK_IMAGE_TABLES,	/* how many of the sections are used */
+       AHO_CORASICK_IMAGE_SECTIONS = 16 };
+
+struct aho_corasick_image_header {
+	char magic[8];
+	aho_corasick_int_t version;
+	aho_corasick_int_t byteorder;
+	aho_corasick_int_t sizeof_size;
+	aho_corasick_int_t nstates;
+	aho_corasick_int_t nclasses;
+	aho_corasick_int_t nkeywords;
+	aho_corasick_int_t flags;
+	aho_corasick_int_t reserved;
+	unsigned char classes[AHO_CORASICK_CHARACTERS];
+	size_t size;
+	size_t sections[AHO_CORASICK_IMAGE_SECTIONS];
+	/* The translate table the tree was made with; classes[] has it
+	   folded in already. */
+	unsigned char folded[AHO_CORASICK_CHARACTERS];
+};
+typedef struct aho_corasick_image_header aho_corasick_image_header_t;
+
+/* Bits of the flags of an image. */
+#define AHO_CORASICK_IMAGE_TEXT 1
+
 
 /* Initializes the tree.  Returns 0 on success, -1 on failure. */
 int aho_corasick_init(aho_corasick_t *);
 
-/* Adds a new string to the tree, given that the string is of length n. */
+/* Adds a new string to the tree, given that the string is of length n.
+   Returns the index of the keyword, which is the same index it got the
+   first time if the string was already in the tree, or -1 on failure. */
 int aho_corasick_addstring(aho_corasick_t *,unsigned char *, Py_ssize_t n);
 
+/* Where the last keyword added with aho_corasick_addstring_path() went:
+   its bytes, and the state after each of them, from the zerostate in
+   states[0] on.  The next keyword starts from where the two part ways,
+   rather than walking down from the zerostate again, which saves the most
+   when the keywords come in sorted order. */
+struct aho_corasick_path {
+	unsigned char *keyword;
+	aho_corasick_state_t **states;
+	size_t n;
+	size_t capacity;
+};
+typedef struct aho_corasick_path aho_corasick_path_t;
+
+void aho_corasick_path_init(aho_corasick_path_t *);
+void aho_corasick_path_destroy(aho_corasick_path_t *);
+
+/* Same as aho_corasick_addstring(), but picks up from the path of the last
+   keyword added along the same path.  Returns -1 on failure. */
+int aho_corasick_addstring_path(aho_corasick_t *, aho_corasick_path_t *,
+				unsigned char *, Py_ssize_t n);
+
 /* Finalizes construction by setting up the failrue transitions, as
-   well as the goto transitions of the zerostate. */
-int aho_corasick_maketree(aho_corasick_t *);
+   well as the goto transitions of the zerostate.  In DFA mode, also builds
+   the flat transition table.  Returns 0 on success, -1 on failure. */
+int aho_corasick_maketree(aho_corasick_t *, aho_corasick_mode_t);
+
+/* aho_corasick_maketree() in pieces, so that the states of each level can
+   be shared out between threads.  aho_corasick_build_begin() does
+   everything that allocates memory, and lines the states up breadth-first
+   in order, the zerostate first.  After that, the states of each level,
+   order[from] up to aho_corasick_build_level(build, from), can go through
+   aho_corasick_build_states() in any split, at the same time, once the
+   levels above are done.  aho_corasick_build_end() finishes up.  The tree
+   comes out the same whichever way it's split. */
+struct aho_corasick_build {
+	aho_corasick_state_t **order;
+	aho_corasick_int_t n;
+	unsigned char bytes[AHO_CORASICK_CHARACTERS];	/* behind each class */
+};
+typedef struct aho_corasick_build aho_corasick_build_t;
+
+/* Returns 0 on success, -1 on failure. */
+int aho_corasick_build_begin(aho_corasick_t *, aho_corasick_build_t *,
+			     aho_corasick_mode_t);
+aho_corasick_int_t aho_corasick_build_level(aho_corasick_build_t *,
+					    aho_corasick_int_t from);
+void aho_corasick_build_states(aho_corasick_t *, aho_corasick_build_t *,
+			       aho_corasick_int_t from, aho_corasick_int_t to);
+void aho_corasick_build_end(aho_corasick_t *, aho_corasick_build_t *);
+
+/* Looks a string of length n up in a made tree.  Returns the index of the
+   keyword, or -1 if it isn't one. */
+int aho_corasick_find(aho_corasick_t *, unsigned char *, size_t n);
+
+/* Keeps the dead flags of the states of a made tree up to date, for
+   searches to act as if the states that only lead to removed keywords
+   weren't there; see aho_corasick_options_t.  kill() is called once the
+   keyword in the string of length n has been marked in removed, and
+   marks as dead the states on the way to it that no keyword left in the
+   tree goes through.  If the tree has had its groups set, into groups,
+   the states also lose the keyword's groups there, for which it needs the
+   masks that aho_corasick_setgroups() was given.  It returns 0 on
+   success, -1 on memory allocation failure.  revive() is called when the
+   keyword comes back, and marks every state on the way to it live again,
+   with the groups of the keyword's mask; dead can be NULL, if it was the
+   last removed keyword.  Either way, groups is NULL if there are none. */
+int aho_corasick_kill(aho_corasick_t *, unsigned char *, size_t n,
+		      unsigned char *dead, const unsigned char *removed,
+		      const aho_corasick_groups_t *masks,
+		      aho_corasick_groups_t *groups);
+void aho_corasick_revive(aho_corasick_t *, unsigned char *, size_t n,
+			 unsigned char *dead, aho_corasick_groups_t mask,
+			 aho_corasick_groups_t *groups);
 
 
 /* Set a transition arrow from this from_state, via a symbol, to a
-   to_state. */
-void aho_corasick_goto_set(aho_corasick_state_t *from_state,
-			   unsigned char symbol,
-			   aho_corasick_state_t *to_state);
+   to_state.  Here and in aho_corasick_goto_get(), the symbol is a byte
+   class, not a raw byte.  Returns 0 on success, -1 on failure. */
+int aho_corasick_goto_set(aho_corasick_t *g,
+			  aho_corasick_state_t *from_state,
+			  unsigned char symbol,
+			  aho_corasick_state_t *to_state);
 
 /* Returns the transition state.  If no such state exists, returns NULL. */
 aho_corasick_state_t* aho_corasick_goto_get(aho_corasick_state_t *state,
@@ -123,17 +387,297 @@ aho_corasick_state_t* aho_corasick_goto_get(aho_corasick_state_t *state,
 
 
 
-/* Helper functions to search for matches in a aho corasick tree. */
-aho_corasick_int_t ahocorasick_KeywordTree_search_helper(aho_corasick_t *,unsigned char *,size_t, size_t, size_t *, size_t *);
-aho_corasick_int_t ahocorasick_KeywordTree_search_long_helper(aho_corasick_t *,unsigned char *,size_t, size_t, size_t *, size_t *);
+/* What the search helpers did, counted if they're given somewhere to count
+   it in the options. */
+struct aho_corasick_counters {
+	size_t bytes;		/* input bytes gone over, skipped ones too */
+	size_t skipped;		/* bytes skipped over in the zerostate */
+	size_t transitions;	/* steps from a state to the next */
+	size_t fails;		/* failure transitions followed on the way */
+	size_t matches;		/* matches found */
+};
+typedef struct aho_corasick_counters aho_corasick_counters_t;
+
+
+/* The most deltas a search can be given; see aho_corasick_options_t. */
+#define AHO_CORASICK_DELTAS 32
+
+/* What a search can be asked to do besides looking for the keywords of the
+   tree.  Any of these can be NULL. */
+struct aho_corasick_options {
+	/* A table of AHO_CORASICK_CHARACTERS entries, nonzero for the bytes
+	   that separate words.  A match only counts if it doesn't start or
+	   end in the middle of a word.  Only the search helpers look at
+	   this. */
+	const unsigned char *boundaries;
+
+	/* Nonzero for the index of each keyword that has been removed since
+	   make(), and doesn't match any more. */
+	const unsigned char *removed;
+
+	/* Nonzero for each state of the tree that no keyword that's left
+	   goes through, as aho_corasick_kill() marks them.  The search skips
+	   them, going on down the failure chain, so that it finds what a
+	   tree made without the removed keywords would.  The deltas never
+	   have removed keywords in them, so this is only for the tree. */
+	const unsigned char *dead;
+
+	/* Made trees of the keywords added since make(), the deltas, which
+	   are searched in step with the tree, as if their keywords were in
+	   it.  Their keywords tables give the indexes the keywords got in
+	   the tree they were added to.  Each keyword is in one of them at
+	   most.  The first ndeltas are used. */
+	struct aho_corasick *deltas[AHO_CORASICK_DELTAS];
+	int ndeltas;
+
+	/* Where to count what the search does.  Searches that count take
+	   the slower way through, even if there's nothing else to the
+	   options, so only set this when the numbers are wanted. */
+	aho_corasick_counters_t *counters;
+
+	/* The groups that each keyword is in, by keyword index.  If it's
+	   set, only the keywords in one of the wanted groups match. */
+	const aho_corasick_groups_t *groups;
+	aho_corasick_groups_t wanted;
+	/* What aho_corasick_setgroups() filled in for the tree, and for each
+	   delta, which the search needs along with groups.  NULL if it
+	   hasn't been called, which only happens if there are no groups. */
+	const aho_corasick_groups_t *tree_groups;
+	const aho_corasick_groups_t *delta_groups[AHO_CORASICK_DELTAS];
+};
+typedef struct aho_corasick_options aho_corasick_options_t;
 
-/* type of any function that helps with search. */
-typedef aho_corasick_int_t (*ahocorasick_KeywordTree_search_helper_t)
-  (aho_corasick_t*, unsigned char *, size_t, size_t, size_t*, size_t*);
 
+/* One match: where it starts and ends, the index of the keyword, and how
+   many characters that is, in text mode. */
+struct aho_corasick_match {
+	size_t start;
+	size_t end;
+	aho_corasick_int_t keyword;
+	aho_corasick_int_t chars;
+};
+typedef struct aho_corasick_match aho_corasick_match_t;
+
+/* A growable array of matches. */
+struct aho_corasick_matches {
+	aho_corasick_match_t *data;
+	size_t size;
+	size_t capacity;
+};
+typedef struct aho_corasick_matches aho_corasick_matches_t;
+
+
+/* Helper functions to search for matches in a aho corasick tree.  If
+   there's a match from startpos on, they fill in the match and return 1;
+   otherwise, they return 0.
+
+   A match is the keyword of the state the search is in, if it has one.
+   With options, the search is in the state that a tree of just the
+   keywords that are left would be in, the keywords added since make()
+   included, and that state's keyword has to pass the checks of the
+   options as well: a keyword that's turned down isn't made up for by a
+   shorter one that ends in the same place.  So the options never find a
+   match that a tree made of the keywords they leave wouldn't. */
+int ahocorasick_KeywordTree_search_helper(aho_corasick_t *,unsigned char *,size_t, size_t, const aho_corasick_options_t *, aho_corasick_match_t *);
+int ahocorasick_KeywordTree_search_long_helper(aho_corasick_t *,unsigned char *,size_t, size_t, const aho_corasick_options_t *, aho_corasick_match_t *);
 
-/* Destroys a tree, deallocating memory. */
+/* type of any function that helps with search. */
+typedef int (*ahocorasick_KeywordTree_search_helper_t)
+  (aho_corasick_t*, unsigned char *, size_t, size_t,
+   const aho_corasick_options_t *, aho_corasick_match_t *);
+
+/* Fills in a boundaries table for the search helpers where words are made
+   of ASCII letters, digits, underscores and the bytes of multibyte UTF-8
+   characters, and everything else separates them. */
+void aho_corasick_word_boundaries(unsigned char *);
+
+
+void aho_corasick_matches_init(aho_corasick_matches_t *);
+void aho_corasick_matches_destroy(aho_corasick_matches_t *);
+
+/* Appends every occurrence of every keyword from startpos on to the
+   matches, nested and overlapping ones included, in one pass over the
+   string.  Matches come out in order of their end, and longest first
+   among those that end at the same place.  Returns 0 on success, -1 on
+   memory allocation failure. */
+int ahocorasick_KeywordTree_every_helper(aho_corasick_t *,
+					 unsigned char *, size_t, size_t,
+					 const aho_corasick_options_t *,
+					 aho_corasick_matches_t *);
+
+/* Feeds the next n bytes of a stream through the tree, starting from the
+   states that states holds, the tree's and then each delta's, so 1 +
+   AHO_CORASICK_DELTAS of them at most, and leaves
+   the states the stream ends up in there, so that the next call picks up
+   where this one left off.  offset is the position of the first byte in
+   the whole stream, and the matches that get appended are positioned in
+   the whole stream too.  If all is
+   set, every keyword occurrence is reported, as with the every helper;
+   otherwise, matches are the same ones the findall helper would find in
+   the whole stream.  Returns 0 on success, -1 on memory allocation
+   failure. */
+int ahocorasick_KeywordTree_feed_helper(aho_corasick_t *,
+					unsigned char *, size_t, size_t,
+					const aho_corasick_options_t *,
+					aho_corasick_int_t *, int,
+					aho_corasick_matches_t *);
+
+/* Like the feed helper with all set, but for a string that's searched a
+   match at a time: feeds the bytes of the string from *pos on through the
+   tree, starting from the states that states holds, and stops after the
+   first byte that ends a keyword occurrence, having appended all of those
+   that end there to the matches.  Leaves *pos just past that byte, or at
+   n if there was none, and the states there, for the next call to go on
+   from.  Returns 0 on success, -1 on memory allocation failure. */
+int ahocorasick_KeywordTree_next_helper(aho_corasick_t *,
+					unsigned char *, size_t, size_t *,
+					const aho_corasick_options_t *,
+					aho_corasick_int_t *,
+					aho_corasick_matches_t *);
+
+/* Text mode.  A character is whatever a Python unicode string counts as
+   one: on narrow builds of Python, that makes characters beyond the Basic
+   Multilingual Plane count as two. */
+
+/* Returns the number of characters in the n bytes of a UTF-8 string. */
+size_t aho_corasick_utf8_chars(unsigned char *, size_t);
+
+/* Returns the byte offset of the character at offset chars in the n bytes
+   of a UTF-8 string, or n if the string has fewer characters. */
+size_t aho_corasick_utf8_offset(unsigned char *, size_t, size_t chars);
+
+/* Turns the byte offsets of matches into character offsets.  The matches
+   must all end within the n bytes of string, which start at byte offset
+   bytes and character offset chars of the whole text.  The matches can
+   come in any order, but the closer to sorted by end they are, the less
+   of the string gets looked at more than once. */
+void aho_corasick_matches_to_chars(unsigned char *, size_t,
+				   size_t bytes, size_t chars,
+				   aho_corasick_matches_t *);
+
+/* Appends every match that the search helper finds, from startpos on, to
+   the matches.  Each search picks up where the last match ended, or just
+   past where it started if allow_overlaps is set.  The options are passed
+   on to the helper.  Only reads the tree, so it's safe to call from many
+   threads at once.  Returns 0 on success, -1 on memory allocation
+   failure. */
+int ahocorasick_KeywordTree_findall_helper(aho_corasick_t *,
+					   ahocorasick_KeywordTree_search_helper_t,
+					   unsigned char *, size_t, size_t,
+					   const aho_corasick_options_t *,
+					   int, aho_corasick_matches_t *);
+
+
+/* Counts the matches that the findall helper would find, without keeping
+   them.  If counts isn't NULL, it's bumped at the index of the keyword of
+   each match, so it needs an entry for every keyword.  Returns the total
+   number of matches. */
+size_t ahocorasick_KeywordTree_count_helper(aho_corasick_t *,
+					    ahocorasick_KeywordTree_search_helper_t,
+					    unsigned char *, size_t, size_t,
+					    const aho_corasick_options_t *,
+					    int, long *);
+
+
+/* Destroys a tree, deallocating memory.  The image of a loaded tree is
+   left alone. */
 void aho_corasick_destroy(aho_corasick_t *);
 
 
+/* What a tree looks like, as aho_corasick_stats() sees it. */
+struct aho_corasick_stats {
+	aho_corasick_int_t states;
+	/* How many states have dense and sparse transition tables.  A loaded
+	   image has no tables but its DFA rows, so neither. */
+	aho_corasick_int_t dense;
+	aho_corasick_int_t sparse;
+	/* depths[d] states sit d levels down, for d up to maxdepth. */
+	aho_corasick_int_t maxdepth;
+	size_t *depths;
+	/* The most failure transitions between a state and the zerostate,
+	   and the most keywords on the dictionary suffix chain of a state,
+	   not counting its own.  Only known once the tree is made; 0
+	   before. */
+	aho_corasick_int_t max_fail_chain;
+	aho_corasick_int_t max_dict_chain;
+	/* Bytes held by the arenas, by the id-indexed tables, by the DFA
+	   table, and by the image the tree was loaded from. */
+	size_t arena_bytes;
+	size_t table_bytes;
+	size_t dfa_bytes;
+	size_t image_bytes;
+};
+typedef struct aho_corasick_stats aho_corasick_stats_t;
+
+/* Fills in the stats of a tree, made or not.  Returns 0 on success, -1 on
+   memory allocation failure.  aho_corasick_stats_destroy() gives back what
+   the stats hold on to. */
+int aho_corasick_stats(aho_corasick_t *, aho_corasick_stats_t *);
+void aho_corasick_stats_destroy(aho_corasick_stats_t *);
+
+
+/* How many masks aho_corasick_setgroups() fills in for a made tree. */
+#define aho_corasick_groupsize(g) (2 * (size_t) (g)->newstate + 1)
+
+/* Fills in the groups of the states of a finished tree, or one loaded
+   from an image, from the groups that each keyword is in, by the index it
+   has in the tree's keywords[] table.  They go into groups, which has
+   aho_corasick_groupsize() masks, and is the caller's, so that it can
+   hand searches a copy to keep while it changes its own:
+
+     groups[id] has the groups of all of the keywords on the dictionary
+     suffix chain of state id, its own included, so that a search for only
+     some of the groups can pass over the states that don't end any of
+     theirs.
+
+     groups[newstate + id] has the groups of all of the keywords that go
+     through state id, the keyword it ends included, but not the ones
+     flagged in removed, which can be NULL.  A search for only some of the
+     groups passes over the states that none of theirs go through, as a
+     tree of just those keywords wouldn't have them.
+
+     groups[2 * newstate] has the groups that keywords have joined since,
+     which the chains can't tell about, and starts out empty.
+
+   Returns 0 on success, -1 on memory allocation failure. */
+int aho_corasick_setgroups(aho_corasick_t *, const aho_corasick_groups_t *,
+			   const unsigned char *removed,
+			   aho_corasick_groups_t *groups);
+
+/* Adds the groups of the mask to the groups of each state on the way to
+   the keyword in the string of length n, which has just joined them, and
+   to the groups joined since.  A removed keyword only goes in the latter,
+   as it doesn't go through the states any more. */
+void aho_corasick_joingroup(aho_corasick_t *, unsigned char *, size_t n,
+			    aho_corasick_groups_t, int removed,
+			    aho_corasick_groups_t *groups);
+
+
+/* Puts the goto transitions of a finished tree, or one loaded from an
+   image, into src, labels and dst, one (state id, byte, state id) triple
+   to each transition, and returns how many there are.  Transitions back to
+   the zerostate are left out.  A transition is there once for every byte
+   that takes it, so fold_case doubles up the ones on letters.  They come
+   in order of the state they leave.  With NULL arrays, only counts
+   them. */
+size_t aho_corasick_edges(aho_corasick_t *, long *src, long *labels,
+			  long *dst);
+
+
+/* Returns the number of bytes in the image of a finished tree. */
+size_t aho_corasick_image_size(aho_corasick_t *);
+
+/* Writes the image of a finished tree into a buffer of
+   aho_corasick_image_size() bytes, which only has to be aligned for
+   aho_corasick_int_t.  Returns 0 on success, -1 on memory allocation
+   failure. */
+int aho_corasick_image_write(aho_corasick_t *, void *);
+
+/* Turns a destroyed (or never initialized) tree into a finished tree that
+   searches the image of the given size in place.  The image must stay put,
+   aligned to 8 bytes, until the tree is destroyed.  Returns 0 on success,
+   -1 if this isn't an image we can read. */
+int aho_corasick_image_load(aho_corasick_t *, void *, size_t);
+
+
 #endif
@@ -1,5 +1,8 @@
 ## fixme: add documentation
 
+import mmap
+import os
+
 import _ahocorasick
 
 
@@ -11,6 +14,8 @@ class KeywordTree(_ahocorasick.KeywordTree):
 
 ## Most of the methods here are just delegated over to the underlying
 ## C KeywordTree.  But we add a few more convenience functions here.
+## findall() and findall_long() live in C now, so that a whole block
+## gets scanned in one call.
 
     def chases(self, sourceStream):
         for block in sourceStream:
@@ -18,42 +23,61 @@ class KeywordTree(_ahocorasick.KeywordTree):
                 yield (block, match)
 
 
-    def findall(self, sourceBlock, allow_overlaps=0):
-        """Returns all the search matches in the source block.
-
-        If allow_overlaps is true, then we allow subsequent matches to
-        overlap."""
-        startpos = 0
-        while True:
-            match = self.search(sourceBlock, startpos)
-            if not match:
-                break
-            yield match
-            if allow_overlaps:
-                startpos = match[0] + 1
-            else:
-                startpos = match[1]
-        
-        
     def chases_long(self, sourceStream):
         for block in sourceStream:
             for match in self.findall_long(block):
                 yield (block, match)
 
 
-    def findall_long(self, sourceBlock, allow_overlaps=0):
-        """Returns all the search matches in the source block.
+    def from_iterable(cls, keywords, mode="goto", **kwargs):
+        """Makes a tree out of the keywords, or (keyword, value) pairs,
+        that an iterable gives, adding them all with add_many() and then
+        calling make(mode).  Any other arguments go to the constructor."""
+        tree = cls(**kwargs)
+        tree.add_many(keywords)
+        tree.make(mode)
+        return tree
+    from_iterable = classmethod(from_iterable)
+
+
+    def search_file(self, path, **kwargs):
+        return self._scan_file(self.search, path, kwargs)
+
+
+    def findall_file(self, path, **kwargs):
+        return self._scan_file(self.findall, path, kwargs)
+
+
+    def _scan_file(self, method, path, kwargs):
+        """Maps the file at path into memory, and calls the search method on
+        it, so the file is searched in place instead of read into a
+        string."""
+        f = open(path, 'rb')
+        try:
+            ## mmap refuses to map empty files.
+            if os.fstat(f.fileno()).st_size == 0:
+                return method("", **kwargs)
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return method(m, **kwargs)
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+
+    def __reduce__(self):
+        return (_loads, (self.__class__, self.dumps(), self._values,
+                         self._groups, self._group_masks()))
+
 
-        If allow_overlaps is true, then we allow subsequent matches to
-        overlap.  """
-        startpos = 0
-        while True:
-            match = self.search_long(sourceBlock, startpos)
-            if not match:
-                break
-            yield match
-            if allow_overlaps:
-                startpos = match[0] + 1
-            else:
-                startpos = match[1]
 
+def _loads(cls, data, values=(), groups=(), masks=None):
+    """Unpickles a KeywordTree from the image returned by dumps(), the
+    values that were given to add(), and the groups the keywords are in."""
+    tree = cls.loads(data)
+    tree._values[:] = values
+    tree._groups[:] = groups
+    if masks is not None:
+        tree._set_group_masks(masks)
+    return tree
@@ -6,25 +6,29 @@ mimicing the example FSM from the Graphviz gallery here:
 The only function that's intended for the public is dotty().
 Everything else is meant to be private.
 
-This code is really really messy.  I'm sorry!  *grin*
+The tree comes out of KeywordTree.export() in one go, so there's no
+walking it a State at a time, and no recursion to run out of.
 """
 
 
-def dotty(kwtree, name="finite_state_machine"):
-    """Returns a string that represents the dot file."""
-    zerostate = kwtree.zerostate()
-    out_names = []
-    for child in children(zerostate):
-	out_names.extend(map(state_name, output_states(zerostate)))
-    edge_triplets = []
-    for (label, child) in child_edges(zerostate):
-	edge_triplets.append((zerostate, label, child))
-	edge_triplets.extend(all_edges(child))
-    edge_names = map(lambda (s1, label, s2): 
-		     '%s -> %s [ label = "%s"]' % (state_name(s1), 
-						   state_name(s2),
-						   chr(label)),
-		     edge_triplets)
+def dotty(kwtree, name="finite_state_machine", max_depth=None,
+          max_states=None):
+    """Returns a string that represents the dot file.  Big trees make
+    graphs that are no use to look at: max_depth leaves out the states
+    deeper than that, and max_states keeps only that many states,
+    the shallowest ones."""
+    export = kwtree.export()
+    kept = kept_states(export["depths"], max_depth, max_states)
+    outputs = export["outputs"]
+    out_names = [state_name(state) for state in range(1, len(kept))
+                 if kept[state] and outputs[state] != 0]
+    edge_names = ['%s -> %s [ label = "%s"]' % (state_name(src),
+                                                 state_name(dst),
+                                                 label_name(label))
+                  for src, label, dst in zip(export["src"],
+                                             export["labels"],
+                                             export["dst"])
+                  if kept[src] and kept[dst]]
     return """
 digraph %(name)s {
     rankdir=LR;
@@ -40,45 +44,28 @@ digraph %(name)s {
 	}
 
 
-def state_name(state):
-    return "STATE_%s" % state.id()
-
-
-def child_edges(state):
-    """Small utility function to get the edges."""
-    for label in state.labels():
-	if state.goto(label).id() != 0:
-	    yield (label, state.goto(label))
+def kept_states(depths, max_depth, max_states):
+    """Returns a list of flags, by state id, of the states to draw."""
+    order = sorted(range(len(depths)), key=depths.__getitem__)
+    if max_depth is not None:
+        order = [state for state in order if depths[state] <= max_depth]
+    if max_states is not None:
+        order = order[:max_states]
+    kept = [False] * len(depths)
+    for state in order:
+        kept[state] = True
+    return kept
 
 
-def children(state):
-    """Small utility function to get the neighbors.  Note: we filter out
-    anything with an id of 0."""
-    for label in state.labels():
-	if state.goto(label).id() != 0:
-	    yield state.goto(label)
-
-
-def all_edges(state):
-    """Returns a list of all (state, label, state) triplets reachable from
-    this state."""
-    if state == None:
-	return []
-    edges = []
-    for edge, child in child_edges(state):
-	edges.append((state, edge, child))
-    for child in children(state):
-	edges.extend(all_edges(child))
-    return edges
+def state_name(state):
+    return "STATE_%s" % state
 
 
-def output_states(state):
-    """Return a list of all the output states reachable from this state."""
-    if state == None:
-	return []
-    outputs = []
-    if state.output() != None:
-	outputs.append(state)
-    for child in children(state):
-	outputs.extend(output_states(child))
-    return outputs
+def label_name(label):
+    """The byte a transition is labeled by, quoted for a dot string."""
+    char = chr(label)
+    if char in '"\\':
+        return "\\" + char
+    if not (" " <= char <= "~"):
+        return "\\\\x%02x" % label
+    return char
@@ -10,6 +10,7 @@ import unittest
 ## Adds the build library at the head to make testing easier.
 from distutils.util import get_platform
 import sys
+import threading
 sys.path.insert(0, "build/lib.%s-%s" % (get_platform(), sys.version[0:3]))
 ## print sys.path
 
@@ -201,6 +202,1004 @@ class AhoCorasickTest(unittest.TestCase):
 
 
 
+    def testFindallWithStartposAndManyMatches(self):
+        """findall() is done in one C call now; make sure it agrees
+        with repeated search() calls."""
+        self.tree.add("ab")
+        self.tree.add("bab")
+        self.tree.make()
+        queryString = "abab" * 1000
+        expected = []
+        startpos = 0
+        while True:
+            match = self.tree.search(queryString, startpos)
+            if not match:
+                break
+            expected.append(match)
+            startpos = match[1]
+        self.assertEqual(expected, self.tree.findall(queryString))
+        self.assertEqual(2000, len(expected))
+        self.assertEqual([(1, 4), (4, 6)],
+                         self.tree.findall("ababab", startpos=1))
+        self.assertEqual([(0, 2), (1, 4), (2, 4)],
+                         self.tree.findall("abab", allow_overlaps=1))
+        self.assertEqual([], self.tree.findall("abab", 4))
+
+
+
+    def testDfaModeAgreesWithGotoMode(self):
+        """make(mode="dfa") should only change how fast we search, not
+        what we find."""
+        import random
+        rand = random.Random(42)
+        keywords = ["".join([rand.choice("abc") for i in range(rand.randint(1, 6))])
+                    for j in range(40)]
+        dfa_tree = ahocorasick.KeywordTree()
+        for k in keywords:
+            self.tree.add(k)
+            dfa_tree.add(k)
+        self.tree.make()
+        dfa_tree.make(mode="dfa")
+        for trial in range(50):
+            query = "".join([rand.choice("abcd") for i in range(60)])
+            self.assertEqual(self.tree.search(query), dfa_tree.search(query))
+            self.assertEqual(self.tree.search_long(query),
+                             dfa_tree.search_long(query))
+            self.assertEqual(self.tree.findall(query, allow_overlaps=1),
+                             dfa_tree.findall(query, allow_overlaps=1))
+            self.assertEqual(self.tree.findall_long(query),
+                             dfa_tree.findall_long(query))
+
+
+    def testEveryByteInAKeyword(self):
+        """When every byte occurs in some keyword, no two bytes can
+        share a class."""
+        dfa_tree = ahocorasick.KeywordTree()
+        for i in range(256):
+            self.tree.add(chr(i) + chr(255 - i))
+            dfa_tree.add(chr(i) + chr(255 - i))
+        self.tree.make()
+        dfa_tree.make(mode="dfa")
+        for tree in (self.tree, dfa_tree):
+            self.assertEqual((1, 3), tree.search("\x01\x00\xff\x02"))
+            self.assertEqual([(0, 2), (2, 4)],
+                             tree.findall("\x7f\x80\x80\x7f"))
+            self.assertEqual([255], tree.zerostate().goto(0).labels())
+            self.assertEqual(range(256), tree.zerostate().labels())
+
+
+    def testDeepStateWithManyChildren(self):
+        """Deep states keep their transitions in a sorted array that
+        grows as keywords get added, in whatever order."""
+        labels = range(256)
+        import random
+        random.Random(7).shuffle(labels)
+        for i in labels:
+            self.tree.add("abcd" + chr(i))
+        self.tree.make()
+        deep = self.tree.zerostate().goto(ord('a')).goto(ord('b')) \
+                   .goto(ord('c')).goto(ord('d'))
+        self.assertEqual(range(256), deep.labels())
+        for i in labels:
+            self.assertEqual(5, deep.goto(i).output())
+            self.assertEqual((1, 6), self.tree.search("xabcd" + chr(i)))
+
+
+    def testVeryLongKeyword(self):
+        """Tearing down a tree doesn't recurse down its states anymore,
+        so a very deep tree shouldn't blow the C stack."""
+        longString = "ab" * 100000
+        self.tree.add(longString)
+        self.tree.add("b")
+        self.tree.make()
+        self.assertEqual((0, len(longString)),
+                         self.tree.search_long(longString))
+        self.tree = None
+
+
+    def testSaveAndLoad(self):
+        import os, tempfile
+        for mode in ("goto", "dfa"):
+            tree = ahocorasick.KeywordTree()
+            for k in ["he", "she", "his", "hers", "\0\xff"]:
+                tree.add(k)
+            tree.make(mode=mode)
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                tree.save(path)
+                loaded = ahocorasick.KeywordTree.load(path)
+            finally:
+                os.unlink(path)
+            self.assert_(isinstance(loaded, ahocorasick.KeywordTree))
+            query = "ushers and his \0\xff she"
+            self.assertEqual(tree.findall(query), loaded.findall(query))
+            self.assertEqual(tree.findall_long(query),
+                             loaded.findall_long(query))
+            self.assertRaises(AssertionError, loaded.zerostate)
+            ## A loaded tree can be saved all over again.
+            self.assertEqual(tree.dumps(), loaded.dumps())
+            ## ... and added to, like any made tree.
+            loaded.add("more")
+            self.assertEqual([(0, 4)], loaded.findall("more"))
+
+
+    def testPickle(self):
+        import pickle
+        self.tree.add("python")
+        self.tree.add("perl")
+        self.tree.make()
+        unpickled = pickle.loads(pickle.dumps(self.tree))
+        self.assertEqual([(0, 4), (9, 15)],
+                         unpickled.findall("perl and python"))
+
+
+    def testLoadingGarbageRaisesValueError(self):
+        self.assertRaises(ValueError, ahocorasick.KeywordTree.loads, "")
+        self.assertRaises(ValueError, ahocorasick.KeywordTree.loads,
+                          "AHOCORAS" + "\0" * 1000)
+        self.tree.add("foo")
+        self.tree.make()
+        self.assertRaises(ValueError, ahocorasick.KeywordTree.loads,
+                          self.tree.dumps()[:-1])
+
+
+    def testLoadingCorruptTablesRaisesValueError(self):
+        import struct
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        image = self.tree.dumps()
+        nstates = struct.unpack_from("I", image, 20)[0]
+        nkeywords = struct.unpack_from("I", image, 28)[0]
+        sections = struct.unpack_from("16P", image, 304)
+        outputs, depths, fails, delta, keywords, dicts = sections[:6]
+        last = (nstates - 1) * 4
+        self.assertEqual(4, nkeywords)
+        self.assertEqual(self.tree.findall("ushers"),
+                         ahocorasick.KeywordTree.loads(image).findall("ushers"))
+        for offset, value in ((delta, nstates), (delta + 4, nstates - 1),
+                              (fails + last, nstates), (fails + last, last // 4),
+                              (dicts + last, nstates), (outputs + last, 1),
+                              (keywords + last, nkeywords),
+                              (depths + last, nstates)):
+            corrupt = (image[:offset] + struct.pack("I", value) +
+                       image[offset + 4:])
+            self.assertRaises(ValueError, ahocorasick.KeywordTree.loads,
+                              corrupt)
+
+
+    def testSearchMany(self):
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        buffers = ["ushers", "", "this is his", "x" * 5000 + "hers"] * 20
+        expected = [self.tree.findall(b) for b in buffers]
+        self.assertEqual(expected, self.tree.search_many(buffers))
+        self.assertEqual(expected, self.tree.search_many(buffers, workers=4))
+        self.assertEqual([self.tree.findall_long(b, allow_overlaps=1)
+                          for b in buffers],
+                         self.tree.search_many(buffers, workers=3,
+                                               allow_overlaps=1, longest=1))
+        self.assertEqual([], self.tree.search_many([], workers=4))
+        self.assertRaises(AssertionError, self.tree.search_many, buffers,
+                          workers=0)
+        self.assertRaises(TypeError, self.tree.search_many, [42])
+
+
+    def testSearchManyBeforeMakeRaisesAssert(self):
+        self.tree.add("foo")
+        self.assertRaises(AssertionError, self.tree.search_many, ["foo"])
+
+
+    def testAddReturnsKeywordIndex(self):
+        self.assertEqual(0, self.tree.add("he"))
+        self.assertEqual(1, self.tree.add("she"))
+        self.assertEqual(0, self.tree.add("he"))
+        self.assertEqual(2, self.tree.add("hers"))
+
+
+    def testMatchesWithValues(self):
+        for mode in ("goto", "dfa"):
+            tree = ahocorasick.KeywordTree()
+            tree.add("he", value="HE")
+            tree.add("she")
+            tree.add("hers", value=("hers", 4))
+            tree.make(mode=mode)
+            self.assertEqual((1, 4, 1), tree.search("ushers", with_value=1))
+            self.assertEqual((2, 6, ("hers", 4)),
+                             tree.search_long("ushers", startpos=2,
+                                              with_value=True))
+            self.assertEqual([(1, 4, 1), (2, 4, "HE")],
+                             tree.findall("ushers", allow_overlaps=1,
+                                          with_value=1))
+            self.assertEqual([(1, 5, ("hers", 4))],
+                             tree.findall_long("xhers", with_value=1))
+            self.assertEqual([[(1, 4, 1)], [(0, 2, "HE")]],
+                             tree.search_many(["ushe", "he"], with_value=1))
+            self.assertEqual((1, 4), tree.search("ushers"))
+
+
+    def testReaddingKeywordReplacesValue(self):
+        self.tree.add("foo", value=1)
+        self.tree.add("foo")
+        self.assertEqual(0, self.tree.add("foo", value=2))
+        self.tree.make()
+        self.assertEqual((0, 3, 2), self.tree.search("foo", with_value=1))
+
+
+    def testValuesSurvivePickling(self):
+        import pickle
+        self.tree.add("perl", value="camel")
+        self.tree.add("python")
+        self.tree.make()
+        unpickled = pickle.loads(pickle.dumps(self.tree))
+        self.assertEqual([(0, 4, "camel"), (9, 15, 1)],
+                         unpickled.findall("perl and python", with_value=1))
+        loaded = ahocorasick.KeywordTree.loads(self.tree.dumps())
+        self.assertEqual([(0, 4, 0), (9, 15, 1)],
+                         loaded.findall("perl and python", with_value=1))
+
+
+    def testIterAll(self):
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        self.assertEqual([(1, 4), (2, 4), (2, 6)],
+                         list(self.tree.iter_all("ushers")))
+        self.assertEqual([(2, 6)], list(self.tree.iter_all("ushers",
+                                                           startpos=2))[1:])
+        self.assertEqual([], list(self.tree.iter_all("xyz")))
+        self.assertEqual([(1, 4, 1), (2, 4, 0)],
+                         list(self.tree.iter_all("ushe", with_value=1)))
+
+
+    def testIterAllScansAsItGoes(self):
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        self.tree.instrument()
+        matches = self.tree.iter_all("ushers" + "x" * 1000)
+        self.assertEqual(matches, iter(matches))
+        ## Only the query up to where a keyword ends is scanned.
+        self.assertEqual((1, 4), matches.next())
+        self.assertEqual(4, self.tree.counters()["bytes"])
+        self.assertEqual((2, 4), matches.next())
+        self.assertEqual(4, self.tree.counters()["bytes"])
+        ## A keyword added now isn't one the iterator looks for.
+        self.tree.add("x")
+        self.assertEqual([(2, 6)], list(matches))
+        self.assertEqual(1006, self.tree.counters()["bytes"])
+        self.assertRaises(StopIteration, matches.next)
+
+    def testIterAllText(self):
+        tree = ahocorasick.KeywordTree(text=True)
+        tree.add(u"\xe9t\xe9")
+        tree.add(u"t\xe9")
+        tree.make()
+        matches = tree.iter_all(u"l'\xe9t\xe9 \xe9t\xe9", startpos=1)
+        self.assertEqual((2, 5), matches.next())
+        self.assertEqual([(3, 5), (6, 9), (7, 9)], list(matches))
+
+    def testIterAllFindsNestedKeywords(self):
+        import random
+        random.seed(9)
+        words = set("".join(random.choice("ab") for i in range(
+            random.randint(1, 6))) for j in range(30))
+        text = "".join(random.choice("ab") for i in range(300))
+        expected = sorted((i, i + len(w)) for w in words
+                          for i in range(len(text)) if text.startswith(w, i))
+        for mode in ("goto", "dfa"):
+            tree = ahocorasick.KeywordTree()
+            for w in words:
+                tree.add(w)
+            tree.make(mode=mode)
+            for t in (tree, ahocorasick.KeywordTree.loads(tree.dumps())):
+                found = list(t.iter_all(text))
+                self.assertEqual(expected, sorted(found))
+                self.assertEqual(sorted(found, key=lambda m: (m[1], m[0])),
+                                 found)
+
+
+    def testStream(self):
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        text = "this is ushers and his sheep, hershey"
+        for size in (1, 2, 3, 7, len(text)):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+            stream = self.tree.stream()
+            found = []
+            for chunk in chunks:
+                found.extend(stream.feed(chunk))
+            self.assertEqual(self.tree.findall(text), found)
+            self.assertEqual(len(text), stream.offset)
+
+            stream = self.tree.stream(all=1, with_value=1)
+            found = []
+            for chunk in chunks:
+                found.extend(stream.feed(chunk))
+            self.assertEqual(list(self.tree.iter_all(text, with_value=1)),
+                             found)
+
+        stream = self.tree.stream()
+        self.assertEqual([], stream.feed("s"))
+        self.assertEqual([(0, 3)], stream.feed("he"))
+        stream.reset()
+        self.assertEqual(0, stream.offset)
+        self.assertEqual([(0, 2)], stream.feed("he"))
+
+
+    def testStreamBeforeMakeRaisesAssert(self):
+        self.tree.add("foo")
+        self.assertRaises(AssertionError, self.tree.stream)
+
+
+    def testSearchingBuffers(self):
+        import array
+        import mmap
+        self.tree.add("foo")
+        self.tree.add("bar")
+        self.tree.make()
+        text = "xfoo bar foo"
+        expected = self.tree.findall(text)
+        for query in (bytearray(text), memoryview(text), buffer(text),
+                      array.array('c', text)):
+            self.assertEqual(expected, self.tree.findall(query))
+            self.assertEqual((1, 4), self.tree.search(query))
+            self.assertEqual(expected, list(self.tree.iter_all(query)))
+        m = mmap.mmap(-1, len(text))
+        m.write(text)
+        self.assertEqual(expected, self.tree.findall(m))
+        self.assertEqual([expected, [(0, 3)]],
+                         self.tree.search_many([bytearray(text),
+                                                memoryview("bar")]))
+        self.assertEqual([(1, 4)], self.tree.stream().feed(bytearray("xbar")))
+        self.assertRaises(TypeError, self.tree.findall, 42)
+
+
+    def testEndpos(self):
+        self.tree.add("foo")
+        self.tree.add("bar")
+        self.tree.make()
+        text = "xfoo bar foo"
+        self.assertEqual([(1, 4), (5, 8)], self.tree.findall(text, endpos=8))
+        self.assertEqual([(1, 4)], self.tree.findall(text, endpos=7))
+        self.assertEqual([(5, 8)], self.tree.findall(text, 2, endpos=11))
+        self.assertEqual(None, self.tree.search(text, endpos=3))
+        self.assertEqual((1, 4), self.tree.search_long(text, endpos=100))
+        self.assertEqual([(5, 8)], list(self.tree.iter_all(text, startpos=4,
+                                                          endpos=9)))
+        self.assertRaises(AssertionError, self.tree.search, text, endpos=-1)
+
+
+    def testSearchFile(self):
+        import os
+        import tempfile
+        self.tree.add("foo")
+        self.tree.make()
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, "food " * 1000)
+            os.close(fd)
+            self.assertEqual((0, 3), self.tree.search_file(path))
+            matches = self.tree.findall_file(path, startpos=1)
+            self.assertEqual(999, len(matches))
+            self.assertEqual((4995, 4998), matches[-1])
+            open(path, "w").close()
+            self.assertEqual(None, self.tree.search_file(path))
+            self.assertEqual([], self.tree.findall_file(path))
+        finally:
+            os.remove(path)
+
+
+    def testFindallArray(self):
+        import array
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        starts, ends, keywords = self.tree.findall_array("ushers his")
+        self.assertEqual(array.array('l', [1, 7]), starts)
+        self.assertEqual(array.array('l', [4, 10]), ends)
+        self.assertEqual(array.array('l', [1, 2]), keywords)
+        self.assertEqual(self.tree.findall_long("ushers", allow_overlaps=1,
+                                                with_value=1),
+                         zip(*self.tree.findall_array("ushers",
+                                                      allow_overlaps=1,
+                                                      longest=1)))
+        self.assertEqual((array.array('l'),) * 3,
+                         self.tree.findall_array("xyz"))
+
+
+    def testFindallBatch(self):
+        for word in ("he", "she", "his", "hers"):
+            self.tree.add(word)
+        self.tree.make()
+        buffers = ["ushers", "", "this is his", "hehe"] * 10
+        docs, starts, ends, keywords = self.tree.findall_batch(buffers,
+                                                               workers=3)
+        expected = [(doc, start, end, keyword)
+                    for doc, buffer in enumerate(buffers)
+                    for start, end, keyword in self.tree.findall(
+                        buffer, with_value=1)]
+        self.assertEqual(expected, zip(docs, starts, ends, keywords))
+
+
+    def testTextMode(self):
+        tree = ahocorasick.KeywordTree(text=True)
+        tree.add(u"caf\xe9")
+        tree.add(u"\u4e2d\u6587")
+        tree.add(u"\xe9t\xe9")
+        tree.make()
+        text = u"un caf\xe9 \u4e2d\u6587, l'\xe9t\xe9"
+        self.assertEqual([(3, 7), (8, 10), (14, 17)], tree.findall(text))
+        self.assertEqual(tree.findall(text),
+                         tree.findall(text.encode("utf-8")))
+        self.assertEqual((8, 10), tree.search(text, startpos=4))
+        self.assertEqual(None, tree.search(text, startpos=4, endpos=9))
+        self.assertEqual([(8, 10, 1)],
+                         list(tree.iter_all(text, 4, endpos=10,
+                                            with_value=1)))
+        stream = tree.stream()
+        # Split the UTF-8 in the middle of the e-acute.
+        self.assertEqual([], stream.feed(text.encode("utf-8")[:7]))
+        self.assertEqual([(3, 7), (8, 10), (14, 17)],
+                         stream.feed(text.encode("utf-8")[7:]))
+        self.assertEqual(len(text), stream.offset)
+        loaded = ahocorasick.KeywordTree.loads(tree.dumps())
+        self.assertEqual(tree.findall(text), loaded.findall(text))
+
+
+    def testAstralCharactersInTextMode(self):
+        tree = ahocorasick.KeywordTree(text=True)
+        tree.add(u"\U0001F600b")
+        tree.make()
+        text = u"a\U0001F600\U0001F600b"
+        match = tree.search(text)
+        self.assertEqual(u"\U0001F600b", text[match[0]:match[1]])
+
+
+    def testFoldCase(self):
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree(fold_case=True)
+            tree.add("Hello")
+            tree.add("WORLD")
+            tree.make(mode)
+            self.assertEqual([(0, 5), (6, 11)],
+                             list(tree.findall("hELLo world")))
+            self.assertEqual((3, 8), tree.search("ok HELLO"))
+            tree = ahocorasick.KeywordTree.loads(tree.dumps())
+            self.assertEqual((0, 5), tree.search("world"))
+
+    def testFoldCaseAfterLoad(self):
+        import pickle
+        tree = ahocorasick.KeywordTree(fold_case=True)
+        tree.add("foo")
+        tree.make()
+        for loaded in (ahocorasick.KeywordTree.loads(tree.dumps()),
+                       pickle.loads(pickle.dumps(tree))):
+            self.assertEqual(1, loaded.add("BAR"))
+            self.assertEqual(1, loaded.add("bar"))
+            self.assertEqual([(0, 3), (4, 7)], loaded.findall("bar FOO"))
+
+    def testTranslate(self):
+        import string
+        tree = ahocorasick.KeywordTree(
+            translate=string.maketrans("0123456789", "#" * 10))
+        tree.add("v0.0")
+        tree.make()
+        self.assertEqual([(4, 8), (9, 13)],
+                         list(tree.findall("use v2.7 v3.1 or v2x")))
+        self.assertRaises(AssertionError, ahocorasick.KeywordTree,
+                          translate="short")
+
+    def testWordBoundaries(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add("alpha")
+        tree.add("bet")
+        tree.add("a b")
+        tree.make()
+        query = "alphabet alpha bet"
+        self.assertEqual((0, 5), tree.search(query))
+        self.assertEqual((9, 14), tree.search(query, word_boundaries=True))
+        self.assertEqual([(9, 14), (15, 18)],
+                         list(tree.findall(query, word_boundaries=True)))
+        self.assertEqual([(9, 14), (15, 18)],
+                         list(tree.findall_long(query,
+                                                word_boundaries=True)))
+        self.assertEqual((0, 5), tree.search("alpha-bet",
+                                             word_boundaries=True))
+        self.assertEqual(None, tree.search("alpha-bet",
+                                           word_boundaries=" "))
+
+    def testWordBoundariesFallBackToShorterKeyword(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add("o bar")
+        tree.add("bar")
+        tree.make()
+        ## "o bar" is what a search without boundaries finds, and it's
+        ## passed over rather than swapped for "bar".
+        self.assertEqual(None, tree.search("xo bar", word_boundaries=True))
+        self.assertEqual((1, 6), tree.search("-o bar", word_boundaries=True))
+
+    def testWordBoundariesOnlyFilter(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add("a b c")
+        tree.add("b")
+        tree.make()
+        self.assertEqual([], tree.findall("a b x", word_boundaries=True))
+        self.assertEqual(None, tree.search("a b x", word_boundaries=True))
+
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree()
+            for keyword in ["a", "ab", "b c", "c", "abc d", "d"]:
+                tree.add(keyword)
+            tree.make(mode)
+            for query in ["ab", "a b c d", "abc d", "ab c", "x abc dd d"]:
+                for overlaps in (False, True):
+                    plain = tree.findall(query, allow_overlaps=overlaps)
+                    bounded = tree.findall(query, allow_overlaps=overlaps,
+                                           word_boundaries=True)
+                    self.assertTrue(set(bounded) <= set(plain))
+                    self.assertEqual(len(bounded),
+                                     tree.count(query, word_boundaries=True,
+                                                allow_overlaps=overlaps))
+                plain = tree.findall_long(query)
+                bounded = tree.findall_long(query, word_boundaries=True)
+                self.assertTrue(set(bounded) <= set(plain))
+                match = tree.search(query, word_boundaries=True)
+                self.assertTrue(match is None or
+                                match in tree.findall(query))
+
+    def testAddAfterMake(self):
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree()
+            tree.add("he")
+            tree.add("hers")
+            tree.make(mode)
+            self.assertEqual(2, tree.add("she", "value"))
+            self.assertEqual(0, tree.add("he"))
+            self.assertEqual([(0, 3, "value"), (4, 6, 0)],
+                             tree.findall("she hers", with_value=True))
+            self.assertEqual([(0, 3, "value"), (1, 3, 0)],
+                             list(tree.iter_all("she", with_value=True)))
+            self.assertRaises(AssertionError, tree.dumps)
+
+    def testAddAfterMakeLongest(self):
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree()
+            tree.add("aaa")
+            tree.make(mode)
+            tree.add("a")
+            tree.add("bax")
+            self.assertEqual((1, 4), tree.search_long("baaab"))
+            self.assertEqual([(1, 4)], tree.findall_long("baaab"))
+
+    def testAddManyAfterMake(self):
+        words = ["k%d" % i for i in range(200)]
+        text = " ".join(words)
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree()
+            tree.add("k")
+            tree.make(mode)
+            ## A search after each add merges the deltas as it goes
+            ## instead of keeping one per add or remaking them all.
+            for word in words:
+                tree.add(word)
+                tree.search(text)
+                self.assert_(tree.stats()["deltas"] <= 9)
+            self.assertEqual(201, tree.stats()["keywords"])
+            self.assertEqual(200, tree.stats()["added"])
+            fresh = ahocorasick.KeywordTree()
+            fresh.add("k")
+            for word in words:
+                fresh.add(word)
+            fresh.make(mode)
+            self.assertEqual(fresh.findall(text), tree.findall(text))
+            self.assertEqual(fresh.findall_long(text),
+                             tree.findall_long(text))
+            tree.remove("k3")
+            fresh.remove("k3")
+            self.assertEqual(fresh.findall_long(text),
+                             tree.findall_long(text))
+
+    def testRemove(self):
+        self.tree.add("he")
+        self.tree.add("she")
+        self.tree.add("his")
+        self.assertRaises(AssertionError, self.tree.remove, "she")
+        self.tree.make()
+        self.tree.remove("she")
+        self.assertEqual([(1, 3), (4, 7)], self.tree.findall("she his"))
+        self.assertRaises(ValueError, self.tree.remove, "she")
+        self.assertRaises(ValueError, self.tree.remove, "hers")
+        stream = self.tree.stream()
+        self.assertEqual(1, self.tree.add("she"))
+        self.assertEqual([(0, 3)], self.tree.findall("she"))
+        ## The stream still sees the keywords as they were.
+        self.assertEqual([(1, 3)], stream.feed("she"))
+
+    def testRemoveIsLikeNeverAdded(self):
+        tree = ahocorasick.KeywordTree()
+        for keyword in ["aaa", "a", "baaab"]:
+            tree.add(keyword)
+        tree.make()
+        tree.remove("baaab")
+        self.assertEqual((1, 4), tree.search_long("baaax"))
+        self.assertEqual([(1, 4)], tree.findall_long("baaax"))
+
+        tree = ahocorasick.KeywordTree()
+        for keyword in ["abc", "b", "zz"]:
+            tree.add(keyword)
+        tree.make()
+        tree.remove("zz")
+        self.assertEqual([], tree.findall("abx"))
+        self.assertEqual(None, tree.search("abx"))
+
+    def testRemoveMatchesTreeWithout(self):
+        keywords = ["he", "she", "his", "hers", "e", "sh", "is", "h"]
+        queries = ["ushers", "she his hers", "shis", "hhe", "sherse"]
+        for mode in ('goto', 'dfa'):
+            for removed in keywords:
+                tree = ahocorasick.KeywordTree()
+                other = ahocorasick.KeywordTree()
+                for keyword in keywords:
+                    tree.add(keyword)
+                    if keyword != removed:
+                        other.add(keyword)
+                tree.make(mode)
+                other.make(mode)
+                tree.remove(removed)
+                for query in queries:
+                    self.assertEqual(other.search(query),
+                                     tree.search(query))
+                    self.assertEqual(other.search_long(query),
+                                     tree.search_long(query))
+                    self.assertEqual(other.findall(query),
+                                     tree.findall(query))
+                    self.assertEqual(
+                        other.findall(query, allow_overlaps=True),
+                        tree.findall(query, allow_overlaps=True))
+                    self.assertEqual(other.findall_long(query),
+                                     tree.findall_long(query))
+
+    def testAddMany(self):
+        other = ahocorasick.KeywordTree()
+        words = ["pear", "apple", ("app", 1), "apply", "pea", "apple"]
+        self.tree.add_many(iter(words))
+        for word in words:
+            if isinstance(word, tuple):
+                other.add(*word)
+            else:
+                other.add(word)
+        self.tree.make()
+        other.make()
+        self.assertEqual(other.findall("apply a pear", with_value=True),
+                         self.tree.findall("apply a pear", with_value=True))
+        self.assertEqual([(0, 3, 1)],
+                         list(self.tree.findall("app!", with_value=True)))
+        self.assertRaises(AssertionError, self.tree.add_many, ["ok", ""])
+        self.assertEqual(5, self.tree.add("ok"))
+
+    def testFromIterable(self):
+        tree = ahocorasick.KeywordTree.from_iterable(
+            sorted([("ab", 1), ("abc", 2), "b", "bcd"]), mode="dfa",
+            fold_case=True)
+        self.assertEqual([(0, 3), (3, 6)], list(tree.findall_long("ABCBCD")))
+        self.assertEqual((0, 3, 2), tree.search_long("abcd", with_value=True))
+
+    def testMakeWithWorkers(self):
+        words = ["%x%x" % (i, i * 7919) for i in range(5000)]
+        for mode in ("goto", "dfa"):
+            trees = []
+            for workers in (1, 3):
+                tree = ahocorasick.KeywordTree()
+                tree.add_many(words)
+                tree.make(mode, workers=workers)
+                trees.append(tree)
+            self.assertEqual(trees[0].dumps(), trees[1].dumps())
+            self.assertEqual(list(trees[0].findall("ff9d3a1b2c")),
+                             list(trees[1].findall("ff9d3a1b2c")))
+        self.tree.add("foo")
+        self.assertRaises(AssertionError, self.tree.make, workers=0)
+
+    def testAddDuringParallelMake(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add_many("%x%x" % (i, i * 7919) for i in range(20000))
+        done = threading.Event()
+        added = []
+
+        def adder():
+            i = 0
+            while not done.is_set():
+                word = "zz%d" % i
+                try:
+                    tree.add(word)
+                except AssertionError:
+                    pass
+                else:
+                    added.append(word)
+                i += 1
+
+        thread = threading.Thread(target=adder)
+        thread.start()
+        try:
+            tree.make(workers=4)
+        finally:
+            done.set()
+            thread.join()
+        tree.make()
+        for word in added:
+            self.assertTrue(tree.contains(word), word)
+
+    def testSkipsToFirstBytes(self):
+        query = "." * 5000 + "xyz" + "-" * 3000 + "XYW" + "x"
+        for mode in ("goto", "dfa"):
+            tree = ahocorasick.KeywordTree(fold_case=True)
+            tree.add("xyz")
+            tree.add("yw")
+            tree.make(mode)
+            self.assertEqual([(5000, 5003), (8004, 8006)],
+                             list(tree.findall(query)))
+            self.assertEqual((8004, 8006), tree.search_long(query, 5003))
+            stream = tree.stream()
+            self.assertEqual([(5000, 5003)], stream.feed(query[:5002]) +
+                             stream.feed(query[5002:8005]))
+        loaded = ahocorasick.KeywordTree.loads(tree.dumps())
+        self.assertEqual(list(tree.findall(query)),
+                         list(loaded.findall(query)))
+
+    def testContains(self):
+        self.tree.add("alpha")
+        self.tree.add("beta")
+        self.assertRaises(AssertionError, self.tree.contains, "alpha")
+        self.tree.make()
+        self.assertEqual(True, self.tree.contains("the alphabet"))
+        self.assertEqual(False, self.tree.contains("the alphabet",
+                                                   word_boundaries=True))
+        self.assertEqual(False, self.tree.contains("gamma"))
+        self.assertEqual(False, self.tree.contains("alpha beta", 1, 9))
+
+    def testCountAndCounts(self):
+        for keyword in ["he", "she", "his", "hers"]:
+            self.tree.add(keyword)
+        self.tree.make()
+        query = "ushers and his sheep, she said"
+        for kwargs in ({}, {"allow_overlaps": True}, {"longest": True}):
+            if kwargs.get("longest"):
+                matches = self.tree.findall_long(query)
+            else:
+                matches = self.tree.findall(
+                    query, allow_overlaps=kwargs.get("allow_overlaps", 0))
+            self.assertEqual(len(list(matches)),
+                             self.tree.count(query, **kwargs))
+        self.assertEqual([0, 3, 1, 0], self.tree.counts(query).tolist())
+        self.assertEqual([3, 3, 1, 0],
+                         self.tree.counts(query, allow_overlaps=True).tolist())
+        self.tree.add("said")
+        self.assertEqual([0, 3, 1, 0, 1], self.tree.counts(query).tolist())
+        self.assertEqual(0, self.tree.count(""))
+
+    def testStats(self):
+        for keyword in ["he", "she", "his", "hers"]:
+            self.tree.add(keyword)
+        stats = self.tree.stats()
+        self.assertEqual(10, stats["states"])
+        self.assertEqual([1, 2, 3, 3, 1], stats["depths"])
+        self.assertEqual(None, stats["mode"])
+        self.tree.make("dfa")
+        stats = self.tree.stats()
+        self.assertEqual(10, stats["states"])
+        self.assertEqual(4, stats["keywords"])
+        self.assertEqual([1, 2, 3, 3, 1], stats["depths"])
+        self.assertEqual("dfa", stats["mode"])
+        self.assertEqual(10, stats["dense_states"] + stats["sparse_states"])
+        # "she" fails to "he", then to the zerostate, and "he" ends at
+        # the end of "she" too.
+        self.assertEqual(2, stats["max_fail_chain"])
+        self.assertEqual(1, stats["max_dict_chain"])
+        self.assert_(stats["dfa_bytes"] > 0)
+        loaded = ahocorasick.KeywordTree.loads(self.tree.dumps())
+        self.assertEqual([1, 2, 3, 3, 1], loaded.stats()["depths"])
+
+    def testCounters(self):
+        for keyword in ["he", "she", "his", "hers"]:
+            self.tree.add(keyword)
+        self.tree.make()
+        self.assertRaises(AssertionError, self.tree.counters)
+        self.tree.instrument()
+        matches = list(self.tree.findall("ushers hishe"))
+        counters = self.tree.counters(reset=True)
+        self.assertEqual([(1, 4), (7, 10), (10, 12)], matches)
+        self.assertEqual(12, counters["bytes"])
+        self.assertEqual(3, counters["matches"])
+        self.assertEqual(counters["bytes"],
+                         counters["skipped"] + counters["transitions"])
+        self.assertEqual(0, self.tree.counters()["bytes"])
+        self.tree.instrument(False)
+        self.tree.findall("ushers")
+        self.tree.instrument()
+        self.assertEqual(0, self.tree.counters()["matches"])
+
+    def testMakeFanoutAndBudget(self):
+        keywords = ["he", "she", "his", "hers", "hello", "help"]
+        query = "ushers helped his hellos"
+        trees = []
+        for kwargs in ({}, {"fanout": 1}, {"fanout": 1000}, {"budget": 0}):
+            tree = ahocorasick.KeywordTree()
+            tree.add_many(keywords)
+            tree.make(**kwargs)
+            trees.append(tree)
+            self.assertEqual(list(trees[0].findall(query)),
+                             list(tree.findall(query)))
+        # Every state with a transition out of it, and only those.
+        stats = trees[1].stats()
+        self.assertEqual(9, stats["dense_states"])
+        self.assertEqual(14, stats["states"])
+        self.assertEqual(1, trees[2].stats()["dense_states"])
+        self.assertEqual(1, trees[3].stats()["dense_states"])
+        self.assertRaises(AssertionError, self.tree.make, fanout=-1)
+
+    def testExport(self):
+        for keyword in ["he", "she", "his", "hers"]:
+            self.tree.add(keyword)
+        self.assertRaises(AssertionError, self.tree.export)
+        self.tree.make()
+        export = self.tree.export()
+        self.assertEqual([0, 1, 2, 1, 2, 3, 2, 3, 3, 4],
+                         export["depths"].tolist())
+        edges = zip(export["src"], map(chr, export["labels"]),
+                    export["dst"])
+        self.assertEqual(9, len(edges))
+        self.assert_((0, "h", 1) in edges)
+        for src, label, dst in edges:
+            self.assertEqual(export["depths"][src] + 1,
+                             export["depths"][dst])
+        keywords = [keyword for keyword in export["keywords"]
+                    if keyword != -1]
+        self.assertEqual([0, 1, 2, 3], sorted(keywords))
+        loaded = ahocorasick.KeywordTree.loads(self.tree.dumps())
+        self.assertEqual(export, loaded.export())
+
+    def testDottyLimits(self):
+        import ahocorasick.graphviz
+        for keyword in ["he", "she", "his", "hers"]:
+            self.tree.add(keyword)
+        self.tree.make()
+        self.assertEqual(9, ahocorasick.graphviz.dotty(self.tree).count("->"))
+        self.assertEqual(5, ahocorasick.graphviz.dotty(
+            self.tree, max_depth=2).count("->"))
+        self.assertEqual(2, ahocorasick.graphviz.dotty(
+            self.tree, max_states=3).count("->"))
+
+    def testGroups(self):
+        self.tree.add("he", group="en")
+        self.tree.add("she", group="en")
+        self.tree.add("sie", group="de")
+        self.tree.add("er", group="de")
+        self.tree.add("hers")
+        self.tree.make()
+        query = "ushers sie"
+        self.assertEqual(["en", "de"], self.tree.groups())
+        self.assertEqual([(1, 4), (7, 10)], self.tree.findall(query))
+        self.assertEqual([(1, 4)], self.tree.findall(query, groups="en"))
+        self.assertEqual([(3, 5), (7, 10)],
+                         self.tree.findall(query, groups=["de"]))
+        self.assertEqual([], self.tree.findall(query, groups=["fr"]))
+        self.assertEqual(False, self.tree.contains("hers", groups=["fr"]))
+        self.assertEqual(2, self.tree.count(query, groups=("en", "de")))
+        self.assertEqual([(1, 4), (2, 4), (3, 5)],
+                         list(self.tree.iter_all("ushers",
+                                                 groups=set(["en", "de"]))))
+        self.assertEqual({"en": [(1, 4), (2, 4)], "de": [(3, 5), (7, 10)]},
+                         self.tree.findall_groups(query))
+        self.assertEqual({"de": [(3, 5)]},
+                         self.tree.findall_groups("ushers", groups="de"))
+
+    def testGroupsAfterMake(self):
+        self.tree.add("he", group=1)
+        self.tree.add("she")
+        self.tree.make()
+        stream = self.tree.stream()
+        # A keyword of the tree joins a group, and a new one comes in.
+        self.tree.add("she", group=2)
+        self.tree.add("hers", group=2)
+        self.assertEqual([(1, 4), (2, 6)],
+                         list(self.tree.iter_all("ushers", groups=2)))
+        self.assertEqual({1: [(2, 4)], 2: [(1, 4), (2, 6)]},
+                         self.tree.findall_groups("ushers"))
+        self.assertEqual([(1, 4)], stream.feed("ushers"))
+        self.assertEqual(2, self.tree.stats()["groups"])
+        for group in range(3, 65):
+            self.tree.add("he", group=group)
+        self.assertRaises(AssertionError, self.tree.add, "he", group=65)
+
+    def testGroupsAreLikeTreeOfGroup(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add("aaa", group="x")
+        tree.add("a", group="x")
+        tree.add("baaab", group="y")
+        tree.make()
+        self.assertEqual((1, 4), tree.search_long("baaax", groups="x"))
+
+        tree = ahocorasick.KeywordTree()
+        tree.add("b", group="x")
+        tree.add("abc", group="y")
+        tree.make()
+        ## A tree of just "b" finds it, though the whole tree doesn't.
+        self.assertEqual([], tree.findall("abx"))
+        self.assertEqual([(1, 2)], tree.findall("abx", groups="x"))
+
+        groups = {"x": ["he", "hers", "is"], "y": ["she", "his", "s"]}
+        queries = ["ushers", "she his hers", "shis", "hhe", "sherse"]
+        for mode in ('goto', 'dfa'):
+            tree = ahocorasick.KeywordTree()
+            for group, keywords in sorted(groups.items()):
+                for keyword in keywords:
+                    tree.add(keyword, group=group)
+            tree.make(mode)
+            for group, keywords in groups.items():
+                other = ahocorasick.KeywordTree.from_iterable(keywords,
+                                                              mode=mode)
+                for query in queries:
+                    self.assertEqual(other.search(query),
+                                     tree.search(query, groups=group))
+                    self.assertEqual(other.search_long(query),
+                                     tree.search_long(query, groups=group))
+                    self.assertEqual(other.findall(query),
+                                     tree.findall(query, groups=group))
+                    self.assertEqual(other.findall_long(query),
+                                     tree.findall_long(query, groups=group))
+
+    def testGroupsChangeDuringSearch(self):
+        tree = ahocorasick.KeywordTree()
+        tree.add("he", group="x")
+        tree.add("she", group="y")
+        tree.add("hers", group="x")
+        tree.make()
+        query = "ushers " * 20000
+        counts = set()
+        for keywords in (["he"], ["he", "hers"], ["he", "she"],
+                         ["he", "she", "hers"]):
+            other = ahocorasick.KeywordTree.from_iterable(keywords)
+            counts.add(other.count(query))
+        done = threading.Event()
+
+        def changer():
+            i = 0
+            while not done.is_set():
+                tree.remove("hers")
+                tree.add("hers")
+                if i == 50:
+                    tree.add("she", group="x")
+                i += 1
+
+        thread = threading.Thread(target=changer)
+        thread.start()
+        try:
+            for i in range(50):
+                self.assertTrue(tree.count(query, groups="x") in counts)
+        finally:
+            done.set()
+            thread.join()
+
+    def testPickleGroups(self):
+        import pickle
+        self.tree.add("perl", group="p")
+        self.tree.add("python", group="p")
+        self.tree.add("ruby", group="r")
+        self.tree.make()
+        unpickled = pickle.loads(pickle.dumps(self.tree))
+        self.assertEqual(["p", "r"], unpickled.groups())
+        self.assertEqual([(9, 13)],
+                         unpickled.findall("perl and ruby", groups="r"))
+
+    def testBadMakeModeRaisesAssert(self):
+        self.tree.add("foo")
+        self.assertRaises(AssertionError, self.tree.make, mode="bogus")
+
+
+
     def testChasesInterface(self):
         self.tree.add("python")
         self.tree.add("is")
@@ -0,0 +1,106 @@
+/**
+
+  @file
+
+  @brief Implementation of a very simple region allocator.
+
+  ----
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+*/
+
+#include "xalloc.h"
+
+#include "arena.h"
+
+//! Everything handed out is aligned to this many bytes
+union arena_align
+{
+	void *p;
+	size_t s;
+	double d;
+};
+#define ARENA_ALIGN sizeof(union arena_align)
+#define ARENA_ROUND(n) (((n) + ARENA_ALIGN - 1) / ARENA_ALIGN * ARENA_ALIGN)
+
+/** \brief Initialize an empty arena
+	\param arena the arena to initialize
+*/
+void
+arena_init(arena_t *arena)
+{
+	arena->blocks = NULL;
+	arena->allocated = 0;
+}
+
+/** \brief Allocate memory from an arena
+	\param arena a pointer to an arena
+	\param size the number of bytes wanted
+	\return a pointer to the memory, or NULL on failure
+*/
+void *
+arena_alloc(arena_t *arena,size_t size)
+{
+	arena_block_t *block = arena->blocks;
+	size_t block_size;
+	void *p;
+
+	size = ARENA_ROUND(size);
+	if ( block == NULL || block->size - block->used < size )
+	{
+		block_size = size > ARENA_BLOCK_SIZE ? size : ARENA_BLOCK_SIZE;
+		if ( (block = xalloc(ARENA_ROUND(sizeof(arena_block_t)) +
+				     block_size)) == NULL )
+			return NULL;
+		block->used = 0;
+		block->size = block_size;
+		arena->allocated += ARENA_ROUND(sizeof(arena_block_t)) +
+			block_size;
+
+		/* Oversized requests get a block of their own, which goes
+		   behind the current one so that we keep filling that. */
+		if ( block_size > ARENA_BLOCK_SIZE && arena->blocks != NULL )
+		{
+			block->next = arena->blocks->next;
+			arena->blocks->next = block;
+		}
+		else
+		{
+			block->next = arena->blocks;
+			arena->blocks = block;
+		}
+	}
+
+	p = (char *) block + ARENA_ROUND(sizeof(arena_block_t)) + block->used;
+	block->used += size;
+	return p;
+}
+
+/** \brief Give back all the memory held by an arena
+	\param arena a pointer to an existing arena
+*/
+void
+arena_destroy(arena_t *arena)
+{
+	arena_block_t *block;
+
+	while( (block = arena->blocks) != NULL )
+	{
+		arena->blocks = block->next;
+		xfree(block);
+	}
+	arena->allocated = 0;
+}
@@ -0,0 +1,64 @@
+/**
+
+  @file
+
+  @brief A very simple region allocator.
+
+  Memory is handed out by bumping a pointer through large blocks that are
+  only ever given back all at once, by arena_destroy().  There's no way to
+  free a single allocation.  The Aho-Corasick tree allocates its states and
+  transition tables out of these, so that building a tree doesn't go to
+  malloc() once per state, and throwing it away doesn't have to walk it.
+
+  ----
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+*/
+
+#ifndef ARENA_H
+#define ARENA_H
+
+#include <stddef.h>
+
+//! The definition of a block of arena memory
+struct arena_block
+{
+	struct arena_block *next; //!< Pointer to the previously filled block
+	size_t used; //!< Number of bytes handed out from this block
+	size_t size; //!< Number of bytes available in this block
+};
+
+//! Arena block type
+typedef struct arena_block arena_block_t;
+
+//! The definition of an arena
+struct arena
+{
+	arena_block_t *blocks; //!< The block we're allocating from, or NULL
+	size_t allocated; //!< Total number of bytes obtained from xalloc
+};
+
+//! Arena type
+typedef struct arena arena_t;
+
+//! Default number of bytes in a block, not counting its header
+#define ARENA_BLOCK_SIZE (64 * 1024)
+
+void arena_init(arena_t *);
+void arena_destroy(arena_t *);
+void *arena_alloc(arena_t *,size_t);
+
+#endif
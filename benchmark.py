@@ -0,0 +1,360 @@
+"""Times the extension on synthetic dictionaries and haystacks.
+
+    python benchmark.py [--sizes 1000,10000,100000] [--shapes ...]
+                        [--modes goto,dfa] [--haystack BYTES]
+                        [--repeat N] [--output results.json]
+                        [--baseline baseline.json] [--tolerance 0.25]
+
+Each dictionary shape and size is run in a process of its own, so that
+the peak RSS reported for it is its own.  The data is made up from a fixed
+seed, so runs on the same machine are comparable.  The shapes are:
+
+    short     3 to 8 lowercase letters
+    long      20 to 64 lowercase letters
+    prefix    a thousand stems of 8 to 16 letters, with suffixes of 2 to
+              10 letters, so that most of every keyword is shared
+    binary    4 to 16 bytes from the top half of the byte range
+
+Sizes of 1000000 or 5000000 keywords work too, given the memory.  Each
+dictionary gets two haystacks: sparse, with a keyword planted every 64K,
+and dense, with one every 32 bytes, in filler that no keyword occurs in.
+
+Timed for each are add(), make(), search() and search_long() called in a
+loop from each match on, findall(), findall_long(), chases() over 64K
+blocks, and throwing the tree away.  Scans take the best of --repeat runs.
+The tree's stats() go along with the times.  Results are written as JSON
+with --output.  With --baseline, they are compared against an earlier
+--output, and the exit status is 1 if any time, or the peak RSS, is more
+than --tolerance worse.
+"""
+
+from distutils.util import get_platform
+import sys
+sys.path.insert(0, "build/lib.%s-%s" % (get_platform(), sys.version[0:3]))
+
+import ahocorasick
+
+import binascii
+import gc
+import json
+import optparse
+import platform
+import random
+import resource
+import string
+import subprocess
+import time
+
+
+SHAPES = {
+    # name: (keyword alphabet, filler alphabet, shortest, longest)
+    "short": (string.ascii_lowercase, string.ascii_uppercase + " .,\n",
+              3, 8),
+    "long": (string.ascii_lowercase, string.ascii_uppercase + " .,\n",
+             20, 64),
+    "prefix": (string.ascii_lowercase, string.ascii_uppercase + " .,\n",
+               2, 10),
+    "binary": ("".join(map(chr, range(128, 256))),
+               "".join(map(chr, range(1, 128))), 4, 16),
+}
+
+HAYSTACKS = {"sparse": 65536, "dense": 32}
+
+SCANS = ["search", "search_long", "findall", "findall_long", "chases"]
+
+
+def random_bytes(rand, n):
+    """Returns n random bytes, made a megabyte at a time."""
+    pieces = []
+    while n > 0:
+        size = min(n, 1 << 20)
+        pieces.append(binascii.unhexlify("%0*x" % (2 * size,
+                                                   rand.getrandbits(8 * size))))
+        n -= size
+    return "".join(pieces)
+
+
+def random_text(rand, n, alphabet):
+    """Returns n random bytes drawn from the alphabet."""
+    table = "".join(alphabet[i % len(alphabet)] for i in range(256))
+    return random_bytes(rand, n).translate(table)
+
+
+def make_keywords(rand, shape, size):
+    alphabet, filler, shortest, longest = SHAPES[shape]
+    lengths = [shortest + ord(c) % (longest - shortest + 1)
+               for c in random_bytes(rand, size)]
+    text = random_text(rand, sum(lengths), alphabet)
+    keywords = []
+    pos = 0
+    for length in lengths:
+        keywords.append(text[pos:pos + length])
+        pos += length
+    if shape == "prefix":
+        stems = [random_text(rand, 8 + i % 9, alphabet) for i in range(1000)]
+        keywords = [stems[i % len(stems)] + keyword
+                    for i, keyword in enumerate(keywords)]
+    return keywords
+
+
+def make_haystack(rand, shape, keywords, size, gap):
+    """Returns size bytes of filler, with a keyword every gap bytes."""
+    filler = random_text(rand, size, SHAPES[shape][1])
+    pieces = []
+    for pos in range(0, size, gap):
+        keyword = keywords[rand.randrange(len(keywords))]
+        pieces.append(filler[pos:pos + max(gap - len(keyword), 0)])
+        pieces.append(keyword)
+    return "".join(pieces)[:size]
+
+
+def count_states(keywords):
+    """The number of states a tree of the keywords has: one for each
+    distinct prefix, and the zerostate."""
+    states = 1
+    previous = ""
+    for keyword in sorted(set(keywords)):
+        shared = 0
+        limit = min(len(keyword), len(previous))
+        while shared < limit and keyword[shared] == previous[shared]:
+            shared += 1
+        states += len(keyword) - shared
+        previous = keyword
+    return states
+
+
+def current_rss():
+    """The resident set size of this process in bytes, or None where
+    /proc isn't there to tell."""
+    try:
+        f = open("/proc/self/statm")
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def peak_rss():
+    """The peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def timed(repeat, function, *args):
+    """Returns the best time of repeat calls, and the last result."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def add_all(tree, keywords):
+    add = tree.add
+    for keyword in keywords:
+        add(keyword)
+
+
+def empty(items):
+    del items[:]
+
+
+def loop(method, haystack):
+    """Calls a search method from each match on, like findall() does."""
+    found = 0
+    pos = 0
+    while True:
+        match = method(haystack, pos)
+        if match is None:
+            return found
+        found += 1
+        pos = match[1]
+
+
+def scan(tree, name, haystack):
+    if name == "search":
+        return loop(tree.search, haystack)
+    if name == "search_long":
+        return loop(tree.search_long, haystack)
+    if name == "findall":
+        return len(list(tree.findall(haystack)))
+    if name == "findall_long":
+        return len(list(tree.findall_long(haystack)))
+    blocks = [haystack[pos:pos + 65536]
+              for pos in range(0, len(haystack), 65536)]
+    return len(list(tree.chases(iter(blocks))))
+
+
+def run_case(shape, size, mode, haystack_size, repeat):
+    """Runs one dictionary through everything, and returns the results."""
+    rand = random.Random(size * len(SHAPES) + sorted(SHAPES).index(shape))
+    keywords = make_keywords(rand, shape, size)
+    gc.collect()
+
+    # The haystacks are made after the tree, so that the tree doesn't go
+    # into memory they've let go of, where it wouldn't show in the RSS.
+    timings = {}
+    matches = {}
+    before = current_rss()
+    tree = ahocorasick.KeywordTree()
+    timings["add"], ignored = timed(1, add_all, tree, keywords)
+    timings["make"], ignored = timed(1, tree.make, mode)
+    after = current_rss()
+    # Builds from before stats() was there can still be timed.
+    stats = None
+    if hasattr(tree, "stats"):
+        stats = tree.stats()
+
+    haystacks = {}
+    for name, gap in sorted(HAYSTACKS.items()):
+        haystacks[name] = make_haystack(rand, shape, keywords,
+                                        haystack_size, gap)
+    states = count_states(keywords)
+
+    for name, haystack in sorted(haystacks.items()):
+        for method in SCANS:
+            key = "%s_%s" % (method, name)
+            timings[key], matches[key] = timed(repeat, scan, tree, method,
+                                               haystack)
+
+    # Only the list holds on to the tree then, so emptying it frees it.
+    trees = [tree]
+    del tree
+    timings["destroy"], ignored = timed(1, empty, trees)
+
+    result = {
+        "shape": shape,
+        "size": size,
+        "mode": mode,
+        "states": states,
+        "keyword_bytes": sum(map(len, keywords)),
+        "haystack_bytes": haystack_size,
+        "timings": timings,
+        "matches": matches,
+        "peak_rss": peak_rss(),
+        "tree_bytes": None,
+        "bytes_per_state": None,
+        "stats": stats,
+    }
+    if before is not None and after is not None:
+        result["tree_bytes"] = after - before
+        result["bytes_per_state"] = float(after - before) / states
+    return result
+
+
+def case_key(result):
+    return "%s:%d:%s" % (result["shape"], result["size"], result["mode"])
+
+
+def compare(results, baseline, tolerance):
+    """Prints how each result compares with the baseline, and returns the
+    number of measurements that got worse by more than the tolerance."""
+    old = dict((case_key(result), result) for result in baseline["results"])
+    regressions = 0
+    for result in results:
+        key = case_key(result)
+        if key not in old:
+            continue
+        pairs = [(name, seconds, old[key]["timings"].get(name))
+                 for name, seconds in sorted(result["timings"].items())]
+        pairs.append(("peak_rss", result["peak_rss"], old[key]["peak_rss"]))
+        for name, new_value, old_value in pairs:
+            if not old_value or not new_value:
+                continue
+            # Times under a millisecond are mostly noise.
+            if name != "peak_rss" and max(new_value, old_value) < 0.001:
+                continue
+            ratio = float(new_value) / old_value
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print "%-24s %-20s %7.3fx%s" % (key, name, ratio, flag)
+    return regressions
+
+
+def report(result):
+    print "%s: %d states, %s bytes/state, peak RSS %.1f MB" % (
+        case_key(result), result["states"],
+        result["bytes_per_state"] is not None and
+        "%.1f" % result["bytes_per_state"] or "?",
+        result["peak_rss"] / 1e6)
+    mb = result["haystack_bytes"] / 1e6
+    timings = result["timings"]
+    for name in ["add", "make"]:
+        print "    %-22s %9.4fs" % (name, timings[name])
+    for name in sorted(HAYSTACKS):
+        for method in SCANS:
+            key = "%s_%s" % (method, name)
+            print "    %-22s %9.4fs %9.1f MB/s %8d matches" % (
+                key, timings[key], mb / max(timings[key], 1e-9),
+                result["matches"][key])
+    print "    %-22s %9.4fs" % ("destroy", timings["destroy"])
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("--sizes", default="1000,10000,100000")
+    parser.add_option("--shapes", default=",".join(sorted(SHAPES)))
+    parser.add_option("--modes", default="goto,dfa")
+    parser.add_option("--haystack", type="int", default=4 << 20,
+                      help="bytes in each haystack")
+    parser.add_option("--repeat", type="int", default=3)
+    parser.add_option("--output", help="write the results here, as JSON")
+    parser.add_option("--baseline", help="compare with these results")
+    parser.add_option("--tolerance", type="float", default=0.25)
+    parser.add_option("--case", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.case:
+        shape, size, mode = options.case.split(":")
+        print json.dumps(run_case(shape, int(size), mode, options.haystack,
+                                  options.repeat))
+        return 0
+
+    results = []
+    for shape in options.shapes.split(","):
+        if shape not in SHAPES:
+            parser.error("unknown shape %r" % shape)
+        for size in map(int, options.sizes.split(",")):
+            for mode in options.modes.split(","):
+                output = subprocess.check_output(
+                    [sys.executable, sys.argv[0],
+                     "--case", "%s:%d:%s" % (shape, size, mode),
+                     "--haystack", str(options.haystack),
+                     "--repeat", str(options.repeat)])
+                result = json.loads(output)
+                report(result)
+                results.append(result)
+
+    if options.output:
+        f = open(options.output, "w")
+        try:
+            json.dump({"python": sys.version.split()[0],
+                       "platform": platform.platform(),
+                       "haystack": options.haystack,
+                       "results": results}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if compare(results, baseline, options.tolerance) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,21 +9,91 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include "structmember.h"
+#include "pythread.h"
 #include "aho-corasick.h"
 
+#include <ctype.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
 
 /* We add a few forward declarations here to make C happy. */
 staticforward PyTypeObject ahocorasick_KeywordTreeType;
 staticforward PyTypeObject ahocorasick_StateType;
+staticforward PyTypeObject ahocorasick_StreamType;
+staticforward PyTypeObject ahocorasick_MatchIteratorType;
 
 
 
 /* Keyword Tree structure definition. */
-typedef struct {
+typedef struct ahocorasick_KeywordTree {
 	PyObject_HEAD
 	int count;
 	int made;
+	/* Nonzero while make() builds the tree in other threads, without
+	   the interpreter lock; nothing else may touch the tree until it's
+	   done.  See ahocorasick_KeywordTree_check_building(). */
+	int building;
 	aho_corasick_t* tree;
+	/* The image the tree was load()ed from, if any.  It's either mmap()ed
+	   from a file, or a PyMem_Malloc()ed copy of a string. */
+	void *image;
+	size_t image_size;
+	int image_mapped;
+	/* The value given to add() for each keyword, by keyword index, or
+	   None if it wasn't given one. */
+	PyObject *values;
+	/* The table the tree was given to translate bytes with.  make()
+	   folds the tree's own copy away, but the deltas need it. */
+	unsigned char translate[AHO_CORASICK_CHARACTERS];
+	/* Keywords added since make(), as they translate, mapped to their
+	   indexes, or NULL if there are none.  added_keys has them the
+	   other way around: a list of them by index, less the number of
+	   keywords in the tree. */
+	PyObject *added;
+	PyObject *added_keys;
+	/* The made trees of the added keywords, the deltas: a tuple of
+	   KeywordTrees, or NULL if there are none.  Each has the added
+	   keywords from where the one before it leaves off, or the first
+	   one, up to the index in delta_ends.  The keywords after the last
+	   one's end go in a delta of their own with the next search, and
+	   if that's no less than half as many as the last delta has, in
+	   that one, made over again: each delta is over twice as big as the
+	   next, so there are only ever a few of them to search, and a
+	   keyword only goes through a few of them.  The tuple is replaced
+	   rather than changed, since a search might be looking at it. */
+	PyObject *deltas;
+	Py_ssize_t delta_ends[AHO_CORASICK_DELTAS];
+	/* A string of one flag per keyword index, set for the keywords
+	   removed since make(), or NULL if there are none.  It's replaced
+	   rather than changed, since a search might be looking at it. */
+	PyObject *removed;
+	/* A string of one flag per state of the tree, set for the states
+	   that only lead to removed keywords, or NULL if there are none; see
+	   aho_corasick_kill().  It's only changed in place while the tree is
+	   all that holds on to it. */
+	PyObject *dead;
+	/* The names of the groups that keywords have been put in, in the
+	   order they were first used; the group of name i has bit i in the
+	   masks. */
+	PyObject *group_names;
+	/* A bytearray of one aho_corasick_groups_t mask per keyword index,
+	   with the groups the keyword is in, or NULL if there are no groups.
+	   It has room to spare, for the keywords to come.  A search holds on
+	   to the one it's looking at, so it's only changed in place while
+	   the tree is all that does. */
+	PyObject *groups;
+	/* A bytearray of the groups of the states of the made tree, that
+	   aho_corasick_setgroups() fills in, or NULL if there are no groups.
+	   Like the dead flags, it's only changed in place while the tree is
+	   all that holds on to it. */
+	PyObject *state_groups;
+	/* Nonzero if searches count what they do into counters; see
+	   instrument(). */
+	int instrumented;
+	aho_corasick_counters_t counters;
 } ahocorasick_KeywordTree;
 
 
@@ -37,6 +107,66 @@ typedef struct {
 
 
 
+/* What a search sees of a tree: the options to search it with, for the
+   keywords added and removed since make(), and references to the deltas,
+   the removed and dead flags and the group masks of the keywords and the
+   states that the options point into.  Holding on to those
+   means that a search doesn't see an add() or remove() that another thread
+   makes while the search is going on.  If the tree is instrumented, the
+   search counts into counters of its own, which are only added to the
+   tree's total once it has the interpreter lock back. */
+typedef struct {
+	aho_corasick_options_t options;
+	PyObject *deltas;
+	PyObject *removed;
+	PyObject *dead;
+	PyObject *groups;
+	PyObject *state_groups;
+	aho_corasick_counters_t counters;
+	aho_corasick_counters_t *total;
+} ahocorasick_snapshot_t;
+
+
+
+/* Match iterator structure definition.  What iter_all() returns: it keeps
+   the query, and where in it and in the automaton the last match left
+   off, and scans on from there for the next. */
+typedef struct {
+	PyObject_HEAD
+	ahocorasick_KeywordTree *tree;
+	ahocorasick_snapshot_t snapshot;
+	Py_buffer query;
+	int done;		/* the query's been let go of */
+	int scanning;		/* next() is scanning, without the GIL */
+	/* the tree's, then each delta's */
+	aho_corasick_int_t states[1 + AHO_CORASICK_DELTAS];
+	Py_ssize_t pos;		/* bytes scanned so far */
+	Py_ssize_t endpos;
+	Py_ssize_t offset;	/* characters before pos, in text mode */
+	aho_corasick_matches_t matches;	/* found at pos, not handed out */
+	size_t next;
+	int with_value;
+} ahocorasick_MatchIterator;
+
+
+
+/* Stream structure definition.  A stream remembers where in the automaton
+   the last chunk it was fed left off, and how far into the stream it is.
+   It searches for the keywords the tree had when the stream was made. */
+typedef struct {
+	PyObject_HEAD
+	ahocorasick_KeywordTree *tree;
+	ahocorasick_snapshot_t snapshot;
+	/* the tree's, then each delta's */
+	aho_corasick_int_t states[1 + AHO_CORASICK_DELTAS];
+	Py_ssize_t offset;	/* in characters, in text mode */
+	Py_ssize_t bytes;	/* how many bytes have been fed */
+	int all;
+	int with_value;
+} ahocorasick_Stream;
+
+
+
 /* I also do a forward declaration of the state-wrapping function, since it is
    called in ahocorasick_KeywordTree_zerostate. */
 static PyObject* 
@@ -45,6 +175,28 @@ ahocorasick_State_make(ahocorasick_KeywordTree *tree,
 
 
 
+/* The array.array type, which findall_array() and findall_batch() return
+   their matches in.  Imported when the module is. */
+static PyObject *ahocorasick_array_type = NULL;
+
+
+
+/* Searches over fewer bytes than this don't bother letting go of the
+   interpreter lock: taking it back would cost more than the search. */
+#define AHOCORASICK_GIL_MINSIZE 2048
+
+/* Bracket a search over n bytes, letting go of the interpreter lock in
+   between if n is big enough. */
+#define AHOCORASICK_BEGIN_SEARCH(n) { \
+	PyThreadState *_save = (n) >= AHOCORASICK_GIL_MINSIZE ? \
+		PyEval_SaveThread() : NULL;
+#define AHOCORASICK_END_SEARCH \
+	if (_save != NULL) \
+		PyEval_RestoreThread(_save); \
+	}
+
+
+
 /**********************************************************************/
 /* Implementation of the KeywordTree follows: */
 
@@ -57,8 +209,11 @@ ahocorasick_KeywordTree_new(PyTypeObject *type,
 	ahocorasick_KeywordTree *self;
 	self = (ahocorasick_KeywordTree *) type->tp_alloc(type, 0);
 	if (self != NULL) {
+		self->values = PyList_New(0);
+		self->group_names = PyList_New(0);
 		self->tree = PyMem_Malloc(sizeof(aho_corasick_t));
-		if (self->tree == NULL) {
+		if (self->values == NULL || self->group_names == NULL ||
+		    self->tree == NULL) {
 			Py_DECREF(self);
 			return NULL;
 		}
@@ -68,6 +223,21 @@ ahocorasick_KeywordTree_new(PyTypeObject *type,
 		}
 		self->count = 0;
 		self->made = 0;
+		self->building = 0;
+		self->image = NULL;
+		self->image_size = 0;
+		self->image_mapped = 0;
+		memcpy(self->translate, self->tree->translate,
+		       AHO_CORASICK_CHARACTERS);
+		self->added = NULL;
+		self->added_keys = NULL;
+		self->deltas = NULL;
+		self->removed = NULL;
+		self->dead = NULL;
+		self->groups = NULL;
+		self->state_groups = NULL;
+		self->instrumented = 0;
+		memset(&self->counters, 0, sizeof(self->counters));
 	}
 	return (PyObject*) self;
 }
@@ -78,6 +248,39 @@ static int
 ahocorasick_KeywordTree_init(ahocorasick_KeywordTree *self,
 			     PyObject *args,
 			     PyObject *kwargs) {
+	static char *kwlist[] = {"text", "fold_case", "translate", NULL};
+	int text = 0;
+	int fold_case = 0;
+	unsigned char *translate = NULL;
+	Py_ssize_t n;
+	int i;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "|iiz#", kwlist, &text, &fold_case,
+	     &translate, &n)) {
+		return -1;
+	}
+
+	if (self->count > 0 || self->made) {
+		PyErr_SetString(PyExc_AssertionError,
+				"a KeywordTree can't be initialized again once keywords have been added.");
+		return -1;
+	}
+
+	if (translate != NULL && n != AHO_CORASICK_CHARACTERS) {
+		PyErr_SetString(PyExc_AssertionError,
+				"translate must be a string of 256 bytes, like string.maketrans() returns.");
+		return -1;
+	}
+
+	self->tree->text = text;
+	for (i = 0; i < AHO_CORASICK_CHARACTERS; i++) {
+		self->tree->translate[i] = translate != NULL ? translate[i] : i;
+		if (fold_case)
+			self->tree->translate[i] =
+				tolower(self->tree->translate[i]);
+	}
+	memcpy(self->translate, self->tree->translate,
+	       AHO_CORASICK_CHARACTERS);
 	return 0;
 }
 
@@ -88,149 +291,3050 @@ static void
 ahocorasick_KeywordTree_dealloc(ahocorasick_KeywordTree *self) {
 	aho_corasick_destroy(self->tree);
 	PyMem_Free(self->tree);
+	if (self->image_mapped)
+		munmap(self->image, self->image_size);
+	else
+		PyMem_Free(self->image);
+	Py_XDECREF(self->values);
+	Py_XDECREF(self->added);
+	Py_XDECREF(self->added_keys);
+	Py_XDECREF(self->deltas);
+	Py_XDECREF(self->removed);
+	Py_XDECREF(self->dead);
+	Py_XDECREF(self->group_names);
+	Py_XDECREF(self->groups);
+	Py_XDECREF(self->state_groups);
 	self->ob_type->tp_free((PyObject*) self);
 }
 
 
+/* Gets at the bytes of a query, which can be a string or any other object
+   with the buffer interface.  In text mode, unicode queries are encoded to
+   UTF-8, and anything else is taken to be UTF-8 already.  Returns -1 with
+   an exception set if the query is none of those. */
+static int
+ahocorasick_KeywordTree_getquery(ahocorasick_KeywordTree *self,
+				 PyObject *object, Py_buffer *query) {
+	PyObject *utf8;
+	int status;
+
+	if (self->tree->text && PyUnicode_Check(object)) {
+		if ( (utf8 = PyUnicode_AsUTF8String(object)) == NULL)
+			return -1;
+		status = PyObject_GetBuffer(utf8, query, PyBUF_SIMPLE);
+		Py_DECREF(utf8);
+		return status;
+	}
+	return PyArg_Parse(object, "s*", query) ? 0 : -1;
+}
+
+
+
+/* Raises an AssertionError and returns -1 if make() is building the tree
+   in other threads, which is only ever the case with workers > 1.  Every
+   method that changes the tree, or looks into it, checks this first. */
+static int
+ahocorasick_KeywordTree_check_building(ahocorasick_KeywordTree *self) {
+	if (self->building) {
+		PyErr_SetString(PyExc_AssertionError,
+				"the KeywordTree is being made by make() in another thread.");
+		return -1;
+	}
+	return 0;
+}
+
+
+
+/* Returns the n bytes of a keyword put through the tree's translate table,
+   as a string. */
+static PyObject*
+ahocorasick_KeywordTree_translate(ahocorasick_KeywordTree *self,
+				  unsigned char *bytes, Py_ssize_t n) {
+	PyObject *result;
+	char *out;
+	Py_ssize_t i;
+
+	if ( (result = PyString_FromStringAndSize(NULL, n)) == NULL)
+		return NULL;
+	out = PyString_AS_STRING(result);
+	for (i = 0; i < n; i++)
+		out[i] = self->translate[bytes[i]];
+	return result;
+}
+
+
+
+/* Looks a keyword up in a made tree, among the ones it was made with and
+   the ones added since.  Removed keywords are found too.  Returns the
+   index of the keyword, -1 if it's not there, or -2 with an exception
+   set. */
+static int
+ahocorasick_KeywordTree_find(ahocorasick_KeywordTree *self,
+			     unsigned char *bytes, Py_ssize_t n) {
+	PyObject *key;
+	PyObject *index;
+	int keyword;
+
+	if ( (keyword = aho_corasick_find(self->tree, bytes, n)) != -1 ||
+	     self->added == NULL)
+		return keyword;
+	if ( (key = ahocorasick_KeywordTree_translate(self, bytes, n)) == NULL)
+		return -2;
+	index = PyDict_GetItem(self->added, key);
+	Py_DECREF(key);
+	return index != NULL ? (int) PyInt_AS_LONG(index) : -1;
+}
+
+
+
+/* True if the keyword has been removed since make(). */
+static int
+ahocorasick_KeywordTree_is_removed(ahocorasick_KeywordTree *self,
+				   int keyword) {
+	return self->removed != NULL &&
+		keyword < PyString_GET_SIZE(self->removed) &&
+		PyString_AS_STRING(self->removed)[keyword];
+}
+
+
+
+/* How many keywords the group masks have room for, and the masks. */
+#define ahocorasick_groups_size(groups) \
+	(PyByteArray_GET_SIZE(groups) / \
+	 (Py_ssize_t) sizeof(aho_corasick_groups_t))
+#define ahocorasick_groups_masks(groups) \
+	((aho_corasick_groups_t *) PyByteArray_AS_STRING(groups))
+
+
+
+/* Gets the dead flags of the tree's states ready to be changed: they're
+   made if there are none yet, and copied if a search holds on to them.
+   Returns 0, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_own_dead(ahocorasick_KeywordTree *self) {
+	PyObject *dead;
+	Py_ssize_t n = self->tree->newstate;
+
+	if (self->dead != NULL && Py_REFCNT(self->dead) == 1)
+		return 0;
+	if ( (dead = PyString_FromStringAndSize(NULL, n)) == NULL)
+		return -1;
+	if (self->dead != NULL)
+		memcpy(PyString_AS_STRING(dead), PyString_AS_STRING(self->dead),
+		       n);
+	else
+		memset(PyString_AS_STRING(dead), 0, n);
+	Py_XDECREF(self->dead);
+	self->dead = dead;
+	return 0;
+}
+
+
+/* Gets the groups of the tree's states ready to be changed, copying them
+   if a search holds on to them.  Returns 0, or -1 with an exception
+   set. */
+static int
+ahocorasick_KeywordTree_own_state_groups(ahocorasick_KeywordTree *self) {
+	PyObject *groups;
+
+	if (Py_REFCNT(self->state_groups) == 1)
+		return 0;
+	if ( (groups = PyByteArray_FromObject(self->state_groups)) == NULL)
+		return -1;
+	Py_DECREF(self->state_groups);
+	self->state_groups = groups;
+	return 0;
+}
+
+
+/* Works out the groups of the states of the made tree from scratch, from
+   the groups that the keywords are in, leaving out the removed keywords
+   flagged in removed, which can be NULL.  The groups are new, so a search
+   that holds on to the old ones can go on with them.  Returns 0, or -1
+   with an exception set. */
+static int
+ahocorasick_KeywordTree_setgroups(ahocorasick_KeywordTree *self,
+				  const aho_corasick_groups_t *masks,
+				  const unsigned char *removed) {
+	PyObject *groups;
+
+	if ( (groups = PyByteArray_FromStringAndSize
+	      (NULL, aho_corasick_groupsize(self->tree) *
+	       sizeof(aho_corasick_groups_t))) == NULL)
+		return -1;
+	if (aho_corasick_setgroups(self->tree, masks, removed,
+				   ahocorasick_groups_masks(groups)) == -1) {
+		Py_DECREF(groups);
+		PyErr_NoMemory();
+		return -1;
+	}
+	Py_XDECREF(self->state_groups);
+	self->state_groups = groups;
+	return 0;
+}
+
+
+/* The groups of the states, for the C functions that take them, or NULL if
+   there are none. */
+#define ahocorasick_KeywordTree_state_groups(self) \
+	((self)->state_groups != NULL ? \
+	 ahocorasick_groups_masks((self)->state_groups) : NULL)
+
+
+
+/* The removed flags, for the C functions that take them, or NULL if no
+   keyword has been removed. */
+#define ahocorasick_KeywordTree_removed(self) \
+	((self)->removed != NULL ? \
+	 (unsigned char *) PyString_AS_STRING((self)->removed) : NULL)
+
+
+
+/* Drops the delta with the added keyword of the given index in it, and
+   the ones after it, for the next search to make again with the keyword
+   as it is by then.  Returns 0, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_drop_deltas(ahocorasick_KeywordTree *self,
+				    Py_ssize_t keyword) {
+	PyObject *deltas;
+	Py_ssize_t i, n;
+
+	if (self->deltas == NULL)
+		return 0;
+	n = PyTuple_GET_SIZE(self->deltas);
+	for (i = 0; i < n && keyword >= self->delta_ends[i]; i++)
+		;
+	if (i == n)
+		return 0;
+	if (i == 0) {
+		Py_CLEAR(self->deltas);
+		return 0;
+	}
+	if ( (deltas = PyTuple_GetSlice(self->deltas, 0, i)) == NULL)
+		return -1;
+	Py_DECREF(self->deltas);
+	self->deltas = deltas;
+	return 0;
+}
+
+
+
+/* Sets the removed flag of a keyword, whose n bytes are given, to flag.
+   The flags are copied rather than changed in place, and dropped
+   altogether once none are set, so that searches go back to not looking
+   at them.  The dead flags of the tree's states go along with them, and a
+   delta with the keyword in it is made again without it.  Returns 0, or
+   -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_set_removed(ahocorasick_KeywordTree *self,
+				    int keyword, unsigned char *bytes,
+				    Py_ssize_t size, int flag) {
+	PyObject *removed;
+	Py_ssize_t n = self->tree->nkeywords;
+	char *flags;
+
+	if (self->added != NULL)
+		n += PyDict_Size(self->added);
+	if (self->removed == NULL ? !flag :
+	    (keyword < PyString_GET_SIZE(self->removed) &&
+	     PyString_AS_STRING(self->removed)[keyword] == flag))
+		return 0;
+
+	if ( (removed = PyString_FromStringAndSize(NULL, n)) == NULL)
+		return -1;
+	flags = PyString_AS_STRING(removed);
+	memset(flags, 0, n);
+	if (self->removed != NULL)
+		memcpy(flags, PyString_AS_STRING(self->removed),
+		       PyString_GET_SIZE(self->removed));
+	flags[keyword] = flag;
+	if (memchr(flags, 1, n) == NULL) {
+		Py_DECREF(removed);
+		removed = NULL;
+	}
+
+	if ((aho_corasick_int_t) keyword >= self->tree->nkeywords) {
+		if (ahocorasick_KeywordTree_drop_deltas(self, keyword) == -1)
+			goto fail;
+	}
+	else if (flag) {
+		if (ahocorasick_KeywordTree_own_dead(self) == -1 ||
+		    (self->state_groups != NULL &&
+		     ahocorasick_KeywordTree_own_state_groups(self) == -1))
+			goto fail;
+		if (aho_corasick_kill(self->tree, bytes, size,
+				      (unsigned char *)
+				      PyString_AS_STRING(self->dead),
+				      (unsigned char *) flags,
+				      self->groups != NULL ?
+				      ahocorasick_groups_masks(self->groups) :
+				      NULL,
+				      ahocorasick_KeywordTree_state_groups
+				      (self)) == -1) {
+			PyErr_NoMemory();
+			goto fail;
+		}
+	}
+	else {
+		if (removed == NULL)
+			Py_CLEAR(self->dead);
+		else if (ahocorasick_KeywordTree_own_dead(self) == -1)
+			goto fail;
+		if (self->state_groups != NULL &&
+		    ahocorasick_KeywordTree_own_state_groups(self) == -1)
+			goto fail;
+		aho_corasick_revive(self->tree, bytes, size,
+				    self->dead != NULL ? (unsigned char *)
+				    PyString_AS_STRING(self->dead) : NULL,
+				    self->groups != NULL ?
+				    ahocorasick_groups_masks(self->groups)
+				    [keyword] : 0,
+				    ahocorasick_KeywordTree_state_groups(self));
+	}
+
+	Py_XDECREF(self->removed);
+	self->removed = removed;
+	return 0;
+
+ fail:
+	Py_XDECREF(removed);
+	return -1;
+}
+
+
+
+/* Looks up the bit of a group by its name.  With create set, a group that
+   isn't there yet gets the next bit.  Returns the bit, -1 if there's no
+   such group, or -2 with an exception set. */
+static int
+ahocorasick_KeywordTree_group_bit(ahocorasick_KeywordTree *self,
+				  PyObject *name, int create) {
+	Py_ssize_t n = PyList_GET_SIZE(self->group_names);
+	Py_ssize_t i;
+	int equal;
+
+	if (n > AHO_CORASICK_GROUPS)
+		n = AHO_CORASICK_GROUPS;
+	for (i = 0; i < n; i++) {
+		if ( (equal = PyObject_RichCompareBool
+		      (PyList_GET_ITEM(self->group_names, i), name, Py_EQ))
+		     == -1)
+			return -2;
+		if (equal)
+			return (int) i;
+	}
+	if (!create)
+		return -1;
+	if (n == AHO_CORASICK_GROUPS) {
+		PyErr_Format(PyExc_AssertionError,
+			     "a KeywordTree can't have more than %d groups.",
+			     AHO_CORASICK_GROUPS);
+		return -2;
+	}
+	if (PyList_Append(self->group_names, name) == -1)
+		return -2;
+	return (int) n;
+}
+
+
+
+/* Gets the group masks ready to be changed, with room for the keyword of
+   the given index.  If anything but the tree holds on to them, the tree
+   gets a copy of its own.  Returns 0, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_own_groups(ahocorasick_KeywordTree *self,
+				   Py_ssize_t keyword) {
+	PyObject *groups;
+	Py_ssize_t size = 0;
+	Py_ssize_t capacity;
+
+	if (self->groups != NULL) {
+		size = ahocorasick_groups_size(self->groups);
+		if (keyword < size && Py_REFCNT(self->groups) == 1)
+			return 0;
+	}
+	for (capacity = size > 0 ? size : 16; capacity <= keyword;
+	     capacity *= 2)
+		;
+	if ( (groups = PyByteArray_FromStringAndSize
+	      (NULL, capacity * sizeof(aho_corasick_groups_t))) == NULL)
+		return -1;
+	memset(PyByteArray_AS_STRING(groups), 0,
+	       capacity * sizeof(aho_corasick_groups_t));
+	if (self->groups != NULL)
+		memcpy(PyByteArray_AS_STRING(groups),
+		       PyByteArray_AS_STRING(self->groups),
+		       size * sizeof(aho_corasick_groups_t));
+	Py_XDECREF(self->groups);
+	self->groups = groups;
+	return 0;
+}
+
+
+
+/* Puts a keyword, whose n bytes are given, in the group of the given name,
+   or in none if group is NULL or None.  Either way, once there are groups,
+   the masks get room for the keyword.  Returns 0, or -1 with an exception
+   set. */
+static int
+ahocorasick_KeywordTree_set_group(ahocorasick_KeywordTree *self,
+				  int keyword, unsigned char *bytes,
+				  Py_ssize_t n, PyObject *group) {
+	aho_corasick_groups_t bit;
+	int index;
+
+	if (group == NULL || group == Py_None) {
+		if (self->groups == NULL ||
+		    keyword < ahocorasick_groups_size(self->groups))
+			return 0;
+		return ahocorasick_KeywordTree_own_groups(self, keyword);
+	}
+
+	if ( (index = ahocorasick_KeywordTree_group_bit(self, group, 1)) < 0)
+		return -1;
+	bit = (aho_corasick_groups_t) 1 << index;
+	if (self->groups != NULL &&
+	    keyword < ahocorasick_groups_size(self->groups) &&
+	    (ahocorasick_groups_masks(self->groups)[keyword] & bit) != 0)
+		return 0;
+	if (ahocorasick_KeywordTree_own_groups(self, keyword) == -1)
+		return -1;
+	ahocorasick_groups_masks(self->groups)[keyword] |= bit;
+
+	/* The groups of the states of a made tree don't know about this.
+	   The tree's own are told, and the delta is made again by the next
+	   search. */
+	if (self->made) {
+		if ((aho_corasick_int_t) keyword >= self->tree->nkeywords) {
+			if (ahocorasick_KeywordTree_drop_deltas(self, keyword)
+			    == -1)
+				return -1;
+		}
+		else if (self->state_groups != NULL) {
+			if (ahocorasick_KeywordTree_own_state_groups(self)
+			    == -1)
+				return -1;
+			aho_corasick_joingroup
+				(self->tree, bytes, n, bit,
+				 ahocorasick_KeywordTree_is_removed(self,
+								    keyword),
+				 ahocorasick_groups_masks(self->state_groups));
+		}
+		else if (ahocorasick_KeywordTree_setgroups
+			 (self, ahocorasick_groups_masks(self->groups),
+			  ahocorasick_KeywordTree_removed(self)) == -1)
+			return -1;
+	}
+	return 0;
+}
+
+
+
+/* Works out the groups that a groups argument asks for: a list, tuple or
+   set of group names, or else a single name.  Names that no keyword has
+   been put in don't match anything.  Returns 1 and sets *wanted if only the
+   keywords in those groups should match, 0 if obj is NULL or None and they
+   all should, or -1 with an exception set.  The group masks, and those of
+   the states of a made tree, are made, if there aren't any yet, for the
+   search to look at. */
+static int
+ahocorasick_KeywordTree_get_groups(ahocorasick_KeywordTree *self,
+				   PyObject *obj,
+				   aho_corasick_groups_t *wanted) {
+	PyObject *iter;
+	PyObject *item;
+	Py_ssize_t n;
+	int bit;
+
+	*wanted = 0;
+	if (obj == NULL || obj == Py_None)
+		return 0;
+	if (PyList_Check(obj) || PyTuple_Check(obj) || PyAnySet_Check(obj)) {
+		if ( (iter = PyObject_GetIter(obj)) == NULL)
+			return -1;
+		while ( (item = PyIter_Next(iter)) != NULL) {
+			bit = ahocorasick_KeywordTree_group_bit(self, item, 0);
+			Py_DECREF(item);
+			if (bit == -2)
+				break;
+			if (bit >= 0)
+				*wanted |= (aho_corasick_groups_t) 1 << bit;
+		}
+		Py_DECREF(iter);
+		if (PyErr_Occurred())
+			return -1;
+	}
+	else {
+		if ( (bit = ahocorasick_KeywordTree_group_bit(self, obj, 0))
+		     == -2)
+			return -1;
+		if (bit >= 0)
+			*wanted |= (aho_corasick_groups_t) 1 << bit;
+	}
+
+	if (self->groups == NULL) {
+		n = self->tree->nkeywords;
+		if (self->added != NULL)
+			n += PyDict_Size(self->added);
+		if (ahocorasick_KeywordTree_own_groups(self, n > 0 ? n - 1 : 0)
+		    == -1)
+			return -1;
+	}
+	if (self->made && self->state_groups == NULL &&
+	    ahocorasick_KeywordTree_setgroups
+	    (self, ahocorasick_groups_masks(self->groups),
+	     ahocorasick_KeywordTree_removed(self)) == -1)
+		return -1;
+	return 1;
+}
+
+
+
+/* Adds a keyword to a tree that's been made already.  If it's one of the
+   tree's, it's only taken off the removed ones, and otherwise it goes in
+   with the added keywords, to be searched by way of the deltas.  Returns
+   the index of the keyword, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_add_made(ahocorasick_KeywordTree *self,
+				 unsigned char *bytes, Py_ssize_t n) {
+	PyObject *key;
+	PyObject *index;
+	int keyword;
+
+	if ( (keyword = ahocorasick_KeywordTree_find(self, bytes, n)) == -2)
+		return -1;
+	if (keyword == -1) {
+		if (self->added == NULL &&
+		    (self->added = PyDict_New()) == NULL)
+			return -1;
+		if (self->added_keys == NULL &&
+		    (self->added_keys = PyList_New(0)) == NULL)
+			return -1;
+		keyword = self->tree->nkeywords + PyDict_Size(self->added);
+		if ( (key = ahocorasick_KeywordTree_translate(self, bytes, n))
+		     == NULL)
+			return -1;
+		if ( (index = PyInt_FromLong(keyword)) == NULL) {
+			Py_DECREF(key);
+			return -1;
+		}
+		/* The next search puts it in a delta. */
+		if (PyList_Append(self->added_keys, key) == -1)
+			keyword = -1;
+		else if (PyDict_SetItem(self->added, key, index) == -1) {
+			PySequence_DelItem(self->added_keys, -1);
+			keyword = -1;
+		}
+		Py_DECREF(key);
+		Py_DECREF(index);
+		if (keyword == -1)
+			return -1;
+	}
+	if (ahocorasick_KeywordTree_set_removed(self, keyword, bytes, n, 0)
+	    == -1)
+		return -1;
+	return keyword;
+}
+
+
+
+/* Makes a delta of the keywords added since make() with indexes from
+   start up to end.  Returns it, or NULL with an exception set. */
+static ahocorasick_KeywordTree*
+ahocorasick_KeywordTree_make_delta(ahocorasick_KeywordTree *self,
+				   Py_ssize_t start, Py_ssize_t end) {
+	ahocorasick_KeywordTree *delta;
+	aho_corasick_t *g;
+	aho_corasick_int_t *indexes;
+	aho_corasick_int_t id;
+	PyObject *key;
+	Py_ssize_t i;
+	int keyword;
+
+	if ( (delta = (ahocorasick_KeywordTree *) PyObject_CallObject
+	      ((PyObject *) &ahocorasick_KeywordTreeType, NULL)) == NULL)
+		return NULL;
+	g = delta->tree;
+	g->text = self->tree->text;
+	if ( (indexes = PyMem_New(aho_corasick_int_t, end - start)) == NULL)
+		goto nomemory;
+
+	/* The keywords are translated already, so they go in as they are,
+	   and the table is only put in for make() to fold into the classes
+	   that the queries go through.  Removed ones are left out, so that
+	   the delta is what it would have been without them. */
+	for (i = start; i < end; i++) {
+		if (ahocorasick_KeywordTree_is_removed(self, (int) i))
+			continue;
+		key = PyList_GET_ITEM(self->added_keys,
+				      i - self->tree->nkeywords);
+		if ( (keyword = aho_corasick_addstring
+		      (g, (unsigned char *) PyString_AS_STRING(key),
+		       PyString_GET_SIZE(key))) == -1)
+			goto nomemory;
+		indexes[keyword] = (aho_corasick_int_t) i;
+	}
+	memcpy(g->translate, self->translate, AHO_CORASICK_CHARACTERS);
+	if (aho_corasick_maketree(g, AHO_CORASICK_DFA_MODE) == -1)
+		goto nomemory;
+
+	/* Matches in the delta have to come out with the indexes the
+	   keywords have in this tree. */
+	for (id = 0; id < g->newstate; id++)
+		if (g->outputs[id] != 0)
+			g->keywords[id] = indexes[g->keywords[id]];
+	PyMem_Free(indexes);
+	indexes = NULL;
+	if (self->groups != NULL &&
+	    ahocorasick_KeywordTree_setgroups
+	    (delta, ahocorasick_groups_masks(self->groups), NULL) == -1) {
+		Py_DECREF(delta);
+		return NULL;
+	}
+	delta->count = g->nkeywords;
+	delta->made = 1;
+	return delta;
+
+ nomemory:
+	PyMem_Free(indexes);
+	Py_DECREF(delta);
+	PyErr_NoMemory();
+	return NULL;
+}
+
+
+
+/* Puts the keywords added since the deltas were made in a delta of their
+   own, merging it with the ones before it for as long as they're no more
+   than twice its size, or there are too many deltas.  That keeps each
+   delta over twice the size of the next, so that adding n keywords, with
+   a search after each, makes deltas of O(n log n) keywords in all, rather
+   than making one of all of them every time.  Returns 0, or -1 with an
+   exception set. */
+static int
+ahocorasick_KeywordTree_make_deltas(ahocorasick_KeywordTree *self) {
+	ahocorasick_KeywordTree *delta;
+	PyObject *deltas;
+	Py_ssize_t first = self->tree->nkeywords;
+	Py_ssize_t end = first + PyList_GET_SIZE(self->added_keys);
+	Py_ssize_t n = self->deltas != NULL ? PyTuple_GET_SIZE(self->deltas) : 0;
+	Py_ssize_t start = n > 0 ? self->delta_ends[n - 1] : first;
+	Py_ssize_t i;
+
+	if (start == end)
+		return 0;
+	while (n > 0) {
+		i = self->delta_ends[n - 1] -
+			(n > 1 ? self->delta_ends[n - 2] : first);
+		if (i > 2 * (end - start) && n < AHO_CORASICK_DELTAS)
+			break;
+		start -= i;
+		n--;
+	}
+
+	if ( (delta = ahocorasick_KeywordTree_make_delta(self, start, end))
+	     == NULL)
+		return -1;
+	if ( (deltas = PyTuple_New(n + 1)) == NULL) {
+		Py_DECREF(delta);
+		return -1;
+	}
+	for (i = 0; i < n; i++) {
+		Py_INCREF(PyTuple_GET_ITEM(self->deltas, i));
+		PyTuple_SET_ITEM(deltas, i, PyTuple_GET_ITEM(self->deltas, i));
+	}
+	PyTuple_SET_ITEM(deltas, n, (PyObject *) delta);
+	Py_XDECREF(self->deltas);
+	self->deltas = deltas;
+	self->delta_ends[n] = end;
+	return 0;
+}
+
+
+
+/* Takes a snapshot of the tree for a search.  The delta is made first, if
+   keywords have been added since it last was.  Returns 0, or -1 with an
+   exception set. */
+static int
+ahocorasick_KeywordTree_snapshot(ahocorasick_KeywordTree *self,
+				 ahocorasick_snapshot_t *snapshot) {
+	ahocorasick_KeywordTree *delta;
+	int i;
+
+	snapshot->options.boundaries = NULL;
+	snapshot->options.removed = NULL;
+	snapshot->options.dead = NULL;
+	snapshot->options.ndeltas = 0;
+	snapshot->options.counters = NULL;
+	snapshot->options.groups = NULL;
+	snapshot->options.wanted = 0;
+	snapshot->options.tree_groups = NULL;
+	snapshot->deltas = NULL;
+	snapshot->removed = NULL;
+	snapshot->dead = NULL;
+	snapshot->groups = NULL;
+	snapshot->state_groups = NULL;
+	snapshot->total = NULL;
+	if (self->instrumented) {
+		memset(&snapshot->counters, 0, sizeof(snapshot->counters));
+		snapshot->options.counters = &snapshot->counters;
+		snapshot->total = &self->counters;
+	}
+
+	if (self->added != NULL &&
+	    ahocorasick_KeywordTree_make_deltas(self) == -1)
+		return -1;
+	if (self->deltas != NULL) {
+		snapshot->deltas = self->deltas;
+		Py_INCREF(snapshot->deltas);
+		snapshot->options.ndeltas = (int) PyTuple_GET_SIZE(self->deltas);
+		for (i = 0; i < snapshot->options.ndeltas; i++) {
+			delta = (ahocorasick_KeywordTree *)
+				PyTuple_GET_ITEM(self->deltas, i);
+			snapshot->options.deltas[i] = delta->tree;
+			snapshot->options.delta_groups[i] =
+				ahocorasick_KeywordTree_state_groups(delta);
+		}
+	}
+	if (self->removed != NULL) {
+		snapshot->removed = self->removed;
+		Py_INCREF(snapshot->removed);
+		snapshot->options.removed =
+			(unsigned char *) PyString_AS_STRING(self->removed);
+	}
+	if (self->dead != NULL) {
+		snapshot->dead = self->dead;
+		Py_INCREF(snapshot->dead);
+		snapshot->options.dead =
+			(unsigned char *) PyString_AS_STRING(self->dead);
+	}
+	if (self->groups != NULL) {
+		snapshot->groups = self->groups;
+		Py_INCREF(snapshot->groups);
+	}
+	if (self->state_groups != NULL) {
+		snapshot->state_groups = self->state_groups;
+		Py_INCREF(snapshot->state_groups);
+		snapshot->options.tree_groups =
+			ahocorasick_groups_masks(self->state_groups);
+	}
+	return 0;
+}
+
+
+/* Has the search only find the keywords in the wanted groups.  The tree
+   must have had group masks when the snapshot was taken, which
+   ahocorasick_KeywordTree_get_groups() sees to. */
+static void
+ahocorasick_snapshot_want(ahocorasick_snapshot_t *snapshot,
+			  aho_corasick_groups_t wanted) {
+	snapshot->options.groups = ahocorasick_groups_masks(snapshot->groups);
+	snapshot->options.wanted = wanted;
+}
+
+
+/* The options to hand the search helpers, or NULL if there's nothing to
+   them, so that the helpers can take their quick way through. */
+static const aho_corasick_options_t *
+ahocorasick_snapshot_options(ahocorasick_snapshot_t *snapshot) {
+	aho_corasick_options_t *options = &snapshot->options;
+	if (options->boundaries == NULL && options->removed == NULL &&
+	    options->ndeltas == 0 && options->counters == NULL &&
+	    options->groups == NULL)
+		return NULL;
+	return options;
+}
+
+
+/* Adds what one set of counters counted to another. */
+static void
+ahocorasick_counters_add(aho_corasick_counters_t *total,
+			 const aho_corasick_counters_t *counters) {
+	total->bytes += counters->bytes;
+	total->skipped += counters->skipped;
+	total->transitions += counters->transitions;
+	total->fails += counters->fails;
+	total->matches += counters->matches;
+}
+
+
+/* Adds what the search counted so far to the tree's total, and starts
+   counting again from zero.  Must be called with the interpreter lock. */
+static void
+ahocorasick_snapshot_flush(ahocorasick_snapshot_t *snapshot) {
+	if (snapshot->total == NULL)
+		return;
+	ahocorasick_counters_add(snapshot->total, &snapshot->counters);
+	memset(&snapshot->counters, 0, sizeof(snapshot->counters));
+}
+
+
+static void
+ahocorasick_snapshot_release(ahocorasick_snapshot_t *snapshot) {
+	ahocorasick_snapshot_flush(snapshot);
+	snapshot->total = NULL;
+	Py_CLEAR(snapshot->deltas);
+	Py_CLEAR(snapshot->removed);
+	Py_CLEAR(snapshot->dead);
+	Py_CLEAR(snapshot->groups);
+	Py_CLEAR(snapshot->state_groups);
+}
+
+
+
+/* Adds one keyword, with its value if value isn't NULL, and puts it in the
+   group if group isn't NULL.  Before make(), if path isn't NULL, the
+   keyword is added along the path of the one added before it.  Returns the
+   index of the keyword, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_add_one(ahocorasick_KeywordTree *self,
+				PyObject *keywordObject, PyObject *value,
+				PyObject *group, aho_corasick_path_t *path) {
+	Py_buffer newKeyword;
+	int keyword;
+
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return -1;
+	if (ahocorasick_KeywordTree_getquery(self, keywordObject,
+					     &newKeyword) == -1)
+		return -1;
+
+
+	/* Check for empty string: the underlying C implementation function
+	   aho_corasick_addstring() crashes on empty string input, so let's
+	   catch that before we enter. */
+	if (newKeyword.len == 0) {
+		PyErr_SetString(PyExc_AssertionError,
+				"add() cannot take the empty string");
+		goto fail;
+	}
+
+	if (self->made) {
+		keyword = ahocorasick_KeywordTree_add_made(self, newKeyword.buf,
+							   newKeyword.len);
+		if (keyword == -1)
+			goto fail;
+	}
+	else {
+		/* The only time we get -1 from addstring is on memory
+		   error, but let's make sure to trace that. */
+		if (path != NULL)
+			keyword = aho_corasick_addstring_path
+				(self->tree, path, newKeyword.buf,
+				 newKeyword.len);
+		else
+			keyword = aho_corasick_addstring
+				(self->tree, newKeyword.buf, newKeyword.len);
+		if (keyword == -1) {
+			PyErr_SetString(PyExc_MemoryError,
+					"internal error: aho_corasick_addstring reports memory allocation error");
+			goto fail;
+		}
+	}
+	self->count++;
+
+	/* A keyword that's added again keeps its index, but takes the new
+	   value, if there is one.  A load()ed tree has no values to start
+	   with. */
+	while (keyword > PyList_GET_SIZE(self->values)) {
+		if (PyList_Append(self->values, Py_None) == -1)
+			goto fail;
+	}
+	if (keyword == PyList_GET_SIZE(self->values)) {
+		if (PyList_Append(self->values,
+				  value != NULL ? value : Py_None) == -1)
+			goto fail;
+	}
+	else if (value != NULL) {
+		Py_INCREF(value);
+		if (PyList_SetItem(self->values, keyword, value) == -1)
+			goto fail;
+	}
+
+	/* Likewise, it stays in the groups it was in, and joins the new
+	   one. */
+	if (ahocorasick_KeywordTree_set_group(self, keyword, newKeyword.buf,
+					      newKeyword.len, group) == -1)
+		goto fail;
+	PyBuffer_Release(&newKeyword);
+	return keyword;
+
+ fail:
+	PyBuffer_Release(&newKeyword);
+	return -1;
+}
+
+
+
 /* Adds a new keyword to the KeywordTree. */
 static PyObject*
 ahocorasick_KeywordTree_add(ahocorasick_KeywordTree *self,
 			    PyObject *args,
 			    PyObject *kwargs) {
-	unsigned char *newKeyword;
-	Py_ssize_t n;
-	static char *kwlist[] = {"keyword", NULL};
+	PyObject *keywordObject;
+	PyObject *value = NULL;
+	PyObject *group = NULL;
+	int keyword;
+	static char *kwlist[] = {"keyword", "value", "group", NULL};
 	if (! PyArg_ParseTupleAndKeywords
-	    (args, kwargs, "s#", kwlist, &newKeyword, &n)) {
+	    (args, kwargs, "O|OO", kwlist, &keywordObject, &value, &group)) {
 		return NULL;
 	}
+	if ( (keyword = ahocorasick_KeywordTree_add_one(self, keywordObject,
+							value, group,
+							NULL)) == -1)
+		return NULL;
+	return PyInt_FromLong(keyword);
+}
 
 
-	/* Check for empty string: the underlying C implementation function
-	   aho_corasick_addstring() crashes on empty string input, so let's
-	   catch that before we enter. */
-	if (n == 0) {
+
+/* Adds every keyword that an iterable gives, in one call.  Each item is a
+   keyword, or a 2-tuple (keyword, value).  If a group is given, they all
+   go in it.  Each keyword picks up from
+   where it parts ways with the one before it, so sorted keywords go in
+   the quickest. */
+static PyObject*
+ahocorasick_KeywordTree_add_many(ahocorasick_KeywordTree *self,
+				 PyObject *args,
+				 PyObject *kwargs) {
+	PyObject *keywords;
+	PyObject *iter;
+	PyObject *item;
+	PyObject *keywordObject;
+	PyObject *value;
+	PyObject *group = NULL;
+	aho_corasick_path_t path;
+	int keyword = 0;
+	static char *kwlist[] = {"keywords", "group", NULL};
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|O", kwlist, &keywords, &group)) {
+		return NULL;
+	}
+	if ( (iter = PyObject_GetIter(keywords)) == NULL)
+		return NULL;
+
+	aho_corasick_path_init(&path);
+	while (keyword != -1 && (item = PyIter_Next(iter)) != NULL) {
+		keywordObject = item;
+		value = NULL;
+		if (PyTuple_Check(item) && PyTuple_GET_SIZE(item) == 2) {
+			keywordObject = PyTuple_GET_ITEM(item, 0);
+			value = PyTuple_GET_ITEM(item, 1);
+		}
+		keyword = ahocorasick_KeywordTree_add_one(self, keywordObject,
+							  value, group, &path);
+		Py_DECREF(item);
+	}
+	aho_corasick_path_destroy(&path);
+	Py_DECREF(iter);
+	if (keyword == -1 || PyErr_Occurred())
+		return NULL;
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+
+/* Takes a keyword out of a made tree.  It's only marked as removed, and
+   searches leave it out from then on. */
+static PyObject*
+ahocorasick_KeywordTree_remove(ahocorasick_KeywordTree *self,
+			       PyObject *args,
+			       PyObject *kwargs) {
+	PyObject *keywordObject;
+	Py_buffer oldKeyword;
+	int keyword;
+	static char *kwlist[] = {"keyword", NULL};
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O", kwlist, &keywordObject)) {
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyErr_SetString(PyExc_AssertionError,
+				"remove() can only be called once a tree has been finalized with make()");
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_getquery(self, keywordObject,
+					     &oldKeyword) == -1)
+		return NULL;
+	keyword = ahocorasick_KeywordTree_find(self, oldKeyword.buf,
+					       oldKeyword.len);
+	if (keyword == -1 ||
+	    (keyword >= 0 &&
+	     ahocorasick_KeywordTree_is_removed(self, keyword))) {
+		PyErr_SetString(PyExc_ValueError,
+				"remove() was given a keyword that isn't in the tree");
+		keyword = -2;
+	}
+	if (keyword >= 0 &&
+	    ahocorasick_KeywordTree_set_removed(self, keyword, oldKeyword.buf,
+						oldKeyword.len, 1) == -1)
+		keyword = -2;
+	PyBuffer_Release(&oldKeyword);
+	if (keyword == -2)
+		return NULL;
+	if (keyword < PyList_GET_SIZE(self->values)) {
+		Py_INCREF(Py_None);
+		if (PyList_SetItem(self->values, keyword, Py_None) == -1)
+			return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+
+/* Builds the tuple for one match: (start, end), or (start, end, value) if
+   with_value is set.  The value is whatever was given to add() for the
+   keyword, or else the keyword's index. */
+static PyObject*
+ahocorasick_KeywordTree_match(ahocorasick_KeywordTree *self,
+			      size_t start, size_t end,
+			      aho_corasick_int_t keyword, int with_value) {
+	PyObject *value;
+
+	if (!with_value)
+		return Py_BuildValue("(ll)", start, end);
+
+	if ((Py_ssize_t) keyword < PyList_GET_SIZE(self->values) &&
+	    PyList_GET_ITEM(self->values, keyword) != Py_None)
+		return Py_BuildValue("(llO)", start, end,
+				     PyList_GET_ITEM(self->values, keyword));
+
+	if ( (value = PyInt_FromLong(keyword)) == NULL)
+		return NULL;
+	return Py_BuildValue("(llN)", start, end, value);
+}
+
+
+
+
+/* Checks the startpos and endpos given along with a query, and clips endpos
+   to the end of the query.  In text mode, they are given in characters, and
+   get turned into byte offsets here.  Raises an AssertionError and returns
+   -1 if either is negative. */
+static int
+ahocorasick_KeywordTree_check_bounds(ahocorasick_KeywordTree *self,
+				     Py_buffer *query, Py_ssize_t *startpos,
+				     Py_ssize_t *endpos) {
+	/* Check startpos bounds.  Assert that they're within the query
+	   string. */
+	if (*startpos < 0) {
+		PyErr_SetString(PyExc_AssertionError,
+				"startpos can't be negative.");
+		return -1;
+	}
+	if (*endpos < 0) {
+		PyErr_SetString(PyExc_AssertionError,
+				"endpos can't be negative.");
+		return -1;
+	}
+	if (self->tree->text) {
+		/* There are never more characters than bytes. */
+		if (*endpos < query->len)
+			*endpos = aho_corasick_utf8_offset(query->buf,
+							   query->len,
+							   *endpos);
+		*startpos = aho_corasick_utf8_offset(query->buf, *endpos,
+						     *startpos);
+	}
+	if (*endpos > query->len)
+		*endpos = query->len;
+	return 0;
+}
+
+
+
+/* Works out the boundaries table that a word_boundaries argument asks for.
+   A string gives the bytes that separate words; anything else that's true
+   means the usual notion of a word.  boundaries is set to table, or to
+   NULL if matches can fall anywhere.  Returns 0 on success, -1 with an
+   exception set on failure. */
+static int
+ahocorasick_get_boundaries(PyObject *obj, unsigned char *table,
+			   const unsigned char **boundaries) {
+	char *bytes;
+	Py_ssize_t n, i;
+	int truth;
+
+	*boundaries = NULL;
+	if (obj == NULL)
+		return 0;
+	if (PyString_Check(obj)) {
+		if (PyString_AsStringAndSize(obj, &bytes, &n) == -1)
+			return -1;
+		memset(table, 0, AHO_CORASICK_CHARACTERS);
+		for (i = 0; i < n; i++)
+			table[(unsigned char) bytes[i]] = 1;
+		*boundaries = table;
+		return 0;
+	}
+	if ((truth = PyObject_IsTrue(obj)) == -1)
+		return -1;
+	if (truth) {
+		aho_corasick_word_boundaries(table);
+		*boundaries = table;
+	}
+	return 0;
+}
+
+
+
+/* Given a string, searches for the first keyword.  Either returns None, or a
+   2-tuple (start, end).  Since search() and search_long() are so similar, I
+   extract the common elements of both here, and specialize by using a helper
+   function pointer. */
+static PyObject*
+ahocorasick_KeywordTree_basesearch(ahocorasick_KeywordTree *self,
+				   PyObject *args, PyObject *kwargs,
+				   ahocorasick_KeywordTree_search_helper_t helper) {
+	PyObject *queryObject;
+	Py_buffer query;
+	int found;
+	aho_corasick_match_t match;
+	aho_corasick_matches_t matches;
+	ahocorasick_snapshot_t snapshot;
+	const aho_corasick_options_t *options;
+	static char *kwlist[] = {"query", "startpos", "with_value", "endpos",
+				 "word_boundaries", "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int with_value = 0;
+	PyObject *boundariesObject = NULL;
+	unsigned char table[AHO_CORASICK_CHARACTERS];
+	const unsigned char *boundaries;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|ninOO", kwlist, &queryObject, &startpos,
+	     &with_value, &endpos, &boundariesObject, &groupsObject)) {
+		return NULL;
+	}
+	if (ahocorasick_get_boundaries(boundariesObject, table,
+				       &boundaries) == -1)
+		return NULL;
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	/* Before searching, the KeywordTree must have been make()ed. earlier,
+	   or else the search doesn't work. */
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before search() to finalize tree construction.");
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+	snapshot.options.boundaries = boundaries;
+	if (grouped)
+		ahocorasick_snapshot_want(&snapshot, wanted);
+	options = ahocorasick_snapshot_options(&snapshot);
+	
+	AHOCORASICK_BEGIN_SEARCH(endpos)
+		found = (*helper)(self->tree, query.buf, (size_t) endpos,
+				  (size_t) startpos, options, &match);
+	if (found && self->tree->text) {
+		matches.data = &match;
+		matches.size = matches.capacity = 1;
+		aho_corasick_matches_to_chars(query.buf, match.end,
+					      0, 0, &matches);
+	}
+	AHOCORASICK_END_SEARCH
+	PyBuffer_Release(&query);
+	ahocorasick_snapshot_release(&snapshot);
+
+	if (found) {
+	  return ahocorasick_KeywordTree_match(self, match.start, match.end,
+					       match.keyword, with_value);
+	}
+
+	/* If we get to this point, the search has failed. */
+	Py_INCREF(Py_None);
+	return Py_None; 
+}
+
+
+
+/* Given a string, searches for the first keyword.  Either returns None, or a
+   2-tuple (start, end). */
+static PyObject*
+ahocorasick_KeywordTree_search(ahocorasick_KeywordTree *self,
+			       PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basesearch
+		(self, args, kwargs,
+		 ahocorasick_KeywordTree_search_helper);
+}
+
+
+
+/* Given a string, searches for the first keyword.  Either returns None, or a
+   2-tuple (start, end).  Tries to match as long a keyword as it can.*/
+static PyObject*
+ahocorasick_KeywordTree_search_long(ahocorasick_KeywordTree *self,
+				    PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basesearch
+		(self, args, kwargs,
+		 ahocorasick_KeywordTree_search_long_helper);
+}
+
+
+
+
+
+
+/* Turns the matches into a list of match tuples. */
+static PyObject*
+ahocorasick_KeywordTree_matches_to_list(ahocorasick_KeywordTree *self,
+					aho_corasick_matches_t *matches,
+					int with_value) {
+	PyObject *list;
+	PyObject *match;
+	size_t i;
+
+	if ( (list = PyList_New(matches->size)) == NULL)
+		return NULL;
+	for (i = 0; i < matches->size; i++) {
+		if ( (match = ahocorasick_KeywordTree_match
+		      (self, matches->data[i].start, matches->data[i].end,
+		       matches->data[i].keyword,
+		       with_value)) == NULL) {
+			Py_DECREF(list);
+			return NULL;
+		}
+		PyList_SET_ITEM(list, i, match);
+	}
+	return list;
+}
+
+
+
+/* Makes a new array('l') of n zeros, and points *items at its storage. */
+static PyObject*
+ahocorasick_new_long_array(Py_ssize_t n, long **items) {
+	PyObject *zero;
+	PyObject *array;
+	void *buffer;
+	Py_ssize_t size;
+
+	if ( (zero = PyObject_CallFunction(ahocorasick_array_type, "s[i]",
+					   "l", 0)) == NULL)
+		return NULL;
+	array = PySequence_Repeat(zero, n);
+	Py_DECREF(zero);
+	if (array == NULL)
+		return NULL;
+	if (PyObject_AsWriteBuffer(array, &buffer, &size) == -1) {
+		Py_DECREF(array);
+		return NULL;
+	}
+	*items = buffer;
+	return array;
+}
+
+
+
+/* Turns the matches found in n buffers into one struct of arrays: a tuple
+   of array('l')s (starts, ends, keywords), with a leading array of the
+   index of the buffer that each match is in if with_docs is set.  That
+   costs a few machine words per match, rather than a tuple and its ints. */
+static PyObject*
+ahocorasick_KeywordTree_matches_to_arrays(ahocorasick_KeywordTree *self,
+					  aho_corasick_matches_t *results,
+					  Py_ssize_t n, int with_docs) {
+	PyObject *arrays[4] = {NULL, NULL, NULL, NULL};
+	long *items[4];
+	PyObject *tuple = NULL;
+	Py_ssize_t total = 0, k = 0, j;
+	size_t i;
+	int a;
+
+	for (j = 0; j < n; j++)
+		total += results[j].size;
+	for (a = 0; a < 4; a++)
+		if ( (arrays[a] = ahocorasick_new_long_array(total, &items[a]))
+		     == NULL)
+			goto finally;
+
+	for (j = 0; j < n; j++) {
+		for (i = 0; i < results[j].size; i++, k++) {
+			items[0][k] = (long) j;
+			items[1][k] = (long) results[j].data[i].start;
+			items[2][k] = (long) results[j].data[i].end;
+			items[3][k] = (long) results[j].data[i].keyword;
+		}
+	}
+
+	if (with_docs)
+		tuple = PyTuple_Pack(4, arrays[0], arrays[1], arrays[2],
+				     arrays[3]);
+	else
+		tuple = PyTuple_Pack(3, arrays[1], arrays[2], arrays[3]);
+
+ finally:
+	for (a = 0; a < 4; a++)
+		Py_XDECREF(arrays[a]);
+	return tuple;
+}
+
+
+
+/* Scans a snapshot of the tree for matches with the helper, letting go of
+   the interpreter lock if the query is long enough.  If grouped is set,
+   only the keywords in the wanted groups match.  Returns 0 on success,
+   or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_scan(ahocorasick_KeywordTree *self,
+			     ahocorasick_KeywordTree_search_helper_t helper,
+			     Py_buffer *query, Py_ssize_t startpos,
+			     Py_ssize_t endpos,
+			     const unsigned char *boundaries,
+			     int grouped, aho_corasick_groups_t wanted,
+			     int allow_overlaps,
+			     aho_corasick_matches_t *matches) {
+	int status;
+	ahocorasick_snapshot_t snapshot;
+	const aho_corasick_options_t *options;
+
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1)
+		return -1;
+	snapshot.options.boundaries = boundaries;
+	if (grouped)
+		ahocorasick_snapshot_want(&snapshot, wanted);
+	options = ahocorasick_snapshot_options(&snapshot);
+
+	AHOCORASICK_BEGIN_SEARCH(endpos)
+		status = ahocorasick_KeywordTree_findall_helper
+			(self->tree, helper, query->buf, (size_t) endpos,
+			 (size_t) startpos, options, allow_overlaps,
+			 matches);
+	if (status == 0 && self->tree->text)
+		aho_corasick_matches_to_chars(query->buf, (size_t) endpos,
+					      0, 0, matches);
+	AHOCORASICK_END_SEARCH
+	ahocorasick_snapshot_release(&snapshot);
+
+	if (status == -1)
+		PyErr_NoMemory();
+	return status;
+}
+
+
+
+/* Given a string, collects every match into a list of 2-tuples (start, end).
+   Like basesearch(), this is shared between findall() and findall_long(),
+   specialized by the helper function pointer.  The whole scan happens in
+   one C call, with the interpreter lock let go, and only then do the
+   matches get turned into tuples. */
+static PyObject*
+ahocorasick_KeywordTree_basefindall(ahocorasick_KeywordTree *self,
+				    PyObject *args, PyObject *kwargs,
+				    ahocorasick_KeywordTree_search_helper_t helper) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "allow_overlaps",
+				 "with_value", "endpos", "word_boundaries",
+				 "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int allow_overlaps = 0;
+	int with_value = 0;
+	PyObject *boundariesObject = NULL;
+	unsigned char table[AHO_CORASICK_CHARACTERS];
+	const unsigned char *boundaries;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	int status;
+	aho_corasick_matches_t matches;
+	PyObject *list;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|niinOO", kwlist, &queryObject, &startpos,
+	     &allow_overlaps, &with_value, &endpos, &boundariesObject,
+	     &groupsObject)) {
+		return NULL;
+	}
+	if (ahocorasick_get_boundaries(boundariesObject, table,
+				       &boundaries) == -1)
+		return NULL;
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before findall() to finalize tree construction.");
+		return NULL;
+	}
+
+	aho_corasick_matches_init(&matches);
+	status = ahocorasick_KeywordTree_scan(self, helper, &query, startpos,
+					      endpos, boundaries, grouped,
+					      wanted, allow_overlaps,
+					      &matches);
+	PyBuffer_Release(&query);
+
+	list = NULL;
+	if (status == 0)
+		list = ahocorasick_KeywordTree_matches_to_list(self, &matches,
+							       with_value);
+	aho_corasick_matches_destroy(&matches);
+	return list;
+}
+
+
+
+/* Returns a list of all the nonoverlapping matches, using search(). */
+static PyObject*
+ahocorasick_KeywordTree_findall(ahocorasick_KeywordTree *self,
+				PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basefindall
+		(self, args, kwargs,
+		 ahocorasick_KeywordTree_search_helper);
+}
+
+
+
+/* Returns a list of all the nonoverlapping matches, using search_long(). */
+static PyObject*
+ahocorasick_KeywordTree_findall_long(ahocorasick_KeywordTree *self,
+				     PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basefindall
+		(self, args, kwargs,
+		 ahocorasick_KeywordTree_search_long_helper);
+}
+
+
+
+/* Same as findall(), or findall_long() if longest is set, but returns the
+   matches as a 3-tuple of arrays (starts, ends, keywords). */
+static PyObject*
+ahocorasick_KeywordTree_findall_array(ahocorasick_KeywordTree *self,
+				      PyObject *args, PyObject *kwargs) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "allow_overlaps",
+				 "endpos", "longest", "word_boundaries",
+				 "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int allow_overlaps = 0;
+	int longest = 0;
+	PyObject *boundariesObject = NULL;
+	unsigned char table[AHO_CORASICK_CHARACTERS];
+	const unsigned char *boundaries;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	int status;
+	aho_corasick_matches_t matches;
+	PyObject *arrays;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|niniOO", kwlist, &queryObject, &startpos,
+	     &allow_overlaps, &endpos, &longest, &boundariesObject,
+	     &groupsObject)) {
+		return NULL;
+	}
+	if (ahocorasick_get_boundaries(boundariesObject, table,
+				       &boundaries) == -1)
+		return NULL;
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before findall_array() to finalize tree construction.");
+		return NULL;
+	}
+
+	aho_corasick_matches_init(&matches);
+	status = ahocorasick_KeywordTree_scan
+		(self, longest ? ahocorasick_KeywordTree_search_long_helper
+		 : ahocorasick_KeywordTree_search_helper,
+		 &query, startpos, endpos, boundaries, grouped, wanted,
+		 allow_overlaps, &matches);
+	PyBuffer_Release(&query);
+
+	arrays = NULL;
+	if (status == 0)
+		arrays = ahocorasick_KeywordTree_matches_to_arrays
+			(self, &matches, 1, 0);
+	aho_corasick_matches_destroy(&matches);
+	return arrays;
+}
+
+
+
+
+
+
+/* Given a string, returns True if any keyword occurs in it.  Nothing is
+   made of the match but that. */
+static PyObject*
+ahocorasick_KeywordTree_contains(ahocorasick_KeywordTree *self,
+				 PyObject *args, PyObject *kwargs) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "endpos",
+				 "word_boundaries", "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	PyObject *boundariesObject = NULL;
+	unsigned char table[AHO_CORASICK_CHARACTERS];
+	const unsigned char *boundaries;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	int found;
+	aho_corasick_match_t match;
+	ahocorasick_snapshot_t snapshot;
+	const aho_corasick_options_t *options;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|nnOO", kwlist, &queryObject, &startpos,
+	     &endpos, &boundariesObject, &groupsObject)) {
+		return NULL;
+	}
+	if (ahocorasick_get_boundaries(boundariesObject, table,
+				       &boundaries) == -1)
+		return NULL;
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before contains() to finalize tree construction.");
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+	snapshot.options.boundaries = boundaries;
+	if (grouped)
+		ahocorasick_snapshot_want(&snapshot, wanted);
+	options = ahocorasick_snapshot_options(&snapshot);
+
+	AHOCORASICK_BEGIN_SEARCH(endpos)
+		found = ahocorasick_KeywordTree_search_helper
+			(self->tree, query.buf, (size_t) endpos,
+			 (size_t) startpos, options, &match);
+	AHOCORASICK_END_SEARCH
+	PyBuffer_Release(&query);
+	ahocorasick_snapshot_release(&snapshot);
+
+	return PyBool_FromLong(found);
+}
+
+
+
+/* Counts the matches that findall(), or findall_long() if longest is set,
+   would find, without making anything of them.  Returns the number of
+   them, or if histogram is set, an array('l') of how many of them there
+   are of each keyword, indexed by keyword.  name is the method we're
+   doing this for, for the error messages. */
+static PyObject*
+ahocorasick_KeywordTree_basecount(ahocorasick_KeywordTree *self,
+				  PyObject *args, PyObject *kwargs,
+				  int histogram, const char *name) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "allow_overlaps",
+				 "endpos", "longest", "word_boundaries",
+				 "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int allow_overlaps = 0;
+	int longest = 0;
+	PyObject *boundariesObject = NULL;
+	unsigned char table[AHO_CORASICK_CHARACTERS];
+	const unsigned char *boundaries;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	Py_ssize_t nkeywords;
+	size_t total;
+	long *counts = NULL;
+	PyObject *array = NULL;
+	ahocorasick_snapshot_t snapshot;
+	const aho_corasick_options_t *options;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|niniOO", kwlist, &queryObject, &startpos,
+	     &allow_overlaps, &endpos, &longest, &boundariesObject,
+	     &groupsObject)) {
+		return NULL;
+	}
+	if (ahocorasick_get_boundaries(boundariesObject, table,
+				       &boundaries) == -1)
+		return NULL;
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_Format(PyExc_AssertionError,
+			     "make() must be called before %s() to finalize tree construction.",
+			     name);
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+	snapshot.options.boundaries = boundaries;
+	if (grouped)
+		ahocorasick_snapshot_want(&snapshot, wanted);
+	options = ahocorasick_snapshot_options(&snapshot);
+
+	/* The keywords added since make() are numbered on from the tree's. */
+	if (histogram) {
+		nkeywords = self->tree->nkeywords;
+		if (self->added != NULL)
+			nkeywords += PyDict_Size(self->added);
+		if ( (array = ahocorasick_new_long_array(nkeywords, &counts))
+		     == NULL) {
+			PyBuffer_Release(&query);
+			ahocorasick_snapshot_release(&snapshot);
+			return NULL;
+		}
+	}
+
+	AHOCORASICK_BEGIN_SEARCH(endpos)
+		total = ahocorasick_KeywordTree_count_helper
+			(self->tree, longest ?
+			 ahocorasick_KeywordTree_search_long_helper :
+			 ahocorasick_KeywordTree_search_helper,
+			 query.buf, (size_t) endpos, (size_t) startpos,
+			 options, allow_overlaps, counts);
+	AHOCORASICK_END_SEARCH
+	PyBuffer_Release(&query);
+	ahocorasick_snapshot_release(&snapshot);
+
+	if (histogram)
+		return array;
+	return PyInt_FromSize_t(total);
+}
+
+
+
+static PyObject*
+ahocorasick_KeywordTree_count(ahocorasick_KeywordTree *self,
+			      PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basecount(self, args, kwargs, 0,
+						 "count");
+}
+
+
+
+static PyObject*
+ahocorasick_KeywordTree_counts(ahocorasick_KeywordTree *self,
+			       PyObject *args, PyObject *kwargs) {
+	return ahocorasick_KeywordTree_basecount(self, args, kwargs, 1,
+						 "counts");
+}
+
+
+
+
+
+
+/* Levels with fewer states than this are built by make()'s own thread
+   alone, since waking the others up would cost more than it saves; bigger
+   ones are shared out this many states at a time. */
+#define AHOCORASICK_MAKE_CHUNK 512
+
+
+/* The work shared out between make()'s threads.  The states of one level
+   of the tree are handed out a chunk at a time; once they're all done,
+   the last thread to finish lets go of the done lock, and make() moves on
+   to the next level and lets go of each thread's start lock again. */
+typedef struct {
+	aho_corasick_t *tree;
+	aho_corasick_build_t *build;
+	aho_corasick_int_t next;	/* the next state nobody has claimed */
+	aho_corasick_int_t end;		/* where the level ends */
+	int running;		/* threads still busy with the level */
+	int quit;		/* set once there are no levels left */
+	PyThread_type_lock lock;	/* guards next and running */
+	PyThread_type_lock done;
+	PyThread_type_lock *start;	/* one for each thread but make()'s */
+} ahocorasick_build_pool_t;
+
+
+/* Works through the states of the current level, a chunk at a time, until
+   they're all claimed.  Lets go of the done lock if this was the last
+   thread busy with them. */
+static void
+ahocorasick_build_pool_level(ahocorasick_build_pool_t *pool) {
+	aho_corasick_int_t from, to;
+	int last;
+
+	for (;;) {
+		PyThread_acquire_lock(pool->lock, WAIT_LOCK);
+		from = pool->next;
+		to = pool->end - from > AHOCORASICK_MAKE_CHUNK ?
+			from + AHOCORASICK_MAKE_CHUNK : pool->end;
+		pool->next = to;
+		PyThread_release_lock(pool->lock);
+		if (from == to)
+			break;
+		aho_corasick_build_states(pool->tree, pool->build, from, to);
+	}
+
+	PyThread_acquire_lock(pool->lock, WAIT_LOCK);
+	last = (--pool->running == 0);
+	PyThread_release_lock(pool->lock);
+	if (last)
+		PyThread_release_lock(pool->done);
+}
+
+
+typedef struct {
+	ahocorasick_build_pool_t *pool;
+	PyThread_type_lock start;
+} ahocorasick_build_worker_t;
+
+
+/* The body of each of make()'s other threads.  Like the search_many()
+   threads, this runs without the interpreter lock. */
+static void
+ahocorasick_build_worker(void *arg) {
+	ahocorasick_build_pool_t *pool = ((ahocorasick_build_worker_t *) arg)->pool;
+	PyThread_type_lock start = ((ahocorasick_build_worker_t *) arg)->start;
+
+	int quit;
+
+	for (;;) {
+		PyThread_acquire_lock(start, WAIT_LOCK);
+		/* make() frees the pool as soon as done is let go after
+		   quit, so quit has to be read before. */
+		quit = pool->quit;
+		ahocorasick_build_pool_level(pool);
+		if (quit)
+			return;
+	}
+}
+
+
+/* Makes the tree like aho_corasick_maketree() does, but a level at a time,
+   sharing each big level out between workers threads, make()'s own
+   included.  Returns 0, or -1 with an exception set. */
+static int
+ahocorasick_KeywordTree_build_parallel(aho_corasick_t *tree,
+				       aho_corasick_mode_t mode,
+				       int workers) {
+	aho_corasick_build_t build;
+	ahocorasick_build_pool_t pool;
+	ahocorasick_build_worker_t *threads;
+	aho_corasick_int_t from, to;
+	int i, started = 0, result = -1;
+
+	pool.tree = tree;
+	pool.build = &build;
+	pool.quit = 0;
+	pool.lock = PyThread_allocate_lock();
+	pool.done = PyThread_allocate_lock();
+	threads = PyMem_New(ahocorasick_build_worker_t, workers);
+	for (i = 0; threads != NULL && i < workers - 1; i++)
+		threads[i].start = NULL;
+	if (pool.lock == NULL || pool.done == NULL || threads == NULL)
+		goto nomemory;
+	for (i = 0; i < workers - 1; i++) {
+		if ( (threads[i].start = PyThread_allocate_lock()) == NULL)
+			goto nomemory;
+		threads[i].pool = &pool;
+	}
+	if (aho_corasick_build_begin(tree, &build, mode) == -1) {
+		PyErr_SetString(PyExc_MemoryError,
+				"internal error: aho_corasick_maketree reports memory allocation error");
+		goto finally;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	PyThread_acquire_lock(pool.done, WAIT_LOCK);
+	/* Each thread waits on its start lock for a level to come up. */
+	for (i = 0; i < workers - 1; i++) {
+		PyThread_acquire_lock(threads[i].start, WAIT_LOCK);
+		if (PyThread_start_new_thread(ahocorasick_build_worker,
+					      &threads[i]) == -1)
+			break;
+		started++;
+	}
+
+	for (from = 1; from < build.n; from = to) {
+		to = aho_corasick_build_level(&build, from);
+		if (started == 0 || to - from < 2 * AHOCORASICK_MAKE_CHUNK) {
+			aho_corasick_build_states(tree, &build, from, to);
+			continue;
+		}
+		pool.next = from;
+		pool.end = to;
+		pool.running = started + 1;
+		for (i = 0; i < started; i++)
+			PyThread_release_lock(threads[i].start);
+		ahocorasick_build_pool_level(&pool);
+		PyThread_acquire_lock(pool.done, WAIT_LOCK);
+	}
+
+	/* Send the threads home, with an empty level to finish. */
+	if (started > 0) {
+		pool.next = pool.end = 0;
+		pool.running = started;
+		pool.quit = 1;
+		for (i = 0; i < started; i++)
+			PyThread_release_lock(threads[i].start);
+		PyThread_acquire_lock(pool.done, WAIT_LOCK);
+	}
+	PyThread_release_lock(pool.done);
+	Py_END_ALLOW_THREADS
+
+	aho_corasick_build_end(tree, &build);
+	result = 0;
+	goto finally;
+
+ nomemory:
+	PyErr_NoMemory();
+ finally:
+	if (threads != NULL) {
+		for (i = 0; i < workers - 1; i++)
+			if (threads[i].start != NULL)
+				PyThread_free_lock(threads[i].start);
+		PyMem_Free(threads);
+	}
+	if (pool.lock != NULL)
+		PyThread_free_lock(pool.lock);
+	if (pool.done != NULL)
+		PyThread_free_lock(pool.done);
+	return result;
+}
+
+
+
+/* Once the keywords have been passed into the tree, maketree does some final
+   construction of the keyword tree.
+
+   We must make sure that maketree has not be called multiple times.  If it
+   is, ignore the call.
+
+   The optional mode argument may be "dfa", in which case the failure
+   transitions are precompiled into a flat transition table.  With more
+   than one worker, the levels of the tree are built by that many threads.
+*/
+static PyObject*
+ahocorasick_KeywordTree_maketree(ahocorasick_KeywordTree *self,
+				 PyObject *args,
+				 PyObject *kwargs) {
+	static char *kwlist[] = {"mode", "workers", "fanout", "budget", NULL};
+	char *modeString = NULL;
+	int workers = 1;
+	int fanout = 0;
+	Py_ssize_t budget = -1;
+	int status;
+	aho_corasick_mode_t mode = AHO_CORASICK_GOTO_MODE;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "|ziin", kwlist, &modeString, &workers, &fanout,
+	     &budget)) {
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return NULL;
+
+	if (workers < 1) {
+		PyErr_SetString(PyExc_AssertionError,
+				"workers must be at least 1.");
+		return NULL;
+	}
+
+	if (fanout < 0) {
+		PyErr_SetString(PyExc_AssertionError,
+				"fanout can't be negative.");
+		return NULL;
+	}
+
+	if (modeString != NULL) {
+		if (strcmp(modeString, "dfa") == 0) {
+			mode = AHO_CORASICK_DFA_MODE;
+		}
+		else if (strcmp(modeString, "goto") != 0) {
+			PyErr_SetString(PyExc_AssertionError,
+					"mode must be either \"goto\" or \"dfa\".");
+			return NULL;
+		}
+	}
+
+	if (!self->made) {
+		if (self->count == 0) {
+			PyErr_SetString(PyExc_AssertionError,
+					"make() can not be called until at least one string has been add()ed.");
+			return NULL;
+		}
+		self->tree->policy.fanout = (aho_corasick_int_t) fanout;
+		self->tree->policy.budget = budget < 0 ? AHO_CORASICK_NO_BUDGET
+			: (size_t) budget;
+		if (workers > 1) {
+			/* The build lets go of the interpreter lock, and
+			   other threads have to keep out until it's done. */
+			self->building = 1;
+			status = ahocorasick_KeywordTree_build_parallel
+				(self->tree, mode, workers);
+			self->building = 0;
+			if (status == -1)
+				return NULL;
+		}
+		else if (aho_corasick_maketree(self->tree, mode) == -1) {
+			PyErr_SetString(PyExc_MemoryError,
+					"internal error: aho_corasick_maketree reports memory allocation error");
+			return NULL;
+		}
+		/* The tree is made now, whether or not the groups of its
+		   states can be worked out; if they can't, a search with
+		   groups works them out again. */
+		self->made = 1;
+		if (self->groups != NULL &&
+		    ahocorasick_KeywordTree_setgroups
+		    (self, ahocorasick_groups_masks(self->groups), NULL) == -1)
+			return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+
+/* Allows access to the states and their transitions. */
+static PyObject*
+ahocorasick_KeywordTree_zerostate(ahocorasick_KeywordTree *self) {
+/* 	if (! self->made) { */
+/* 		PyErr_SetString(PyExc_AssertionError, */
+/* 				"zerostate() can not be called until the tree has been made()."); */
+/* 		return NULL; */
+/* 	} */
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return NULL;
+	if (self->tree->zerostate == NULL) {
+		PyErr_SetString(PyExc_AssertionError,
+				"zerostate() is not available on a tree that was load()ed.");
+		return NULL;
+	}
+	return ahocorasick_State_make(self, self->tree->zerostate);
+}
+
+
+
+/* Writes the flat image of a made tree out to a file, by mapping the file
+   and writing the image straight into it. */
+static PyObject*
+ahocorasick_KeywordTree_save(ahocorasick_KeywordTree *self,
+			     PyObject *args,
+			     PyObject *kwargs) {
+	static char *kwlist[] = {"path", NULL};
+	char *path;
+	size_t size;
+	int fd;
+	void *image;
+	int result;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "s", kwlist, &path)) {
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before save() to finalize tree construction.");
+		return NULL;
+	}
+	if (self->added != NULL || self->removed != NULL) {
+		PyErr_SetString(PyExc_AssertionError,
+				"save() can't be called once keywords have been added or removed since make().");
+		return NULL;
+	}
+
+	size = aho_corasick_image_size(self->tree);
+	if ( (fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0666)) == -1 )
+		return PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+	if (ftruncate(fd, size) == -1 ||
+	    (image = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED,
+			  fd, 0)) == MAP_FAILED) {
+		PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+		close(fd);
+		return NULL;
+	}
+	close(fd);
+
+	result = aho_corasick_image_write(self->tree, image);
+	munmap(image, size);
+	if (result == -1) {
+		PyErr_SetString(PyExc_MemoryError,
+				"internal error: aho_corasick_image_write reports memory allocation error");
+		return NULL;
+	}
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+
+/* Returns the flat image of a made tree as a string. */
+static PyObject*
+ahocorasick_KeywordTree_dumps(ahocorasick_KeywordTree *self) {
+	PyObject *result;
+	if (!self->made) {
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before dumps() to finalize tree construction.");
+		return NULL;
+	}
+	if (self->added != NULL || self->removed != NULL) {
+		PyErr_SetString(PyExc_AssertionError,
+				"dumps() can't be called once keywords have been added or removed since make().");
+		return NULL;
+	}
+
+	result = PyString_FromStringAndSize(NULL,
+					    aho_corasick_image_size(self->tree));
+	if (result == NULL)
+		return NULL;
+	if (aho_corasick_image_write(self->tree,
+				     PyString_AS_STRING(result)) == -1) {
+		Py_DECREF(result);
+		PyErr_SetString(PyExc_MemoryError,
+				"internal error: aho_corasick_image_write reports memory allocation error");
+		return NULL;
+	}
+	return result;
+}
+
+
+
+/* Private function: makes a new, made tree of the given class out of an
+   image.  On success, the tree takes ownership of the image. */
+static PyObject*
+ahocorasick_KeywordTree_from_image(PyTypeObject *cls,
+				   void *image, size_t size, int mapped) {
+	ahocorasick_KeywordTree *self;
+
+	self = (ahocorasick_KeywordTree *) PyObject_CallObject((PyObject *) cls,
+							      NULL);
+	if (self == NULL)
+		goto fail;
+	if (!PyObject_TypeCheck(self, &ahocorasick_KeywordTreeType)) {
+		PyErr_SetString(PyExc_TypeError,
+				"load() must be called on a KeywordTree class.");
+		goto fail;
+	}
+
+	/* Throw away the empty tree we were constructed with. */
+	aho_corasick_destroy(self->tree);
+	if (aho_corasick_image_load(self->tree, image, size) == -1) {
+		PyErr_SetString(PyExc_ValueError,
+				"not a KeywordTree image, or written on a different platform.");
+		goto fail;
+	}
+	self->image = image;
+	self->image_size = size;
+	self->image_mapped = mapped;
+	/* Keywords added from now on go through the table the tree was
+	   made with, which the image has kept. */
+	memcpy(self->translate, self->tree->folded, AHO_CORASICK_CHARACTERS);
+	self->made = 1;
+	return (PyObject *) self;
+
+fail:
+	Py_XDECREF(self);
+	if (mapped)
+		munmap(image, size);
+	else
+		PyMem_Free(image);
+	return NULL;
+}
+
+
+
+/* Makes a new tree out of an image file written by save().  The file is
+   mapped read-only and searched in place, so processes that load the same
+   file share its pages. */
+static PyObject*
+ahocorasick_KeywordTree_load(PyTypeObject *cls,
+			     PyObject *args,
+			     PyObject *kwargs) {
+	static char *kwlist[] = {"path", NULL};
+	char *path;
+	int fd;
+	struct stat st;
+	void *image;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "s", kwlist, &path)) {
+		return NULL;
+	}
+
+	if ( (fd = open(path, O_RDONLY)) == -1 )
+		return PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+	if (fstat(fd, &st) == -1) {
+		PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+		close(fd);
+		return NULL;
+	}
+	if (st.st_size == 0) {
+		close(fd);
+		PyErr_SetString(PyExc_ValueError, "not a KeywordTree image.");
+		return NULL;
+	}
+	image = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	close(fd);
+	if (image == MAP_FAILED)
+		return PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+
+	return ahocorasick_KeywordTree_from_image(cls, image, st.st_size, 1);
+}
+
+
+
+/* Makes a new tree out of a string returned by dumps(). */
+static PyObject*
+ahocorasick_KeywordTree_loads(PyTypeObject *cls,
+			      PyObject *args,
+			      PyObject *kwargs) {
+	static char *kwlist[] = {"data", NULL};
+	char *data;
+	Py_ssize_t n;
+	void *image;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "s#", kwlist, &data, &n)) {
+		return NULL;
+	}
+
+	/* Copy, since the string's contents aren't necessarily aligned. */
+	if ( (image = PyMem_Malloc(n > 0 ? n : 1)) == NULL )
+		return PyErr_NoMemory();
+	memcpy(image, data, n);
+	return ahocorasick_KeywordTree_from_image(cls, image, n, 0);
+}
+
+
+
+/* Finds every occurrence of every keyword from startpos on, in a snapshot
+   of the tree that the caller has taken, letting go of the interpreter
+   lock if the query is long enough.  Returns 0 on success, or -1 with an
+   exception set. */
+static int
+ahocorasick_KeywordTree_scan_every(ahocorasick_KeywordTree *self,
+				   ahocorasick_snapshot_t *snapshot,
+				   Py_buffer *query, Py_ssize_t startpos,
+				   Py_ssize_t endpos,
+				   aho_corasick_matches_t *matches) {
+	int status;
+
+	AHOCORASICK_BEGIN_SEARCH(endpos)
+		status = ahocorasick_KeywordTree_every_helper
+			(self->tree, query->buf, (size_t) endpos,
+			 (size_t) startpos,
+			 ahocorasick_snapshot_options(snapshot), matches);
+	if (status == 0 && self->tree->text)
+		aho_corasick_matches_to_chars(query->buf, (size_t) endpos,
+					      0, 0, matches);
+	AHOCORASICK_END_SEARCH
+
+	if (status == -1)
+		PyErr_NoMemory();
+	return status;
+}
+
+
+
+/* Given a string, returns an iterator over every occurrence of every
+   keyword in it, nested and overlapping ones included.  Unlike findall()
+   with allow_overlaps, which starts a new search after each match, this
+   follows the dictionary suffix links that make() sets up, so the string
+   is only scanned once.  It's scanned as the iterator is, up to the next
+   match each time, so the matches aren't all found, or kept, at once. */
+static PyObject*
+ahocorasick_KeywordTree_iter_all(ahocorasick_KeywordTree *self,
+				 PyObject *args, PyObject *kwargs) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "with_value", "endpos",
+				 "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int with_value = 0;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int grouped;
+	ahocorasick_MatchIterator *iter;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|ninO", kwlist, &queryObject, &startpos,
+	     &with_value, &endpos, &groupsObject)) {
+		return NULL;
+	}
+	if ( (grouped = ahocorasick_KeywordTree_get_groups
+	      (self, groupsObject, &wanted)) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before iter_all() to finalize tree construction.");
+		return NULL;
+	}
+
+	iter = (ahocorasick_MatchIterator *)
+		ahocorasick_MatchIteratorType.tp_alloc
+		(&ahocorasick_MatchIteratorType, 0);
+	if (iter == NULL) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+	if (ahocorasick_KeywordTree_snapshot(self, &iter->snapshot) == -1) {
+		PyBuffer_Release(&query);
+		iter->ob_type->tp_free((PyObject*) iter);
+		return NULL;
+	}
+	if (grouped)
+		ahocorasick_snapshot_want(&iter->snapshot, wanted);
+	Py_INCREF(self);
+	iter->tree = self;
+	iter->query = query;
+	iter->done = 0;
+	iter->scanning = 0;
+	memset(iter->states, 0, sizeof(iter->states));
+	iter->pos = startpos < endpos ? startpos : endpos;
+	iter->endpos = endpos;
+	iter->offset = self->tree->text ? (Py_ssize_t) aho_corasick_utf8_chars
+		(query.buf, (size_t) iter->pos) : 0;
+	aho_corasick_matches_init(&iter->matches);
+	iter->next = 0;
+	iter->with_value = with_value;
+	return (PyObject *) iter;
+}
+
+
+
+/* Sorts the matches out by the wanted groups of their keywords, going by
+   the group masks the search was made with: returns a dict from the name
+   of each wanted group to the list of its matches.  A match of a keyword
+   in several of them is in each of their lists. */
+static PyObject*
+ahocorasick_KeywordTree_matches_to_groups(ahocorasick_KeywordTree *self,
+					  aho_corasick_matches_t *matches,
+					  const aho_corasick_groups_t *groups,
+					  aho_corasick_groups_t wanted,
+					  int with_value) {
+	PyObject *lists[AHO_CORASICK_GROUPS];
+	PyObject *dict;
+	PyObject *match;
+	aho_corasick_groups_t mask;
+	size_t i;
+	int bit;
+
+	if ( (dict = PyDict_New()) == NULL)
+		return NULL;
+	for (bit = 0; bit < AHO_CORASICK_GROUPS; bit++) {
+		lists[bit] = NULL;
+		if (((wanted >> bit) & 1) == 0 ||
+		    bit >= PyList_GET_SIZE(self->group_names))
+			continue;
+		if ( (lists[bit] = PyList_New(0)) == NULL ||
+		     PyDict_SetItem(dict, PyList_GET_ITEM(self->group_names,
+							  bit),
+				    lists[bit]) == -1)
+			goto fail;
+		/* The dict holds on to the list from here on. */
+		Py_DECREF(lists[bit]);
+	}
+
+	for (i = 0; i < matches->size; i++) {
+		mask = groups[matches->data[i].keyword] & wanted;
+		if ( (match = ahocorasick_KeywordTree_match
+		      (self, matches->data[i].start, matches->data[i].end,
+		       matches->data[i].keyword, with_value)) == NULL)
+			goto fail;
+		for (bit = 0; mask != 0; bit++, mask >>= 1) {
+			if ((mask & 1) != 0 && lists[bit] != NULL &&
+			    PyList_Append(lists[bit], match) == -1) {
+				Py_DECREF(match);
+				goto fail;
+			}
+		}
+		Py_DECREF(match);
+	}
+	return dict;
+
+ fail:
+	Py_DECREF(dict);
+	return NULL;
+}
+
+
+
+/* Finds every keyword occurrence, like iter_all(), and hands back the
+   matches by group: a dict from the name of each group asked for, or of
+   every group if none are, to the list of the matches of its keywords.
+   However many groups there are, the string is only scanned once. */
+static PyObject*
+ahocorasick_KeywordTree_findall_groups(ahocorasick_KeywordTree *self,
+				       PyObject *args, PyObject *kwargs) {
+	PyObject *queryObject;
+	Py_buffer query;
+	static char *kwlist[] = {"query", "startpos", "with_value", "endpos",
+				 "groups", NULL};
+	Py_ssize_t startpos = 0;
+	Py_ssize_t endpos = PY_SSIZE_T_MAX;
+	int with_value = 0;
+	PyObject *groupsObject = NULL;
+	aho_corasick_groups_t wanted;
+	int status;
+	aho_corasick_matches_t matches;
+	ahocorasick_snapshot_t snapshot;
+	PyObject *dict;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|ninO", kwlist, &queryObject, &startpos,
+	     &with_value, &endpos, &groupsObject)) {
+		return NULL;
+	}
+	if (groupsObject == NULL || groupsObject == Py_None)
+		groupsObject = self->group_names;
+	if (ahocorasick_KeywordTree_get_groups(self, groupsObject,
+					       &wanted) == -1)
+		return NULL;
+	if (ahocorasick_KeywordTree_getquery(self, queryObject, &query) == -1)
+		return NULL;
+
+	if (ahocorasick_KeywordTree_check_bounds(self, &query, &startpos,
+						 &endpos) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyBuffer_Release(&query);
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before findall_groups() to finalize tree construction.");
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1) {
+		PyBuffer_Release(&query);
+		return NULL;
+	}
+	ahocorasick_snapshot_want(&snapshot, wanted);
+
+	aho_corasick_matches_init(&matches);
+	status = ahocorasick_KeywordTree_scan_every(self, &snapshot, &query,
+						    startpos, endpos,
+						    &matches);
+	PyBuffer_Release(&query);
+
+	dict = NULL;
+	if (status == 0)
+		dict = ahocorasick_KeywordTree_matches_to_groups
+			(self, &matches, snapshot.options.groups, wanted,
+			 with_value);
+	ahocorasick_snapshot_release(&snapshot);
+	aho_corasick_matches_destroy(&matches);
+	return dict;
+}
+
+
+
+
+/* Returns a new Stream, for searching text that comes in chunks. */
+static PyObject*
+ahocorasick_KeywordTree_stream(ahocorasick_KeywordTree *self,
+			       PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"all", "with_value", NULL};
+	int all = 0;
+	int with_value = 0;
+	ahocorasick_Stream *stream;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "|ii", kwlist, &all, &with_value)) {
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyErr_SetString(PyExc_AssertionError,
+				"make() must be called before stream() to finalize tree construction.");
+		return NULL;
+	}
+
+	stream = (ahocorasick_Stream *)
+		ahocorasick_StreamType.tp_alloc(&ahocorasick_StreamType, 0);
+	if (stream != NULL) {
+		if (ahocorasick_KeywordTree_snapshot(self,
+						     &stream->snapshot) == -1) {
+			stream->ob_type->tp_free((PyObject*) stream);
+			return NULL;
+		}
+		Py_INCREF(self);
+		stream->tree = self;
+		memset(stream->states, 0, sizeof(stream->states));
+		stream->offset = 0;
+		stream->bytes = 0;
+		stream->all = all;
+		stream->with_value = with_value;
+	}
+	return (PyObject *) stream;
+}
+
+
+
+
+/* Type of the functions that turn the matches that a batch found in each
+   of its buffers into the Python result. */
+typedef PyObject* (*ahocorasick_batch_convert_t)
+	(ahocorasick_KeywordTree *, aho_corasick_matches_t *, Py_ssize_t);
+
+
+
+/* The work shared out between search_many()'s threads.  Each thread keeps
+   claiming the next unsearched buffer until there are none left; the last
+   one out lets go of the done lock that search_many() is waiting on. */
+typedef struct {
+	aho_corasick_t *tree;
+	const aho_corasick_options_t *options;
+	ahocorasick_KeywordTree_search_helper_t helper;
+	int allow_overlaps;
+	Py_ssize_t nbuffers;
+	unsigned char **buffers;
+	size_t *lengths;
+	aho_corasick_matches_t *results;
+	Py_ssize_t next;	/* the next buffer nobody has claimed */
+	int running;		/* threads that haven't finished yet */
+	int failed;		/* set if some search ran out of memory */
+	PyThread_type_lock lock;	/* guards next, running and failed */
+	PyThread_type_lock done;
+} ahocorasick_batch_t;
+
+
+
+/* The body of each search_many() thread.  This must never touch a Python
+   object: it runs without the interpreter lock. */
+static void
+ahocorasick_batch_worker(void *arg) {
+	ahocorasick_batch_t *batch = (ahocorasick_batch_t *) arg;
+	const aho_corasick_options_t *options = batch->options;
+	aho_corasick_options_t local;
+	aho_corasick_counters_t counters;
+	Py_ssize_t i;
+	int last;
+
+	/* Each thread counts into counters of its own, and adds them up at
+	   the end, so that they don't fight over the snapshot's. */
+	if (options != NULL && options->counters != NULL) {
+		local = *options;
+		memset(&counters, 0, sizeof(counters));
+		local.counters = &counters;
+		options = &local;
+	}
+
+	for (;;) {
+		PyThread_acquire_lock(batch->lock, WAIT_LOCK);
+		i = batch->next;
+		if (i < batch->nbuffers && !batch->failed)
+			batch->next++;
+		else
+			i = -1;
+		PyThread_release_lock(batch->lock);
+		if (i == -1)
+			break;
+
+		if (ahocorasick_KeywordTree_findall_helper
+		    (batch->tree, batch->helper, batch->buffers[i],
+		     batch->lengths[i], 0, options,
+		     batch->allow_overlaps,
+		     &batch->results[i]) == -1) {
+			PyThread_acquire_lock(batch->lock, WAIT_LOCK);
+			batch->failed = 1;
+			PyThread_release_lock(batch->lock);
+		}
+		else if (batch->tree->text)
+			aho_corasick_matches_to_chars
+				(batch->buffers[i], batch->lengths[i], 0, 0,
+				 &batch->results[i]);
+	}
+
+	/* search_many() frees the batch as soon as done is let go, so that
+	   has to be the very last thing we touch. */
+	PyThread_acquire_lock(batch->lock, WAIT_LOCK);
+	if (options == &local)
+		ahocorasick_counters_add(batch->options->counters, &counters);
+	last = (--batch->running == 0);
+	PyThread_release_lock(batch->lock);
+	if (last)
+		PyThread_release_lock(batch->done);
+}
+
+
+
+/* Turns the matches found in each of n buffers into a list of lists of
+   match tuples, one list per buffer, with the keywords' values in them if
+   with_value is set. */
+static PyObject*
+ahocorasick_KeywordTree_lists_helper(ahocorasick_KeywordTree *self,
+				     aho_corasick_matches_t *results,
+				     Py_ssize_t n, int with_value) {
+	PyObject *list;
+	PyObject *item;
+	Py_ssize_t j;
+
+	if ( (list = PyList_New(n)) == NULL)
+		return NULL;
+	for (j = 0; j < n; j++) {
+		if ( (item = ahocorasick_KeywordTree_matches_to_list
+		      (self, &results[j], with_value)) == NULL) {
+			Py_DECREF(list);
+			return NULL;
+		}
+		PyList_SET_ITEM(list, j, item);
+	}
+	return list;
+}
+
+
+
+/* The batch_convert_t's for search_many(), with and without values. */
+static PyObject*
+ahocorasick_KeywordTree_batch_to_lists(ahocorasick_KeywordTree *self,
+				       aho_corasick_matches_t *results,
+				       Py_ssize_t n) {
+	return ahocorasick_KeywordTree_lists_helper(self, results, n, 0);
+}
+
+static PyObject*
+ahocorasick_KeywordTree_batch_to_value_lists(ahocorasick_KeywordTree *self,
+					     aho_corasick_matches_t *results,
+					     Py_ssize_t n) {
+	return ahocorasick_KeywordTree_lists_helper(self, results, n, 1);
+}
+
+
+
+/* Turns the matches found in each of n buffers into arrays, docs and all;
+   see ahocorasick_KeywordTree_matches_to_arrays(). */
+static PyObject*
+ahocorasick_KeywordTree_batch_to_arrays(ahocorasick_KeywordTree *self,
+					aho_corasick_matches_t *results,
+					Py_ssize_t n) {
+	return ahocorasick_KeywordTree_matches_to_arrays(self, results, n, 1);
+}
+
+
+
+/* Searches every buffer in a sequence of strings or buffers, using up to
+   workers native threads at once, and hands the matches found in each to
+   convert.  The calling thread does its share of the searching too, and
+   the interpreter lock is let go for the whole batch, so other Python
+   threads keep running.  name is the method we're doing this for, for the
+   error messages. */
+static PyObject*
+ahocorasick_KeywordTree_basebatch(ahocorasick_KeywordTree *self,
+				  PyObject *buffers, int workers,
+				  int allow_overlaps, int longest,
+				  ahocorasick_batch_convert_t convert,
+				  const char *name) {
+	PyObject *seq = NULL;
+	PyObject *result = NULL;
+	PyObject *item;
+	int i, started;
+	Py_buffer *views;
+	Py_ssize_t nviews = 0;	/* how many of the views we hold */
+	Py_ssize_t j;
+	ahocorasick_batch_t batch;
+	ahocorasick_snapshot_t snapshot;
+
+	if (workers < 1) {
+		PyErr_SetString(PyExc_AssertionError,
+				"workers must be at least 1.");
+		return NULL;
+	}
+
+	if (!self->made) {
+		PyErr_Format(PyExc_AssertionError,
+			     "make() must be called before %s() to finalize tree construction.",
+			     name);
+		return NULL;
+	}
+
+	if ( (seq = PySequence_Fast(buffers, "buffers must be a sequence of strings or buffers.")) == NULL)
+		return NULL;
+	if (ahocorasick_KeywordTree_snapshot(self, &snapshot) == -1) {
+		Py_DECREF(seq);
+		return NULL;
+	}
+
+	batch.tree = self->tree;
+	batch.options = ahocorasick_snapshot_options(&snapshot);
+	batch.helper = longest ? ahocorasick_KeywordTree_search_long_helper
+		: ahocorasick_KeywordTree_search_helper;
+	batch.allow_overlaps = allow_overlaps;
+	batch.nbuffers = PySequence_Fast_GET_SIZE(seq);
+	batch.buffers = PyMem_New(unsigned char *, batch.nbuffers + 1);
+	batch.lengths = PyMem_New(size_t, batch.nbuffers + 1);
+	batch.results = PyMem_New(aho_corasick_matches_t, batch.nbuffers + 1);
+	views = PyMem_New(Py_buffer, batch.nbuffers + 1);
+	batch.next = 0;
+	batch.failed = 0;
+	batch.lock = NULL;
+	batch.done = NULL;
+	if (batch.results != NULL)
+		for (j = 0; j < batch.nbuffers; j++)
+			aho_corasick_matches_init(&batch.results[j]);
+	if (batch.buffers == NULL || batch.lengths == NULL ||
+	    batch.results == NULL || views == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+
+	/* The views keep the buffers alive, and the same size, while we
+	   search them. */
+	for (j = 0; j < batch.nbuffers; j++) {
+		item = PySequence_Fast_GET_ITEM(seq, j);
+		if (ahocorasick_KeywordTree_getquery(self, item,
+						     &views[nviews]) == -1)
+			goto finally;
+		nviews++;
+		batch.buffers[j] = views[j].buf;
+		batch.lengths[j] = (size_t) views[j].len;
+	}
+
+	if (workers > batch.nbuffers)
+		workers = batch.nbuffers > 0 ? (int) batch.nbuffers : 1;
+
+	if ( (batch.lock = PyThread_allocate_lock()) == NULL ||
+	     (batch.done = PyThread_allocate_lock()) == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	PyThread_acquire_lock(batch.done, WAIT_LOCK);
+	batch.running = workers;
+	started = 1;
+	for (i = 1; i < workers; i++) {
+		if (PyThread_start_new_thread(ahocorasick_batch_worker,
+					      &batch) == -1)
+			break;
+		started++;
+	}
+	/* Threads we couldn't start just leave more work for the rest. */
+	PyThread_acquire_lock(batch.lock, WAIT_LOCK);
+	batch.running -= workers - started;
+	PyThread_release_lock(batch.lock);
+
+	ahocorasick_batch_worker(&batch);
+	PyThread_acquire_lock(batch.done, WAIT_LOCK);
+	PyThread_release_lock(batch.done);
+	Py_END_ALLOW_THREADS
+
+	if (batch.failed) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+
+	result = (*convert)(self, batch.results, batch.nbuffers);
+
+ finally:
+	if (batch.results != NULL)
+		for (j = 0; j < batch.nbuffers; j++)
+			aho_corasick_matches_destroy(&batch.results[j]);
+	for (j = 0; j < nviews; j++)
+		PyBuffer_Release(&views[j]);
+	PyMem_Free(views);
+	PyMem_Free(batch.buffers);
+	PyMem_Free(batch.lengths);
+	PyMem_Free(batch.results);
+	if (batch.lock != NULL)
+		PyThread_free_lock(batch.lock);
+	if (batch.done != NULL)
+		PyThread_free_lock(batch.done);
+	ahocorasick_snapshot_release(&snapshot);
+	Py_DECREF(seq);
+	return result;
+}
+
+
+
+
+
+
+
+
+/* Given a sequence of strings, returns a list holding the findall() list of
+   each, searched by up to workers native threads at once. */
+static PyObject*
+ahocorasick_KeywordTree_search_many(ahocorasick_KeywordTree *self,
+				    PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"buffers", "workers", "allow_overlaps",
+				 "longest", "with_value", NULL};
+	PyObject *buffers;
+	int workers = 1;
+	int allow_overlaps = 0;
+	int longest = 0;
+	int with_value = 0;
+
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|iiii", kwlist, &buffers, &workers,
+	     &allow_overlaps, &longest, &with_value)) {
+		return NULL;
+	}
+	return ahocorasick_KeywordTree_basebatch
+		(self, buffers, workers, allow_overlaps, longest,
+		 with_value ? ahocorasick_KeywordTree_batch_to_value_lists :
+		 ahocorasick_KeywordTree_batch_to_lists,
+		 "search_many");
+}
+
+
+
+/* Same as search_many(), but returns the matches of all the buffers in
+   arrays: a 4-tuple (docs, starts, ends, keywords). */
+static PyObject*
+ahocorasick_KeywordTree_findall_batch(ahocorasick_KeywordTree *self,
+				      PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"buffers", "workers", "allow_overlaps",
+				 "longest", NULL};
+	PyObject *buffers;
+	int workers = 1;
+	int allow_overlaps = 0;
+	int longest = 0;
+
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O|iii", kwlist, &buffers, &workers,
+	     &allow_overlaps, &longest)) {
+		return NULL;
+	}
+	return ahocorasick_KeywordTree_basebatch
+		(self, buffers, workers, allow_overlaps, longest,
+		 ahocorasick_KeywordTree_batch_to_arrays, "findall_batch");
+}
+
+
+
+/* Returns a dict of how big the tree is, how its states are laid out, and
+   how much memory it holds on to. */
+static PyObject*
+ahocorasick_KeywordTree_stats(ahocorasick_KeywordTree *self) {
+	aho_corasick_t *g = self->tree;
+	aho_corasick_stats_t stats;
+	PyObject *depths;
+	PyObject *result;
+	const char *mode = NULL;
+	Py_ssize_t added = self->added != NULL ? PyDict_Size(self->added) : 0;
+	Py_ssize_t removed = 0;
+	Py_ssize_t i;
+	size_t total;
+
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return NULL;
+	if (aho_corasick_stats(g, &stats) == -1) {
+		PyErr_SetString(PyExc_MemoryError,
+				"internal error: aho_corasick_stats reports memory allocation error");
+		return NULL;
+	}
+	if (self->state_groups != NULL)
+		stats.table_bytes += PyByteArray_GET_SIZE(self->state_groups);
+	depths = PyList_New(stats.maxdepth + 1);
+	if (depths == NULL) {
+		aho_corasick_stats_destroy(&stats);
+		return NULL;
+	}
+	for (i = 0; i <= (Py_ssize_t) stats.maxdepth; i++) {
+		PyObject *n = PyInt_FromSsize_t((Py_ssize_t) stats.depths[i]);
+		if (n == NULL) {
+			Py_DECREF(depths);
+			aho_corasick_stats_destroy(&stats);
+			return NULL;
+		}
+		PyList_SET_ITEM(depths, i, n);
+	}
+
+	if (self->made)
+		mode = g->delta != NULL ? "dfa" : "goto";
+	if (self->removed != NULL)
+		for (i = 0; i < PyString_GET_SIZE(self->removed); i++)
+			removed += PyString_AS_STRING(self->removed)[i] != 0;
+	total = stats.arena_bytes + stats.table_bytes + stats.dfa_bytes +
+		stats.image_bytes;
+
+	result = Py_BuildValue
+		("{s:n,s:n,s:i,s:z,s:n,s:n,s:N,s:n,s:n,s:n,s:n,s:n,s:n,s:n,"
+		 "s:n,s:i,s:N,s:n,s:n,s:n,s:n}",
+		 "states", (Py_ssize_t) stats.states,
+		 "keywords", (Py_ssize_t) g->nkeywords + added,
+		 "classes", g->nclasses,
+		 "mode", mode,
+		 "dense_states", (Py_ssize_t) stats.dense,
+		 "sparse_states", (Py_ssize_t) stats.sparse,
+		 "depths", depths,
+		 "max_depth", (Py_ssize_t) stats.maxdepth,
+		 "max_fail_chain", (Py_ssize_t) stats.max_fail_chain,
+		 "max_dict_chain", (Py_ssize_t) stats.max_dict_chain,
+		 "arena_bytes", (Py_ssize_t) stats.arena_bytes,
+		 "table_bytes", (Py_ssize_t) stats.table_bytes,
+		 "dfa_bytes", (Py_ssize_t) stats.dfa_bytes,
+		 "image_bytes", (Py_ssize_t) stats.image_bytes,
+		 "total_bytes", (Py_ssize_t) total,
+		 "start_bytes", self->made ? g->nstarts : 0,
+		 "skip", PyBool_FromLong(self->made && g->skip),
+		 "added", added,
+		 "removed", removed,
+		 "deltas", self->deltas != NULL ?
+		 PyTuple_GET_SIZE(self->deltas) : 0,
+		 "groups", PyList_GET_SIZE(self->group_names));
+	aho_corasick_stats_destroy(&stats);
+	return result;
+}
+
+
+
+/* Returns the made tree as a dict of flat arrays: for each state, by id,
+   its depths, outputs, keywords (-1 if it has none), fails and dicts, and
+   for each goto transition, its src, labels and dst.  See
+   aho_corasick_edges(). */
+static PyObject*
+ahocorasick_KeywordTree_export(ahocorasick_KeywordTree *self) {
+	static const char *names[] = {"depths", "outputs", "keywords",
+				      "fails", "dicts", "src", "labels",
+				      "dst"};
+	enum { DEPTHS = 0, OUTPUTS, KEYWORDS, FAILS, DICTS, SRC, LABELS, DST,
+	       NARRAYS };
+	aho_corasick_t *g = self->tree;
+	PyObject *arrays[NARRAYS];
+	long *items[NARRAYS];
+	PyObject *result = NULL;
+	Py_ssize_t nstates = g->newstate;
+	Py_ssize_t nedges;
+	Py_ssize_t i;
+	int a;
+
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return NULL;
+	if (!self->made) {
 		PyErr_SetString(PyExc_AssertionError,
-				"add() cannot take the empty string");
+				"make() must be called before export() to finalize tree construction.");
 		return NULL;
 	}
 
-	if (self->made) {
-		PyErr_SetString(PyExc_AssertionError, 
-				"add() cannot be called once a tree has been finalized with make()");
-		return NULL;
+	for (a = 0; a < NARRAYS; a++)
+		arrays[a] = NULL;
+	nedges = (Py_ssize_t) aho_corasick_edges(g, NULL, NULL, NULL);
+	for (a = 0; a < NARRAYS; a++)
+		if ( (arrays[a] = ahocorasick_new_long_array
+		      (a < SRC ? nstates : nedges, &items[a])) == NULL)
+			goto finally;
+
+	AHOCORASICK_BEGIN_SEARCH(nstates)
+	for (i = 0; i < nstates; i++) {
+		items[DEPTHS][i] = g->depths[i];
+		items[OUTPUTS][i] = g->outputs[i];
+		items[KEYWORDS][i] = g->outputs[i] != 0 ?
+			(long) g->keywords[i] : -1;
+		items[FAILS][i] = g->fails[i];
+		items[DICTS][i] = g->dicts[i];
+	}
+	aho_corasick_edges(g, items[SRC], items[LABELS], items[DST]);
+	AHOCORASICK_END_SEARCH
+
+	if ( (result = PyDict_New()) == NULL)
+		goto finally;
+	for (a = 0; a < NARRAYS; a++) {
+		if (PyDict_SetItemString(result, names[a], arrays[a]) == -1) {
+			Py_CLEAR(result);
+			break;
+		}
 	}
 
+ finally:
+	for (a = 0; a < NARRAYS; a++)
+		Py_XDECREF(arrays[a]);
+	return result;
+}
+
 
-	/* The only time we get -1 from addstring is on memory error, but
-	   let's make sure to trace that. */
-	if (aho_corasick_addstring(self->tree, newKeyword, n) == -1) {
-		PyErr_SetString(PyExc_MemoryError,
-				"internal error: aho_corasick_addstring reports memory allocation error");
+
+/* Turns the counting of what searches do on or off. */
+static PyObject*
+ahocorasick_KeywordTree_instrument(ahocorasick_KeywordTree *self,
+				   PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"enabled", NULL};
+	int enabled = 1;
+
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "|i", kwlist, &enabled)) {
 		return NULL;
 	}
-	self->count++;
-
+	self->instrumented = enabled;
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
 
 
-
-/* Given a string, searches for the first keyword.  Either returns None, or a
-   2-tuple (start, end).  Since search() and search_long() are so similar, I
-   extract the common elements of both here, and specialize by using a helper
-   function pointer. */
+/* Returns a dict of what searches have counted since instrument() was
+   called, or since the last reset. */
 static PyObject*
-ahocorasick_KeywordTree_basesearch(ahocorasick_KeywordTree *self,
-				   PyObject *args, PyObject *kwargs,
-				   ahocorasick_KeywordTree_search_helper_t helper) {
-	unsigned char *queryString;
-	size_t start, end;
-	static char *kwlist[] = {"query", "startpos", NULL};
-	int startpos = 0;
-	size_t n;		/* length of queryString */
-	if (! PyArg_ParseTupleAndKeywords
-	    (args, kwargs, "s#|i", kwlist, &queryString, &n, &startpos)) {
-		return NULL;
-	}
+ahocorasick_KeywordTree_counters(ahocorasick_KeywordTree *self,
+				 PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"reset", NULL};
+	int reset = 0;
+	aho_corasick_counters_t *counters = &self->counters;
+	PyObject *result;
 
-	/* Check startpos bounds.  Assert that they're within the query
-	   string. */
-	if (startpos < 0) {
-		PyErr_SetString(PyExc_AssertionError,
-				"startpos can't be negative.");
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "|i", kwlist, &reset)) {
 		return NULL;
 	}
-	
-
-	/* Before searching, the KeywordTree must have been make()ed. earlier,
-	   or else the search doesn't work. */
-	if (!self->made) {
+	if (!self->instrumented) {
 		PyErr_SetString(PyExc_AssertionError,
-				"make() must be called before search() to finalize tree construction.");
+				"instrument() must be called before counters() to count anything.");
 		return NULL;
 	}
-	
-	if ((*helper)(self->tree, 
-		      queryString, n,
-		      (size_t) startpos,
-		      &start, &end)) {
-	  return Py_BuildValue("(ll)", start, end);
-	}
 
-	/* If we get to this point, the search has failed. */
-	Py_INCREF(Py_None);
-	return Py_None; 
+	result = Py_BuildValue("{s:n,s:n,s:n,s:n,s:n}",
+			       "bytes", (Py_ssize_t) counters->bytes,
+			       "skipped", (Py_ssize_t) counters->skipped,
+			       "transitions",
+			       (Py_ssize_t) counters->transitions,
+			       "fails", (Py_ssize_t) counters->fails,
+			       "matches", (Py_ssize_t) counters->matches);
+	if (result != NULL && reset)
+		memset(counters, 0, sizeof(*counters));
+	return result;
 }
 
 
 
-/* Given a string, searches for the first keyword.  Either returns None, or a
-   2-tuple (start, end). */
-static PyObject*
-ahocorasick_KeywordTree_search(ahocorasick_KeywordTree *self,
-			       PyObject *args, PyObject *kwargs) {
-	return ahocorasick_KeywordTree_basesearch
-		(self, args, kwargs,
-		 ahocorasick_KeywordTree_search_helper);
-}
-
-
 
-/* Given a string, searches for the first keyword.  Either returns None, or a
-   2-tuple (start, end).  Tries to match as long a keyword as it can.*/
+/* Returns a list of the names of the groups, in the order they were first
+   given to add(). */
 static PyObject*
-ahocorasick_KeywordTree_search_long(ahocorasick_KeywordTree *self,
-				    PyObject *args, PyObject *kwargs) {
-	return ahocorasick_KeywordTree_basesearch
-		(self, args, kwargs,
-		 ahocorasick_KeywordTree_search_long_helper);
+ahocorasick_KeywordTree_groups(ahocorasick_KeywordTree *self) {
+	return PyList_GetSlice(self->group_names, 0,
+			       PyList_GET_SIZE(self->group_names));
 }
 
 
 
+/* Returns the group masks as a string, for pickling: one
+   aho_corasick_groups_t for each keyword index, or None if there are no
+   groups. */
+static PyObject*
+ahocorasick_KeywordTree_group_masks(ahocorasick_KeywordTree *self) {
+	Py_ssize_t n = self->tree->nkeywords;
 
+	if (self->groups == NULL) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	if (self->added != NULL)
+		n += PyDict_Size(self->added);
+	return PyString_FromStringAndSize(PyByteArray_AS_STRING(self->groups),
+					  n * sizeof(aho_corasick_groups_t));
+}
 
 
-/* Once the keywords have been passed into the tree, maketree does some final
-   construction of the keyword tree.
 
-   We must make sure that maketree has not be called multiple times.  If it
-   is, ignore the call.
-*/
+/* Puts back the group masks that _group_masks() returned, once the names
+   of the groups are back in _groups, and works out the groups of the
+   states again.  Only meant for unpickling a tree that no search has
+   seen yet. */
 static PyObject*
-ahocorasick_KeywordTree_maketree(ahocorasick_KeywordTree *self) {
-	/* fixme: only call this if self->count is positive! */
-	if (!self->made) {
-		if (self->count == 0) {
-			PyErr_SetString(PyExc_AssertionError,
-					"make() can not be called until at least one string has been add()ed.");
+ahocorasick_KeywordTree_set_group_masks(ahocorasick_KeywordTree *self,
+					PyObject *args, PyObject *kwargs) {
+	static char *kwlist[] = {"masks", NULL};
+	char *masks;
+	Py_ssize_t n;
+	Py_ssize_t nkeywords = self->tree->nkeywords;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "s#", kwlist, &masks, &n)) {
+		return NULL;
+	}
+
+	if (ahocorasick_KeywordTree_check_building(self) == -1)
+		return NULL;
+	if (self->added != NULL)
+		nkeywords += PyDict_Size(self->added);
+	if (n % sizeof(aho_corasick_groups_t) != 0 ||
+	    n / (Py_ssize_t) sizeof(aho_corasick_groups_t) > nkeywords) {
+		PyErr_SetString(PyExc_AssertionError,
+				"masks must have one group mask for each keyword.");
+		return NULL;
+	}
+	Py_CLEAR(self->groups);
+	if (ahocorasick_KeywordTree_own_groups(self, nkeywords > 0 ?
+					       nkeywords - 1 : 0) == -1)
+		return NULL;
+	memcpy(PyByteArray_AS_STRING(self->groups), masks, n);
+	if (self->made) {
+		if (ahocorasick_KeywordTree_setgroups
+		    (self, ahocorasick_groups_masks(self->groups),
+		     ahocorasick_KeywordTree_removed(self)) == -1)
 			return NULL;
-		}
-		aho_corasick_maketree(self->tree);
-		self->made = 1;
+		Py_CLEAR(self->deltas);
 	}
 	Py_INCREF(Py_None);
 	return Py_None;
@@ -238,20 +3342,11 @@ ahocorasick_KeywordTree_maketree(ahocorasick_KeywordTree *self) {
 
 
 
-/* Allows access to the states and their transitions. */
-static PyObject*
-ahocorasick_KeywordTree_zerostate(ahocorasick_KeywordTree *self) {
-/* 	if (! self->made) { */
-/* 		PyErr_SetString(PyExc_AssertionError, */
-/* 				"zerostate() can not be called until the tree has been made()."); */
-/* 		return NULL; */
-/* 	} */
-	return ahocorasick_State_make(self, self->tree->zerostate);
-}
-
-
-
 static PyMemberDef ahocorasick_KeywordTree_members[] = {
+	{"_values", T_OBJECT, offsetof(ahocorasick_KeywordTree, values), READONLY,
+	 "The list of values given to add(), by keyword index."},
+	{"_groups", T_OBJECT, offsetof(ahocorasick_KeywordTree, group_names),
+	 READONLY, "The list of the names of the groups, by bit."},
 	{NULL}			/* sentinel */
 };
 
@@ -262,17 +3357,81 @@ static PyMethodDef ahocorasick_KeywordTree_methods[] = {
 	   happy.  These functions take ahocorasick_KeywordTree pointers as
 	   their first argument. */
 	{"add", (PyCFunction) ahocorasick_KeywordTree_add, METH_VARARGS | METH_KEYWORDS,
-	 "Add a new keyword to the KeywordTree." },
+	 "Add a new keyword to the KeywordTree, with an optional value.  \
+Returns the index of the keyword." },
+	{"add_many", (PyCFunction) ahocorasick_KeywordTree_add_many, METH_VARARGS | METH_KEYWORDS,
+	 "Adds every keyword, or (keyword, value) pair, that an iterable \
+gives." },
+	{"remove", (PyCFunction) ahocorasick_KeywordTree_remove, METH_VARARGS | METH_KEYWORDS,
+	 "Takes a keyword out of a made KeywordTree." },
 	{"search", (PyCFunction) ahocorasick_KeywordTree_search, METH_VARARGS | METH_KEYWORDS,
 	 "Search for a keyword.  Either returns a 2-tuple \
 (start, end), or None." },
 	{"search_long", (PyCFunction) ahocorasick_KeywordTree_search_long, METH_VARARGS | METH_KEYWORDS,
 	 "Search for a keyword.  Either returns a 2-tuple \
 (start, end), or None.  Tries for longest match." },
-	{"make", (PyCFunction) ahocorasick_KeywordTree_maketree, METH_NOARGS,
-	 "Finishes KeywordTree construction." },
+	{"findall", (PyCFunction) ahocorasick_KeywordTree_findall, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a list of 2-tuples (start, end) of all matches, \
+using search()." },
+	{"findall_long", (PyCFunction) ahocorasick_KeywordTree_findall_long, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a list of 2-tuples (start, end) of all matches, \
+using search_long()." },
+	{"findall_array", (PyCFunction) ahocorasick_KeywordTree_findall_array, METH_VARARGS | METH_KEYWORDS,
+	 "Same as findall(), but returns the matches as a 3-tuple of \
+arrays (starts, ends, keywords)." },
+	{"contains", (PyCFunction) ahocorasick_KeywordTree_contains, METH_VARARGS | METH_KEYWORDS,
+	 "Returns True if any keyword occurs in the query." },
+	{"count", (PyCFunction) ahocorasick_KeywordTree_count, METH_VARARGS | METH_KEYWORDS,
+	 "Returns the number of matches findall() would return." },
+	{"counts", (PyCFunction) ahocorasick_KeywordTree_counts, METH_VARARGS | METH_KEYWORDS,
+	 "Returns an array of the number of matches findall() would \
+return of each keyword, indexed by keyword." },
+	{"iter_all", (PyCFunction) ahocorasick_KeywordTree_iter_all, METH_VARARGS | METH_KEYWORDS,
+	 "Returns an iterator over the 2-tuples (start, end) of every \
+keyword occurrence, overlapping ones included." },
+	{"findall_groups", (PyCFunction) ahocorasick_KeywordTree_findall_groups, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a dict from each group to the list of every occurrence \
+of its keywords, found in one pass over the query." },
+	{"groups", (PyCFunction) ahocorasick_KeywordTree_groups, METH_NOARGS,
+	 "Returns a list of the names of the groups keywords were put in." },
+	{"_group_masks", (PyCFunction) ahocorasick_KeywordTree_group_masks, METH_NOARGS,
+	 "Returns the groups of each keyword as a string, for pickling." },
+	{"_set_group_masks", (PyCFunction) ahocorasick_KeywordTree_set_group_masks, METH_VARARGS | METH_KEYWORDS,
+	 "Puts back the groups of each keyword from _group_masks()." },
+	{"findall_batch", (PyCFunction) ahocorasick_KeywordTree_findall_batch, METH_VARARGS | METH_KEYWORDS,
+	 "Same as search_many(), but returns the matches of all the \
+strings as a 4-tuple of arrays (docs, starts, ends, keywords)." },
+	{"stream", (PyCFunction) ahocorasick_KeywordTree_stream, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a Stream that finds matches in text fed to it a chunk \
+at a time, including matches that span chunks." },
+	{"search_many", (PyCFunction) ahocorasick_KeywordTree_search_many, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a list of the findall() lists of each of a sequence \
+of strings, searched by several threads at once." },
+	{"make", (PyCFunction) ahocorasick_KeywordTree_maketree, METH_VARARGS | METH_KEYWORDS,
+	 "Finishes KeywordTree construction.  If mode is \"dfa\", \
+precompiles a full transition table for faster searching." },
 	{"zerostate", (PyCFunction) ahocorasick_KeywordTree_zerostate, METH_NOARGS,
 	 "extracts the root zerostate node of the KeywordTree."},
+	{"save", (PyCFunction) ahocorasick_KeywordTree_save, METH_VARARGS | METH_KEYWORDS,
+	 "Writes the made KeywordTree out to a file, as a flat image." },
+	{"load", (PyCFunction) ahocorasick_KeywordTree_load, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+	 "Returns a KeywordTree that searches an image file written by \
+save() in place." },
+	{"dumps", (PyCFunction) ahocorasick_KeywordTree_dumps, METH_NOARGS,
+	 "Returns the made KeywordTree as a flat image string." },
+	{"loads", (PyCFunction) ahocorasick_KeywordTree_loads, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+	 "Returns a KeywordTree made from a string returned by dumps()." },
+	{"export", (PyCFunction) ahocorasick_KeywordTree_export, METH_NOARGS,
+	 "Returns the made KeywordTree as a dict of flat arrays of its \
+states and its goto transitions." },
+	{"stats", (PyCFunction) ahocorasick_KeywordTree_stats, METH_NOARGS,
+	 "Returns a dict of the size and layout of the KeywordTree, and \
+of the memory it holds." },
+	{"instrument", (PyCFunction) ahocorasick_KeywordTree_instrument, METH_VARARGS | METH_KEYWORDS,
+	 "Turns counting what searches do on, or off." },
+	{"counters", (PyCFunction) ahocorasick_KeywordTree_counters, METH_VARARGS | METH_KEYWORDS,
+	 "Returns a dict of what searches have counted since instrument(), \
+and optionally starts counting from zero again." },
 	{NULL}			/* sentinel */
 };
 
@@ -373,6 +3532,8 @@ ahocorasick_State_goto(ahocorasick_State *self,
 	    (args, kwargs, "i", kwlist, &label)) {
 		return NULL;
 	}
+	if (ahocorasick_KeywordTree_check_building(self->tree) == -1)
+		return NULL;
 	/* Label must be between 0 and 255, or else we raise
 	   AssertionError. */
 	if (label < 0 || label >= AHO_CORASICK_CHARACTERS) {
@@ -381,6 +3542,9 @@ ahocorasick_State_goto(ahocorasick_State *self,
 		return NULL;
 	}
 
+	/* Transitions are labeled by byte class, not by the byte itself. */
+	label = aho_corasick_symbol(self->tree->tree, label);
+
 	if (aho_corasick_goto_get(self->state, label) == NULL) {
 		Py_INCREF(Py_None);
 		return Py_None;
@@ -396,6 +3560,8 @@ ahocorasick_State_goto(ahocorasick_State *self,
    case of the zerostate, we return None.  */
 static PyObject*
 ahocorasick_State_fail(ahocorasick_State *self) {
+	if (ahocorasick_KeywordTree_check_building(self->tree) == -1)
+		return NULL;
 	if (self->state->fail == NULL) {
 		/* If we get in here, we're probably at the zerostate. */
 		Py_INCREF(Py_None);
@@ -413,11 +3579,15 @@ ahocorasick_State_labels(ahocorasick_State *self) {
 	PyObject *list;
 	PyObject *label;
 
+	if (ahocorasick_KeywordTree_check_building(self->tree) == -1)
+		return NULL;
 	if ( (list = PyList_New(0)) == NULL)
 		return NULL;
 
 	for(i = 0; i < AHO_CORASICK_CHARACTERS; i++) {
-		if (aho_corasick_goto_get(self->state, i) != NULL) {
+		if (aho_corasick_goto_get(self->state,
+					  aho_corasick_symbol(self->tree->tree, i))
+		    != NULL) {
 			if ( (label = Py_BuildValue("i", i)) == NULL) {
 				Py_DECREF(list);
 				return NULL;
@@ -436,6 +3606,8 @@ ahocorasick_State_labels(ahocorasick_State *self) {
 
 static PyObject*
 ahocorasick_State_output(ahocorasick_State *self) {
+	if (ahocorasick_KeywordTree_check_building(self->tree) == -1)
+		return NULL;
 	if (self->state->output == 0) {
 		Py_INCREF(Py_None);
 		return Py_None;
@@ -514,6 +3686,297 @@ static PyTypeObject ahocorasick_StateType = {
 
 
 
+/************************************************************************/
+/* Implementation of the Stream follows: */
+
+
+/* Deallocates a stream. */
+static void
+ahocorasick_Stream_dealloc(ahocorasick_Stream *self) {
+	ahocorasick_snapshot_release(&self->snapshot);
+	Py_DECREF(self->tree);
+	self->tree = NULL;
+	self->ob_type->tp_free((PyObject*) self);
+}
+
+
+
+/* Feeds the next chunk of the stream through the automaton, and returns the
+   list of matches found, positioned from the start of the stream.  A match
+   that started in an earlier chunk is reported by the chunk it ends in. */
+static PyObject*
+ahocorasick_Stream_feed(ahocorasick_Stream *self,
+			PyObject *args, PyObject *kwargs) {
+	PyObject *chunkObject;
+	Py_buffer chunk;
+	static char *kwlist[] = {"chunk", NULL};
+	size_t n;		/* length of chunk */
+	size_t chars;		/* characters in chunk, in text mode */
+	int status;
+	aho_corasick_int_t states[1 + AHO_CORASICK_DELTAS];
+	aho_corasick_t *g = self->tree->tree;
+	aho_corasick_matches_t matches;
+	PyObject *list;
+	if (! PyArg_ParseTupleAndKeywords
+	    (args, kwargs, "O", kwlist, &chunkObject)) {
+		return NULL;
+	}
+	if (ahocorasick_KeywordTree_getquery(self->tree, chunkObject,
+					     &chunk) == -1)
+		return NULL;
+	n = chunk.len;
+	chars = n;
+	memcpy(states, self->states, sizeof(states));
+
+	aho_corasick_matches_init(&matches);
+	AHOCORASICK_BEGIN_SEARCH(n)
+		status = ahocorasick_KeywordTree_feed_helper
+			(g, chunk.buf, n, (size_t) self->bytes,
+			 ahocorasick_snapshot_options(&self->snapshot),
+			 states, self->all, &matches);
+	if (status == 0 && g->text) {
+		aho_corasick_matches_to_chars(chunk.buf, n,
+					      (size_t) self->bytes,
+					      (size_t) self->offset,
+					      &matches);
+		chars = aho_corasick_utf8_chars(chunk.buf, n);
+	}
+	AHOCORASICK_END_SEARCH
+	PyBuffer_Release(&chunk);
+	ahocorasick_snapshot_flush(&self->snapshot);
+
+	if (status == -1) {
+		aho_corasick_matches_destroy(&matches);
+		return PyErr_NoMemory();
+	}
+	memcpy(self->states, states, sizeof(states));
+	self->bytes += n;
+	self->offset += chars;
+	list = ahocorasick_KeywordTree_matches_to_list(self->tree, &matches,
+						       self->with_value);
+	aho_corasick_matches_destroy(&matches);
+	return list;
+}
+
+
+
+/* Starts the stream over, as if nothing had been fed to it yet. */
+static PyObject*
+ahocorasick_Stream_reset(ahocorasick_Stream *self) {
+	memset(self->states, 0, sizeof(self->states));
+	self->offset = 0;
+	self->bytes = 0;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+
+static PyMemberDef ahocorasick_Stream_members[] = {
+	{"offset", T_PYSSIZET, offsetof(ahocorasick_Stream, offset), READONLY,
+	 "The number of bytes fed to the stream so far, or characters in text mode."},
+	{NULL}			/* sentinel */
+};
+
+
+static PyMethodDef ahocorasick_Stream_methods[] = {
+	{"feed", (PyCFunction) ahocorasick_Stream_feed, METH_VARARGS | METH_KEYWORDS,
+	 "Searches the next chunk of the stream.  Returns a list of \
+matches, positioned from the start of the stream."},
+
+	{"reset", (PyCFunction) ahocorasick_Stream_reset, METH_NOARGS,
+	 "Starts the stream over."},
+
+	{NULL}			/* sentinel */
+};
+
+
+static PyTypeObject ahocorasick_StreamType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                                /*ob_size*/
+    "ahocorasick.Stream",                       /*tp_name*/
+    sizeof(ahocorasick_Stream),                 /*tp_basicsize*/
+    0,                                                /*tp_itemsize*/
+    (destructor)ahocorasick_Stream_dealloc,     /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "Stream objects",          /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    ahocorasick_Stream_methods,            /* tp_methods */
+    ahocorasick_Stream_members,            /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+    0,                         /* tp_new */
+};
+
+
+
+
+/************************************************************************/
+/* Implementation of the MatchIterator follows: */
+
+
+/* Lets go of the query and the snapshot, once the iterator is done with
+   them. */
+static void
+ahocorasick_MatchIterator_finish(ahocorasick_MatchIterator *self) {
+	if (self->done)
+		return;
+	self->done = 1;
+	PyBuffer_Release(&self->query);
+	ahocorasick_snapshot_release(&self->snapshot);
+}
+
+
+/* Deallocates a match iterator. */
+static void
+ahocorasick_MatchIterator_dealloc(ahocorasick_MatchIterator *self) {
+	ahocorasick_MatchIterator_finish(self);
+	aho_corasick_matches_destroy(&self->matches);
+	Py_DECREF(self->tree);
+	self->tree = NULL;
+	self->ob_type->tp_free((PyObject*) self);
+}
+
+
+
+/* Returns the next match, scanning the query on to the next place that a
+   keyword ends if the ones found at the last have all been handed out.
+   Returns NULL, with no exception set, once the query runs out. */
+static PyObject*
+ahocorasick_MatchIterator_next(ahocorasick_MatchIterator *self) {
+	aho_corasick_int_t states[1 + AHO_CORASICK_DELTAS];
+	aho_corasick_t *g = self->tree->tree;
+	aho_corasick_matches_t matches;
+	aho_corasick_match_t *match;
+	size_t pos, start;
+	int status;
+
+	if (self->next == self->matches.size) {
+		if (self->done)
+			return NULL;
+		/* Another thread mustn't let go of the query under us. */
+		if (self->scanning) {
+			PyErr_SetString(PyExc_ValueError,
+					"MatchIterator already executing");
+			return NULL;
+		}
+		self->scanning = 1;
+		memcpy(states, self->states, sizeof(states));
+		start = pos = (size_t) self->pos;
+		aho_corasick_matches_init(&matches);
+		AHOCORASICK_BEGIN_SEARCH(self->endpos - self->pos)
+			status = ahocorasick_KeywordTree_next_helper
+				(g, self->query.buf, (size_t) self->endpos,
+				 &pos,
+				 ahocorasick_snapshot_options(&self->snapshot),
+				 states, &matches);
+		if (status == 0 && g->text)
+			aho_corasick_matches_to_chars
+				((unsigned char *) self->query.buf + start,
+				 pos - start, start, (size_t) self->offset,
+				 &matches);
+		AHOCORASICK_END_SEARCH
+		ahocorasick_snapshot_flush(&self->snapshot);
+		self->scanning = 0;
+
+		if (status == -1) {
+			aho_corasick_matches_destroy(&matches);
+			PyErr_NoMemory();
+			return NULL;
+		}
+		if (g->text)
+			self->offset += aho_corasick_utf8_chars
+				((unsigned char *) self->query.buf + start,
+				 pos - start);
+		memcpy(self->states, states, sizeof(states));
+		self->pos = (Py_ssize_t) pos;
+		aho_corasick_matches_destroy(&self->matches);
+		self->matches = matches;
+		self->next = 0;
+		if (self->pos == self->endpos)
+			ahocorasick_MatchIterator_finish(self);
+		if (matches.size == 0)
+			return NULL;
+	}
+
+	match = &self->matches.data[self->next++];
+	return ahocorasick_KeywordTree_match(self->tree, match->start,
+					     match->end, match->keyword,
+					     self->with_value);
+}
+
+
+
+static PyTypeObject ahocorasick_MatchIteratorType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                                /*ob_size*/
+    "ahocorasick.MatchIterator",                /*tp_name*/
+    sizeof(ahocorasick_MatchIterator),          /*tp_basicsize*/
+    0,                                                /*tp_itemsize*/
+    (destructor)ahocorasick_MatchIterator_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "MatchIterator objects",   /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    PyObject_SelfIter,         /* tp_iter */
+    (iternextfunc)ahocorasick_MatchIterator_next, /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+    0,                         /* tp_new */
+};
+
+
+
+
 /**********************************************************************/
 /* Module stuff below: */
 
@@ -539,6 +4002,19 @@ init_ahocorasick(void) {
 	if (PyType_Ready(&ahocorasick_StateType) < 0)
 		return;
 
+	if (PyType_Ready(&ahocorasick_StreamType) < 0)
+		return;
+
+	if (PyType_Ready(&ahocorasick_MatchIteratorType) < 0)
+		return;
+
+	if ( (m = PyImport_ImportModule("array")) == NULL)
+		return;
+	ahocorasick_array_type = PyObject_GetAttrString(m, "array");
+	Py_DECREF(m);
+	if (ahocorasick_array_type == NULL)
+		return;
+
 
 	m = Py_InitModule3("_ahocorasick", AhoCorasickMethods,
 			   "Aho-Corasick keyword tree");
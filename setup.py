@@ -20,6 +20,7 @@ setup(name="ahocorasick",
       ext_modules = [Extension("ahocorasick._ahocorasick",
                                ["aho-corasick.c",
                                 "slist.c",
+                                "arena.c",
                                 "py_wrapper.c"],
                                define_macros=[
                                                  ('USE_PYTHON_MALLOC', 1)
@@ -42,15 +42,18 @@
 #ifdef __KERNEL__
 #include <linux/slab.h>
 #define xalloc(s) kmalloc(s,GFP_KERNEL)
+#define xrealloc(p,s) krealloc(p,s,GFP_KERNEL)
 #define xfree(s) kfree(s)
 #else
 #ifdef USE_PYTHON_MALLOC
 #include <Python.h>
 #define xalloc(s) PyMem_Malloc(s)
+#define xrealloc(p,s) PyMem_Realloc(p,s)
 #define xfree(s) PyMem_Free(s)
 #else
 #include <stdlib.h>
 #define xalloc(s) malloc(s)
+#define xrealloc(p,s) realloc(p,s)
 #define xfree(s) free(s)
 #endif
 #endif